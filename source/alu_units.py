@@ -0,0 +1,115 @@
+import amaranth as am
+from amaranth.build import Platform
+
+
+ALU_UNITS = ["comb", "sequential"]
+
+
+# Shared handshake of the sequential units. Raising start latches a and b and
+# starts the operation, ready goes high once the result is valid and stays high
+# until ack. cancel drops an operation that is in progress. Every cycle does
+# log2(radix) steps, so a word_size bit operation takes word_size /
+# log2(radix) cycles plus one for the result.
+class SequentialUnit(am.Elaboratable):
+    def __init__(self, width, radix=2):
+        assert radix in [2, 4, 8, 16], "radix must be a power of two"
+        self.width = width
+        self.steps = radix.bit_length() - 1
+        assert width % self.steps == 0, "width must be a multiple of log2(radix)"
+
+        self.a = am.Signal(width)
+        self.b = am.Signal(width)
+        self.start = am.Signal()
+        self.ack = am.Signal()
+        self.cancel = am.Signal()
+        self.busy = am.Signal()
+        self.ready = am.Signal()
+
+        self.count = am.Signal(range(width + 1))
+
+    def elaborate_control(self, m):
+        with m.If(self.cancel):
+            m.d.sync += self.busy.eq(0)
+            m.d.sync += self.ready.eq(0)
+        with m.Elif(self.start):
+            m.d.sync += self.busy.eq(1)
+            m.d.sync += self.ready.eq(0)
+            m.d.sync += self.count.eq(self.width // self.steps)
+        with m.Elif(self.busy):
+            m.d.sync += self.count.eq(self.count - 1)
+            with m.If(self.count == 1):
+                m.d.sync += self.busy.eq(0)
+                m.d.sync += self.ready.eq(1)
+        with m.Elif(self.ack):
+            m.d.sync += self.ready.eq(0)
+
+
+# Radix 2^n restoring divider. Division by zero gives 0 for both the quotient
+# and the remainder, like // and % do in Amaranth.
+class SequentialDivider(SequentialUnit):
+    def __init__(self, width, radix=2):
+        super().__init__(width, radix)
+        self.quotient = am.Signal(width)
+        self.remainder = am.Signal(width)
+
+    def elaborate(self, platform: Platform):
+        m = am.Module()
+        width = self.width
+        self.elaborate_control(m)
+
+        divisor = am.Signal(width)
+        dividend = am.Signal(width)  # Shifts out the dividend and shifts in the quotient
+        partial = am.Signal(width + 1)
+
+        with m.If(self.start & ~self.cancel):
+            m.d.sync += dividend.eq(self.a)
+            m.d.sync += divisor.eq(self.b)
+            m.d.sync += partial.eq(0)
+        with m.Elif(self.busy):
+            (next_dividend, next_partial) = (dividend, partial)
+            for step in range(self.steps):
+                shifted = am.Cat(next_dividend[width - 1], next_partial[:width])
+                fits = shifted >= divisor
+                next_partial = am.Mux(fits, shifted - divisor, shifted)
+                next_dividend = am.Cat(fits, next_dividend[:width - 1])
+            m.d.sync += dividend.eq(next_dividend)
+            m.d.sync += partial.eq(next_partial)
+
+        m.d.comb += self.quotient.eq(am.Mux(divisor == 0, 0, dividend))
+        m.d.comb += self.remainder.eq(am.Mux(divisor == 0, 0, partial))
+        return m
+
+
+# Radix 2^n shift-add multiplier, with the full 2 * width bit product
+class SequentialMultiplier(SequentialUnit):
+    def __init__(self, width, radix=2):
+        super().__init__(width, radix)
+        self.low = am.Signal(width)
+        self.high = am.Signal(width)
+
+    def elaborate(self, platform: Platform):
+        m = am.Module()
+        width = self.width
+        self.elaborate_control(m)
+
+        multiplicand = am.Signal(width * 2)
+        multiplier = am.Signal(width)
+        product = am.Signal(width * 2)
+
+        with m.If(self.start & ~self.cancel):
+            m.d.sync += multiplicand.eq(self.a)
+            m.d.sync += multiplier.eq(self.b)
+            m.d.sync += product.eq(0)
+        with m.Elif(self.busy):
+            (next_multiplicand, next_multiplier, next_product) = (multiplicand, multiplier, product)
+            for step in range(self.steps):
+                next_product = am.Mux(next_multiplier[0], next_product + next_multiplicand, next_product)
+                next_multiplicand = next_multiplicand << 1
+                next_multiplier = next_multiplier >> 1
+            m.d.sync += multiplicand.eq(next_multiplicand)
+            m.d.sync += multiplier.eq(next_multiplier)
+            m.d.sync += product.eq(next_product)
+
+        m.d.comb += self.low.eq(product[:width])
+        m.d.comb += self.high.eq(product[width:])
+        return m
@@ -1,123 +1,202 @@
 #!/usr/bin/env python3
 
 import argparse
-from codes import Operation, Argument
+from codes import Operation, Argument, ENDIANS, pack_words
+from peephole import format_report, optimize as optimize_tokens
 import re
+from source_map import SourceMap
+import time
 
 
-def parse_tokens(token_list):
-    byte_list = []
+SEPARATORS = re.compile(r" |\t")
+
+
+# First pass: lay out the program. Emits one item per word, which is either a
+# number or a reference to a label that is not defined yet, and collects the
+# label addresses and a (address, line, label, text) entry for every source
+# line that emitted bytes. Tokens are consumed from an iterator, so this is
+# linear in the size of the program.
+def layout(tokens, verbosity=0):
+    items = []
     labels = {}
-    deferred_tokens = []
+    entries = []
+    emit = items.append
+
+    line = 1
+    line_start = 0
+    line_tokens = []
+    scope = None
 
-    while len(token_list):
-        token = token_list.pop(0)
+    tokens = iter(tokens)
+    for token in tokens:
+        start = len(items)
+        upper = token.upper()
 
         if token.endswith(":"):
             label = token.strip(":")
-            labels[label] = len(byte_list)
+            labels[label] = len(items)
+            scope = label
+            line_start = len(items)
 
-        elif token == ".byte":
-            token = token_list.pop(0)
+        elif token in [".byte", ".word"]:
+            line_tokens.append(token)
+            token = next(tokens)
             while token != "\n":
-                byte_list.append(int(token, 0))
-                print(f"0 Assembled: {int(token, 0)} (from {token})")
-                token = token_list.pop(0)
+                emit(int(token, 0))
+                line_tokens.append(token)
+                token = next(tokens)
 
-        elif token.upper() in Operation.members():
-            byte_list.append(int(Operation.get(token.upper())))
-            print(f"1 Assembled: {int(Operation.get(token.upper()))} (from {token})")
+        elif Operation.contains(upper):
+            emit(Operation.get(upper))
 
-        elif token.upper() in Argument.members():
-            byte_list.append(Argument.REG)
-            print(f"2 Assembled: {Argument.REG} (from {token})")
-            byte_list.append(int(Argument.get(token.upper())))
-            print(f"3 Assembled: {int(Argument.get(token.upper()))} (from {token})")
+        elif Argument.contains(upper):
+            emit(Argument.REG)
+            emit(Argument.get(upper))
 
         elif token[0] == "#":
-            byte_list.append(Argument.IMM)
-            print(f"4 Assembled: {Argument.IMM} (from {token})")
-            byte_list.append(int(token[1:], 0))
-            print(f"5 Assembled: {int(token[1:], 0)} (from {token})")
+            emit(Argument.IMM)
+            emit(int(token[1:], 0))
 
-        elif token[0] == "[" and token[1] != "#" and token[-1] == "]" and token[1:-1].upper() in Argument.members():
-            byte_list.append(Argument.IND)
-            print(f"6 Assembled: {Argument.IND} (from {token})")
-            byte_list.append(int(Argument.get(token[1:-1].upper())))
-            print(f"7 Assembled: {int(Argument.get(token[1:-1].upper()))} (from {token})")
+        elif token[0] == "[" and token[1] != "#" and token[-1] == "]" and Argument.contains(upper[1:-1]):
+            emit(Argument.IND)
+            emit(Argument.get(upper[1:-1]))
 
         elif token[0] == "[" and token[1] == "#" and token[-1] == "]":
-            byte_list.append(Argument.RAM)
-            print(f"8 Assembled: {Argument.RAM} (from {token})")
-            byte_list.append(int(token[2:-1], 0))
-            print(f"9 Assembled: {int(token[2:-1], 0)} (from {token})")
+            emit(Argument.RAM)
+            emit(int(token[2:-1], 0))
 
         elif token == "\n":
             # TODO : Write out the args param when it has been refactored
             pass
 
         elif token in labels:
-            byte_list.append(Argument.IMM)
-            print(f"10 Assembled: {Argument.IMM} (from {token})")
-            byte_list.append(labels[token])
-            print(f"11 Assembled: {labels[token]} (from {token})")
+            emit(Argument.IMM)
+            emit(labels[token])
 
         else:
-            # raise Exception(f"Unknown token: #{token}#")
             # Unknown token, defer it for later (if it is eg. a future label) and add a placeholder
-            byte_list.append(Argument.IMM)
-            print(f"12 Assembled: {Argument.IMM} (from {token})")
-            deferred_tokens.append((len(byte_list), token))
-            byte_list.append(0)
-            print(f"13 Assembled: {0} (deferred token) (from {token})")
-
-    # Check the deferred tokens
-    for (offset, token) in deferred_tokens:
-        if token in labels:
-            byte_list[offset] = labels[token]
-            print(f"14 Assembled deferred token at {offset}: {labels[token]} (from {token})")
+            emit(Argument.IMM)
+            emit(token)
+
+        if token == "\n":
+            if len(items) > line_start:
+                entries.append((line_start, line, scope, " ".join(line_tokens)))
+            line += 1
+            line_start = len(items)
+            line_tokens = []
         else:
-            raise Exception(f"Unknown token: #{token}#")
-
-    # Fix up the numbers
-    for index in range(len(byte_list)):
-        if byte_list[index] < 0:
-            byte_list[index] = 256 + byte_list[index]
-        if byte_list[index] > 255:
-            byte_list[index] = 255 & byte_list[index]
+            line_tokens.append(token)
+
+        if verbosity >= 2 and len(items) > start:
+            print(f"Assembled at {start}: {items[start:]} (from {token})")
+
+    return (items, labels, entries)
+
+
+# Second pass: resolve the deferred labels and encode the words. Numbers must
+# fit in a word, either signed or unsigned.
+def encode(items, labels, verbosity=0, word_size=8):
+    mask = (1 << word_size) - 1
+    lowest = -(1 << (word_size - 1))
+    words = [0] * len(items)
+    for (offset, item) in enumerate(items):
+        if item.__class__ is str:
+            if item not in labels:
+                raise Exception(f"Unknown token: #{item}#")
+            if verbosity >= 2:
+                print(f"Assembled deferred token at {offset}: {labels[item]} (from {item})")
+            item = labels[item]
+        if item < lowest or item > mask:
+            raise Exception(f"Value {item} at {offset} does not fit in {word_size} bits")
+        words[offset] = item & mask
 
     # Add final halt if needed
-    if byte_list[-1] != Operation.HALT:
-        byte_list.append(int(Operation.HALT))
-
-    # print(labels)
-    # print(byte_list)
-    print(f"Assembled {len(byte_list)} bytes")
-    return bytes(byte_list)
-    # return byte_list
+    if len(words) == 0 or words[-1] != Operation.HALT:
+        words.append(Operation.HALT)
+
+    return words
+
+
+# Returns the ROM image, with word_size / 8 bytes per word in the given byte
+# order, and the source map, which is addressed in words. With optimize set,
+# the peephole optimizer runs first and fills in report if it is given.
+def assemble(token_list, verbosity=0, timings=None, file=None, word_size=8, endian="little", optimize=False,
+             report=None):
+    if optimize:
+        start = time.perf_counter()
+        (token_list, optimized) = optimize_tokens(token_list, word_size)
+        if report is not None:
+            report.update(optimized)
+        if timings is not None:
+            timings["optimize"] = time.perf_counter() - start
+    start = time.perf_counter()
+    (items, labels, entries) = layout(token_list, verbosity)
+    middle = time.perf_counter()
+    words = encode(items, labels, verbosity, word_size)
+    byte_list = pack_words(words, word_size, endian)
+    end = time.perf_counter()
+
+    if len(words) > len(items):
+        entries.append((len(items), None, entries[-1][2] if len(entries) > 0 else None, "halt"))
+    source_map = SourceMap.build(file, len(words), labels, entries)
+
+    if timings is not None:
+        timings["pass 1"] = middle - start
+        timings["pass 2"] = end - middle
+    if verbosity >= 1:
+        print(f"Assembled {len(words)} words ({len(byte_list)} bytes)")
+    return (byte_list, source_map)
+
+
+def parse_tokens(token_list, verbosity=0, timings=None, word_size=8, endian="little"):
+    return assemble(token_list, verbosity, timings, word_size=word_size, endian=endian)[0]
 
 
 def tokenize(s):
-    tokens = []
-
     for line in s:
         line_tokens = line
         line_tokens = line_tokens.split(";")[0]
         line_tokens = line_tokens.strip()
-        line_tokens = re.split(r" |\t", line_tokens)
-        line_tokens.append("\n")
-        if len(line_tokens) > 0:
-            tokens += list(filter(lambda s: s != "", line_tokens))
-    return tokens
+        line_tokens = SEPARATORS.split(line_tokens)
+        for token in line_tokens:
+            if token != "":
+                yield token
+        yield "\n"
 
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("-i", "--input", nargs=1)
     ap.add_argument("-o", "--output", nargs=1)
+    ap.add_argument("-m", "--map", nargs=1, default=None, help="also write a source map to this file")
+    ap.add_argument("-v", "--verbose", action="count", default=1, help="repeat to log every assembled word")
+    ap.add_argument("-q", "--quiet", action="store_true")
+    ap.add_argument("-t", "--timing", action="store_true", help="report the time spent in every pass")
+    ap.add_argument("-w", "--word-size", type=int, default=8, choices=[8, 16, 32])
+    ap.add_argument("--endian", default="little", choices=ENDIANS, help="byte order of the words in the ROM")
+    ap.add_argument("-O", "--optimize", action="store_true", help="run the peephole optimizer and report what it saved")
     args = ap.parse_args()
+    verbosity = 0 if args.quiet else args.verbose
 
+    timings = {}
+    start = time.perf_counter()
     with open(args.input[0], "r") as ifs:
-        tokens = tokenize(ifs.readlines())
-        with open(args.output[0], "wb") as ofs:
-            ofs.write(parse_tokens(tokens))
+        tokens = list(tokenize(ifs))
+    timings["tokenize"] = time.perf_counter() - start
+
+    report = {}
+    (byte_list, source_map) = assemble(tokens, verbosity, timings, args.input[0], args.word_size, args.endian,
+                                       args.optimize, report)
+    if args.optimize and verbosity >= 1:
+        print(format_report(report, args.word_size))
+
+    start = time.perf_counter()
+    with open(args.output[0], "wb") as ofs:
+        ofs.write(byte_list)
+    if args.map:
+        source_map.save(args.map[0])
+    timings["write"] = time.perf_counter() - start
+
+    if args.timing:
+        for (name, seconds) in timings.items():
+            print(f"{name}: {seconds * 1000:.3f} ms")
@@ -1,23 +1,132 @@
 #!/usr/bin/env python3
 
-import struct
+import argparse
+import array
+import sys
+
+
+CFI = 0  # Carry flag signal index
+OFI = 1  # Overflow flag signal index
+SFI = 2  # Signed flag signal index
+ZFI = 3  # Zero flag signal index
+
+CF = 1 << CFI  # Carry flag mask
+OF = 1 << OFI  # Overflow flag mask
+SF = 1 << SFI  # Signed flag mask
+ZF = 1 << ZFI  # Zero flag mask
+
+IRQ_INPUTI = 0  # Input available interrupt index
+IRQ_OUTPUTI = 1  # Output space interrupt index
+IRQ_TIMERI = 2  # Timer compare interrupt index
+IRQ_SOFTWAREI = 3  # Software interrupt index
+
+IRQ_INPUT = 1 << IRQ_INPUTI  # Input available interrupt mask
+IRQ_OUTPUT = 1 << IRQ_OUTPUTI  # Output space interrupt mask
+IRQ_TIMER = 1 << IRQ_TIMERI  # Timer compare interrupt mask
+IRQ_SOFTWARE = 1 << IRQ_SOFTWAREI  # Software interrupt mask
+IRQ_ALL = IRQ_INPUT | IRQ_OUTPUT | IRQ_TIMER | IRQ_SOFTWARE
+
+NUM_ARGS_0 = 0 * 2 + 1
+NUM_ARGS_1 = 1 * 2 + 1
+NUM_ARGS_2 = 2 * 2 + 1
+NUM_ARGS_3 = 3 * 2 + 1
+
+
+ENDIANS = ["little", "big"]
+
+
+# ROM images store every word in word_size / 8 bytes
+def word_type(word_size):
+    assert word_size in [8, 16, 32], "word_size must be 8, 16 or 32"
+    return next(code for code in "BHIL" if array.array(code).itemsize == word_size // 8)
+
+
+# Bytes of an Intel HEX image. Data, end of file and both extended address
+# records are supported, gaps read as 0 and start addresses are ignored.
+def read_intel_hex(text):
+    image = bytearray()
+    base = 0
+    for (number, line) in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise Exception(f"Intel HEX line {number} does not start with ':'")
+        record = bytes.fromhex(line[1:])
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise Exception(f"Intel HEX line {number} has the wrong length")
+        if sum(record) & 0xFF != 0:
+            raise Exception(f"Intel HEX line {number} has a bad checksum")
+        (kind, data) = (record[3], record[4:-1])
+        if kind == 0x00:
+            address = base + (record[1] << 8 | record[2])
+            if len(image) < address + len(data):
+                image.extend(bytes(address + len(data) - len(image)))
+            image[address:address + len(data)] = data
+        elif kind == 0x01:
+            break
+        elif kind == 0x02:
+            base = int.from_bytes(data, "big") << 4
+        elif kind == 0x04:
+            base = int.from_bytes(data, "big") << 16
+        elif kind not in [0x03, 0x05]:
+            raise Exception(f"Intel HEX line {number} has unknown record type {kind:02X}")
+    return bytes(image)
+
+
+# Words of a ROM image, which is a file name or anything with the buffer
+# protocol (bytes, bytearray, memoryview). Converted in one pass. Files
+# ending in .hex or .ihex are Intel HEX, other files raw words.
+def load_words(rom, word_size=8, endian="little"):
+    if isinstance(rom, str):
+        if rom.endswith((".hex", ".ihex")):
+            with open(rom, "r") as ifs:
+                rom = read_intel_hex(ifs.read())
+        else:
+            with open(rom, "rb") as ifs:
+                rom = ifs.read()
+    rom = memoryview(rom).cast("B")
+    words = array.array(word_type(word_size))
+    if len(rom) % words.itemsize != 0:
+        raise Exception(f"ROM size {len(rom)} is not a multiple of {words.itemsize} bytes")
+    words.frombytes(rom)
+    if endian != sys.byteorder and words.itemsize > 1:
+        words.byteswap()
+    return words
+
+
+def pack_words(words, word_size=8, endian="little"):
+    packed = array.array(word_type(word_size), words)
+    if endian != sys.byteorder and packed.itemsize > 1:
+        packed.byteswap()
+    return packed.tobytes()
 
 
 class MyEnum:
+    # Name and number tables are built once, when a subclass is defined
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._members = [attr for attr in dir(cls) if not callable(getattr(cls, attr)) and not attr.startswith("_")]
+        cls._numbers = {mem: getattr(cls, mem) for mem in cls._members}
+        cls._names = {}
+        for mem in cls._members:
+            cls._names.setdefault(cls._numbers[mem], mem)
+
     @classmethod
     def members(cls):
-        return [attr for attr in dir(cls) if not callable(getattr(cls, attr)) and not attr.startswith("_")]
+        return cls._members
+
+    @classmethod
+    def contains(cls, name):
+        return name in cls._numbers
 
     @classmethod
     def get(cls, name):
-        return getattr(cls, name)
+        return cls._numbers[name]
 
     @classmethod
     def lookup(cls, number):
-        for mem in cls.members():
-            if cls.get(mem) == number:
-                return mem
-        return f"{number}"
+        return cls._names.get(number, f"{number}")
 
 
 class Argument(MyEnum):
@@ -45,33 +154,47 @@ class Argument(MyEnum):
     RAM = 18  # [#123]
 #    IMM_REL = 17  # #+123, used for jmp
 
+    # Performance counters, read-only register operands
+    CNT_RETIRED = 19  # Instructions retired
+    CNT_HALTED = 20  # Cycles with hf set
+    CNT_TAKEN = 21  # Jumps taken
+    CNT_NOT_TAKEN = 22  # Conditional jumps not taken
+    CNT_ALU = 23  # ALU instructions retired
+    CNT_JUMP = 24  # Jumps retired
+    CNT_CALL = 25  # CALL and RET retired
+    CNT_STACK = 26  # PUSH and POP retired
+    CNT_INPUT_STALLS = 27  # Reads of INPUT before the bench answered the previous one
+    CNT_MEM_READS = 28  # RAM operands and POP
+    CNT_MEM_WRITES = 29  # RAM destinations and PUSH
+    CNT_WAIT = 30  # Cycles asleep in WAIT
+
+    # Interrupt controller, only with interrupts enabled
+    IE = 31  # Enabled sources, IRQ_* mask
+    IP = 32  # Pending sources, writing clears or sets the timer and software ones
+    TIMER = 33  # The timer source fires when TICK equals this
+    EPC = 34  # PC to return to
+    ESTATUS = 35  # STATUS to return with
+    IVEC = 36  # Address of the handler
+
     _NUM_REGS = TICK + 1
+    _FIRST_COUNTER = CNT_RETIRED
+    _NUM_COUNTERS = CNT_WAIT - CNT_RETIRED + 1
+    _FIRST_CONTROL = IE
+    _NUM_CONTROLS = IVEC - IE + 1
+
+    @classmethod
+    def is_counter(cls, number):
+        return cls._FIRST_COUNTER <= number < cls._FIRST_COUNTER + cls._NUM_COUNTERS
+
+    @classmethod
+    def is_control(cls, number):
+        return cls._FIRST_CONTROL <= number < cls._FIRST_CONTROL + cls._NUM_CONTROLS
 
 
 class Operation(MyEnum):
     @staticmethod
     def decode(bytebuf):
-        def decode_arg(bytebuf, offset):
-            mode = Argument.lookup(struct.unpack('B', bytebuf[offset:offset+1])[0])
-            reg = Argument.lookup(struct.unpack('B', bytebuf[offset+1:offset+2])[0])
-            imm = bytebuf[offset+1]
-            out = ""
-            if mode == "REG":
-                out = f"{reg} "
-            elif mode == "IMM":
-                out = f"#{imm:02X} "
-            elif mode == "IND":
-                out = f"[{reg}] "
-            elif mode == "RAM":
-                out = f"[#{imm:02X}] "
-            return out
-
-        out = f"{Operation.lookup(struct.unpack('B', bytebuf[0:1])[0])} "
-        out += decode_arg(bytebuf, 1)
-        out += decode_arg(bytebuf, 3)
-        out += decode_arg(bytebuf, 5)
-
-        return out
+        return disassemble(bytebuf, end=1)[0].text
 
     HALT = 0
     NOP = 1
@@ -136,6 +259,266 @@ class Operation(MyEnum):
     PUSH = 34  # push a0, sp -= 1
     POP = 35  # sp += 1, a0 = pop
 
+    WAIT = 36  # sleep until an enabled interrupt is pending
+    RETI = 37  # pc = epc, status = estatus
+
+
+# Encoded size of every instruction, in words
+SIZES = {
+    Operation.HALT: NUM_ARGS_0,
+    Operation.NOP: NUM_ARGS_0,
+
+    Operation.AND: NUM_ARGS_3,
+    Operation.OR: NUM_ARGS_3,
+    Operation.XOR: NUM_ARGS_3,
+
+    Operation.NOT: NUM_ARGS_2,
+    Operation.NEG: NUM_ARGS_2,
+    Operation.ABS: NUM_ARGS_2,
+
+    Operation.ADD: NUM_ARGS_3,
+    Operation.SUB: NUM_ARGS_3,
+
+    Operation.MULL: NUM_ARGS_3,
+    Operation.MULH: NUM_ARGS_3,
+
+    Operation.DIV: NUM_ARGS_3,
+    Operation.MOD: NUM_ARGS_3,
+
+    Operation.CMP: NUM_ARGS_2,
+
+    Operation.INC: NUM_ARGS_1,
+    Operation.DEC: NUM_ARGS_1,
+
+    Operation.MIN: NUM_ARGS_3,
+    Operation.MAX: NUM_ARGS_3,
+
+    Operation.ASHR: NUM_ARGS_3,
+    Operation.SHR: NUM_ARGS_3,
+    Operation.SHL: NUM_ARGS_3,
+
+    Operation.COPY: NUM_ARGS_2,
+
+    Operation.JUMP: NUM_ARGS_1,
+    Operation.JC: NUM_ARGS_1,
+    Operation.JNC: NUM_ARGS_1,
+    Operation.JO: NUM_ARGS_1,
+    Operation.JNO: NUM_ARGS_1,
+    Operation.JS: NUM_ARGS_1,
+    Operation.JNS: NUM_ARGS_1,
+    Operation.JZ: NUM_ARGS_1,
+    Operation.JNZ: NUM_ARGS_1,
+
+    Operation.CALL: NUM_ARGS_1,
+    Operation.RET: NUM_ARGS_0,
+
+    Operation.PUSH: NUM_ARGS_1,
+    Operation.POP: NUM_ARGS_1,
+
+    Operation.WAIT: NUM_ARGS_0,
+    Operation.RETI: NUM_ARGS_0,
+}
+
+
+# Semantics of every opcode, which Cpu, PipelinedCpu and IsaSim all decode from:
+# (kind, expression or jump condition, result location, flags, pc increment).
+# Expressions are Python, evaluated by IsaSim with alu_functions().
+OPS = {
+    Operation.HALT: ("halt", None, 3, 0, 0),
+    Operation.NOP: ("next", None, 3, 0, NUM_ARGS_0),
+
+    Operation.AND: ("alu", "{a} & {b}", 2, SF | ZF, NUM_ARGS_3),
+    Operation.OR: ("alu", "{a} | {b}", 2, SF | ZF, NUM_ARGS_3),
+    Operation.XOR: ("alu", "{a} ^ {b}", 2, SF | ZF, NUM_ARGS_3),
+
+    Operation.NOT: ("alu", "~{a}", 1, SF | ZF, NUM_ARGS_2),
+    Operation.NEG: ("alu", "-{a}", 1, SF | ZF, NUM_ARGS_2),
+    Operation.ABS: ("alu", "{a}", 1, SF | ZF, NUM_ARGS_2),
+
+    Operation.ADD: ("alu", "{a} + {b}", 2, CF | OF | SF | ZF, NUM_ARGS_3),
+    Operation.SUB: ("alu", "{a} - {b}", 2, CF | OF | SF | ZF, NUM_ARGS_3),
+
+    Operation.MULL: ("alu", "{a} * {b}", 2, SF | ZF, NUM_ARGS_3),
+    Operation.MULH: ("alu", "({a} * {b}) >> WORD_SIZE", 2, SF | ZF, NUM_ARGS_3),
+
+    Operation.DIV: ("alu", "div({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+    Operation.MOD: ("alu", "mod({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+
+    Operation.CMP: ("alu", "mod({a}, {b})", 3, CF | OF | SF | ZF, NUM_ARGS_2),
+
+    Operation.INC: ("alu", "{a} + 1", 0, CF | OF | SF | ZF, NUM_ARGS_1),
+    Operation.DEC: ("alu", "{a} - 1", 0, CF | OF | SF | ZF, NUM_ARGS_1),
+
+    Operation.MIN: ("alu", "min({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+    Operation.MAX: ("alu", "max({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+
+    Operation.ASHR: ("alu", "ashr({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+    Operation.SHR: ("alu", "shr({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+    Operation.SHL: ("alu", "shl({a}, {b})", 2, SF | ZF, NUM_ARGS_3),
+
+    Operation.COPY: ("alu", "{a}", 1, SF | ZF, NUM_ARGS_2),
+
+    Operation.JUMP: ("jump", "True", 3, 0, NUM_ARGS_1),
+    Operation.JC: ("jump", f"R[{Argument.STATUS}] & {CF}", 3, 0, NUM_ARGS_1),
+    Operation.JNC: ("jump", f"not R[{Argument.STATUS}] & {CF}", 3, 0, NUM_ARGS_1),
+    Operation.JO: ("jump", f"R[{Argument.STATUS}] & {OF}", 3, 0, NUM_ARGS_1),
+    Operation.JNO: ("jump", f"not R[{Argument.STATUS}] & {OF}", 3, 0, NUM_ARGS_1),
+    Operation.JS: ("jump", f"R[{Argument.STATUS}] & {SF}", 3, 0, NUM_ARGS_1),
+    Operation.JNS: ("jump", f"not R[{Argument.STATUS}] & {SF}", 3, 0, NUM_ARGS_1),
+    Operation.JZ: ("jump", f"R[{Argument.STATUS}] & {ZF}", 3, 0, NUM_ARGS_1),
+    Operation.JNZ: ("jump", f"not R[{Argument.STATUS}] & {ZF}", 3, 0, NUM_ARGS_1),
+
+    Operation.CALL: ("call", None, 3, 0, NUM_ARGS_1),
+    Operation.RET: ("ret", None, 3, 0, 0),
+
+    Operation.PUSH: ("push", None, 3, 0, NUM_ARGS_1),
+    Operation.POP: ("pop", None, 0, 0, NUM_ARGS_1),
+
+    Operation.WAIT: ("wait", None, 3, 0, NUM_ARGS_0),
+    Operation.RETI: ("reti", None, 3, 0, 0),
+}
+
+# Performance counter of every kind of instruction
+CLASSES = {
+    "alu": Argument.CNT_ALU,
+    "jump": Argument.CNT_JUMP,
+    "call": Argument.CNT_CALL,
+    "ret": Argument.CNT_CALL,
+    "reti": Argument.CNT_CALL,
+    "push": Argument.CNT_STACK,
+    "pop": Argument.CNT_STACK,
+}
+
+
+# Operand slots that an instruction reads, not counting the destination
+def source_slots(opcode):
+    (kind, expr, location, flags, size) = OPS[opcode]
+    if kind == "alu":
+        return [0, 1] if "{b}" in expr else [0]
+    if kind in ["jump", "call", "push"]:
+        return [0]
+    return []
+
+
+# Counter increments of one retired instruction that only depend on its
+# encoding. modes can be numbers or Amaranth values, so that IsaSim, Cpu and
+# PipelinedCpu all count the same way. Taken jumps and input stalls are counted
+# by the caller.
+def counter_events(opcode, modes):
+    events = {Argument.CNT_RETIRED: 1}
+    if opcode not in OPS:
+        return events
+    (kind, expr, location, flags, size) = OPS[opcode]
+
+    def in_ram(mode):
+        return (mode == Argument.IND) | (mode == Argument.RAM)
+
+    if kind in CLASSES:
+        events[CLASSES[kind]] = 1
+    reads = [in_ram(modes[index]) for index in source_slots(opcode)] + ([1] if kind == "pop" else [])
+    writes = ([in_ram(modes[location])] if location < 3 else []) + ([1] if kind == "push" else [])
+    if len(reads) > 0:
+        events[Argument.CNT_MEM_READS] = sum(reads)
+    if len(writes) > 0:
+        events[Argument.CNT_MEM_WRITES] = sum(writes)
+    return events
+
+
+# Whether the instruction writes RAM. Interrupts are not taken on these, as with
+# caches the store may already be on the bus when the interrupt arrives.
+def stores(opcode, modes):
+    if opcode not in OPS:
+        return False
+    (kind, expr, location, flags, size) = OPS[opcode]
+    return kind == "push" or (location < 3 and modes[location] in [Argument.IND, Argument.RAM])
+
+
+# Names the OPS expressions use besides their operands
+def alu_functions(word_size):
+    sign_bit = 1 << (word_size - 1)
+    return {
+        "MASK": (1 << word_size) - 1,
+        "WORD_SIZE": word_size,
+        "div": lambda a, b: 0 if b == 0 else a // b,
+        "mod": lambda a, b: 0 if b == 0 else a % b,
+        "shr": lambda a, b: a >> b if b < word_size else 0,
+        "shl": lambda a, b: a << b if b < word_size else 0,
+        "ashr": lambda a, b: ((a ^ sign_bit) - sign_bit) >> min(b, word_size),
+    }
+
+
+class Instruction:
+    def __init__(self, address, opcode, operands, raw):
+        self.address = address
+        self.opcode = opcode
+        self.operands = operands  # ((mode, value), ...)
+        self.raw = raw
+        self.size = len(raw)
+
+    @property
+    def name(self):
+        return Operation.lookup(self.opcode) if self.opcode in SIZES else None
+
+    @property
+    def text(self):
+        if self.opcode not in SIZES or len(self.raw) < SIZES[self.opcode]:
+            return ".byte " + " ".join(f"0x{value:02X}" for value in self.raw)
+        return " ".join([self.name] + [format_operand(mode, value) for (mode, value) in self.operands])
+
+    def __repr__(self):
+        return f"Instruction({self.address:#04x}, {self.text!r})"
+
+
+def format_operand(mode, value):
+    if mode == Argument.REG:
+        return f"{Argument.lookup(value)}"
+    elif mode == Argument.IMM:
+        return f"#{value:02X}"
+    elif mode == Argument.IND:
+        return f"[{Argument.lookup(value)}]"
+    elif mode == Argument.RAM:
+        return f"[#{value:02X}]"
+    return f"?{mode:02X}:{value:02X}"
+
+
+# Linear sweep over a ROM image or memory buffer (bytes, bytearray, memoryview
+# or a list of words), one slice per instruction. Unknown opcodes and
+# instructions cut off by the end of the buffer decode as one .byte each.
+def disassemble(buf, base=0, start=0, end=None):
+    if isinstance(buf, (bytes, bytearray)):
+        buf = memoryview(buf)
+    if end is None:
+        end = len(buf)
+
+    records = []
+    address = start
+    while address < end:
+        opcode = buf[address]
+        size = SIZES.get(opcode, 1)
+        raw = buf[address:address + size]
+        if len(raw) < size:
+            raw = buf[address:address + 1]
+        raw = bytes(raw) if isinstance(raw, memoryview) else tuple(raw)
+        operands = tuple((raw[index], raw[index + 1]) for index in range(1, len(raw) - 1, 2))
+        records.append(Instruction(base + address, opcode, operands, raw))
+        address += len(raw)
+    return records
+
+
+def listing(records, word_size=8):
+    digits = word_size // 4
+    lines = []
+    for record in records:
+        raw = " ".join(f"{value:0{digits}X}" for value in record.raw)
+        lines.append(f"{record.address:03X}: {raw:<{NUM_ARGS_3 * (digits + 1) - 1}} {record.text}")
+    return "\n".join(lines)
+
 
 if __name__ == "__main__":
-    pass
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("-w", "--word-size", type=int, default=8)
+    ap.add_argument("--endian", default="little", choices=ENDIANS)
+    args = ap.parse_args()
+
+    print(listing(disassemble(load_words(args.input[0], args.word_size, args.endian)), args.word_size))
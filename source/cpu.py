@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 
 import amaranth as am
+import argparse
 from amaranth.build import Platform
 # from amaranth.lib import data
-from amaranth.sim import Simulator
-import os
-import struct
-
-from codes import Operation, Argument
+from amaranth.lib.fifo import SyncFIFO
+from amaranth.sim import Settle, Simulator
+
+from alu_units import ALU_UNITS, SequentialDivider, SequentialMultiplier
+from codes import Operation, Argument, SIZES
+from codes import CFI, OFI, SFI, ZFI, CF, OF, SF, ZF
+from codes import NUM_ARGS_0, NUM_ARGS_1, NUM_ARGS_2, NUM_ARGS_3
+from codes import IRQ_TIMERI, IRQ_SOFTWAREI, IRQ_TIMER, IRQ_SOFTWARE
+from codes import ENDIANS, load_words
+from codes import CLASSES, OPS, counter_events, source_slots
+from debugger import Debugger
+from memory_bus import Arbiter, BackingMemory, Cache, WishboneBus
+from snapshot import take_snapshot
+from source_map import SourceMap
+from stream import StreamDriver, read_stream
+from retire_trace import RetireTrace
+from vcd_trace import VcdTrace, DEFAULT_SIGNALS
+
+
+# Shifting by the whole amount makes a value 2^word_size bits wide, so only the
+# low bits of the amount are used and shifting out the whole word gives 0
+def shift_left(value, amount, word_size):
+    bits = (word_size - 1).bit_length()
+    return am.Mux(amount >= word_size, 0, value << amount[:bits])
 
 
 class C:
@@ -54,22 +74,6 @@ class C:
     BG_BWHITE = '\033[107m'
 
 
-CFI = 0  # Carry flag signal index
-OFI = 1  # Overflow flag signal index
-SFI = 2  # Signed flag signal index
-ZFI = 3  # Zero flag signal index
-
-CF = 1 << CFI  # Carry flag mask
-OF = 1 << OFI  # Overflow flag mask
-SF = 1 << SFI  # Signed flag mask
-ZF = 1 << ZFI  # Zero flag mask
-
-NUM_ARGS_0 = 0 * 2 + 1
-NUM_ARGS_1 = 1 * 2 + 1
-NUM_ARGS_2 = 2 * 2 + 1
-NUM_ARGS_3 = 3 * 2 + 1
-
-
 class Cpu(am.Elaboratable):
     def f(self, index):
         return self.registers[Argument.STATUS][index]
@@ -134,11 +138,33 @@ class Cpu(am.Elaboratable):
     def tick(self):
         return self.registers[Argument.TICK]
 
-    def __init__(self, rom_file="build/rom_file", word_size=8, addr_bus_width=8, ram_size=256):
+    # Address of a RAM port for a word address. Past the end of RAM it is the
+    # last word, as with indexing self.ram.
+    def ram_address(self, address):
+        if 1 << self.word_size <= self.ram.depth:
+            return address
+        return am.Mux(address >= self.ram.depth, self.ram.depth - 1, address)
+
+    def counter(self, name):
+        return self.counters[Argument.get(name.upper()) - Argument._FIRST_COUNTER]
+
+    def control(self, name):
+        return self.controls[Argument.get(name.upper()) - Argument._FIRST_CONTROL]
+
+    def __init__(self, rom_file="build/rom_file", word_size=8, addr_bus_width=8, ram_size=256, harvard=False,
+                 multiplier="comb", divider="comb", alu_radix=2, endian="little", cache_lines=0, line_size=4,
+                 memory_latency=2, io_fifo_depth=0, interrupts=False):
+        assert multiplier in ALU_UNITS and divider in ALU_UNITS, f"ALU units must be one of {ALU_UNITS}"
+        assert not (harvard and cache_lines), "the instruction cache replaces the harvard instruction memory"
         self.word_size = word_size
+        self.endian = endian
+        self.addr_bus_width = addr_bus_width
+        self.memory_latency = memory_latency
         self.ram_size = ram_size + 6
-
-        bytes_in_word = int(word_size/8)
+        self.harvard = harvard
+        self.multiplier = multiplier
+        self.divider = divider
+        self.alu_radix = alu_radix
 
         # Set up internal flags
         self.hf = am.Signal()  # Halt flag
@@ -150,17 +176,338 @@ class Cpu(am.Elaboratable):
         self.registers = am.Memory(width=word_size, depth=Argument._NUM_REGS)
         self.sp().reset = ram_size - 1
 
-        # Set up RAM
-        plain_ram = []
-        with open(rom_file, "rb") as ifs:
-            ifs.seek(0, os.SEEK_END)
-            self.rom_size = ifs.tell()
-            ifs.seek(0)
-            while ifs.tell() != self.rom_size:
-                plain_ram.append(struct.unpack(f"{bytes_in_word}B", ifs.read(bytes_in_word))[0])
+        # Performance counters, which programs read as the CNT_* registers
+        self.counters = []
+        for index in range(Argument._NUM_COUNTERS):
+            name = Argument.lookup(Argument._FIRST_COUNTER + index).lower()
+            self.counters.append(am.Signal(word_size, name=name))
+
+        # Set up RAM, from a ROM image with word_size / 8 bytes per word
+        plain_ram = list(load_words(rom_file, word_size, endian))
+        self.rom_size = len(plain_ram)
 
         self.ram = am.Memory(width=word_size, depth=self.ram_size, init=plain_ram)
 
+        # With harvard set, instructions are fetched from a read-only copy of the
+        # ROM instead. It is split in 8 banks, word n in bank n % 8, so that every
+        # word is stored once and one read of each bank returns the 7 words of an
+        # instruction at any address. Writes to RAM do not change the code. Data
+        # RAM then has one registered read port and one write port, and the
+        # words an instruction loads are read one per cycle.
+        self.imem = None
+        self.data_addr = [am.Signal(word_size, name=f"data_addr{slot}") for slot in range(4)]
+        self.data = [am.Signal(word_size, name=f"data{slot}") for slot in range(4)]
+        if harvard:
+            self.imem = [am.Memory(width=word_size, depth=len(bank), init=bank, name=f"imem{index}")
+                         for (index, bank) in enumerate(self.code_banks(plain_ram))]
+
+        # With cache_lines set, RAM is a backing memory on a Wishbone bus with
+        # memory_latency wait states, behind an instruction and a data cache.
+        # Stores write through to RAM and stall until it acknowledges them.
+        self.icache = None
+        self.dcache = None
+        if cache_lines:
+            assert ram_size <= 1 << addr_bus_width, "RAM is larger than the address bus"
+            self.icache = Cache(word_size, addr_bus_width, cache_lines, line_size, 7, "icache")
+            # Ports 0 to 2 read the operands, 3 the top of the stack for POP
+            self.dcache = Cache(word_size, addr_bus_width, cache_lines, line_size, 4, "dcache")
+            self.store_bus = WishboneBus(word_size, addr_bus_width, "store")
+
+        # With io_fifo_depth set, reading INPUT pops the input FIFO and writing
+        # OUTPUT pushes to the output FIFO. The other ends are ready/valid
+        # streams for the bench, and an instruction stalls while the input
+        # FIFO is empty or the output FIFO is full. irf and owf still pulse.
+        self.input_fifo = None
+        self.output_fifo = None
+        if io_fifo_depth:
+            self.input_fifo = SyncFIFO(width=word_size, depth=io_fifo_depth)
+            self.output_fifo = SyncFIFO(width=word_size, depth=io_fifo_depth)
+
+        # With interrupts set, the IE to IVEC registers of the interrupt
+        # controller. An enabled, pending interrupt is taken instead of the next
+        # instruction, unless that writes RAM, and not again until RETI. The
+        # input and output sources are the FIFO levels, and always pending
+        # without FIFOs.
+        self.controls = []
+        self.irq_active = None
+        if interrupts:
+            for index in range(Argument._NUM_CONTROLS):
+                name = Argument.lookup(Argument._FIRST_CONTROL + index).lower()
+                self.controls.append(am.Signal(word_size, name=name))
+            self.irq_active = am.Signal()
+
+    def code_banks(self, words):
+        depth = (self.ram_size + 7) // 8
+        code = list(words) + [0] * (depth * 8 - len(words))
+        return [code[index::8] for index in range(8)]
+
+    def rom_words(self, rom):
+        words = list(load_words(rom, self.word_size, self.endian))
+        if len(words) > self.ram_size:
+            raise Exception(f"ROM of {len(words)} words does not fit in {self.ram_size} words of RAM")
+        return words
+
+    # Replaces the program from a sync process of the bench, so that one
+    # elaborated design and simulator run many ROMs. rom is anything
+    # load_words takes, or a list from rom_words. rst is the reset of the
+    # sync domain of the Cpu, which puts every flag, register and counter
+    # back to its reset value. A sync process runs in the same delta cycle as
+    # the clock edge and its writes race with the design's, so every write is
+    # made once the signals have settled. The image goes in after the reset,
+    # because that also puts the RAM words the Cpu stores to back to the
+    # first image. Like a new sync process, this returns on the first edge of
+    # the new program.
+    def load_rom(self, rom, rst):
+        words = rom if isinstance(rom, list) else self.rom_words(rom)
+        yield Settle()
+        yield rst.eq(1)
+        yield
+        yield Settle()
+        yield rst.eq(0)
+        code = words + [0] * (self.ram_size - len(words))
+        for (address, word) in enumerate(code):
+            yield self.ram[address].eq(word)
+        if self.imem is not None:
+            for (bank, init) in zip(self.imem, self.code_banks(words)):
+                for (address, word) in enumerate(init):
+                    yield bank[address].eq(word)
+        self.rom_size = len(words)
+        yield
+
+    # The 7 words of the instruction at pc. With a sync domain the read port is
+    # registered, so pc must be the address of the next cycle's instruction.
+    def fetch(self, m, pc, domain="comb"):
+        if self.icache is not None:
+            for index in range(7):
+                m.d.comb += self.icache.addr[index].eq(pc + index)
+            # Ports past the end of the instruction are not read and hold any
+            # word, which must not look like an operand reading INPUT
+            return [self.icache.data[0]] + [am.Mux(self.icache.read[index], self.icache.data[index], 0)
+                                            for index in range(1, 7)]
+
+        if self.imem is None:
+            words = []
+            for index in range(7):
+                words.append(am.Signal(self.word_size, name=f"code{index}"))
+                m.d.comb += words[index].eq(self.ram[pc + index])
+            return words
+
+        # Bank b reads the word at pc + (b - pc) % 8, which is in the next row for
+        # the banks below pc % 8. The words are then rotated back into order.
+        offset = am.Signal(3, name="fetch_offset")
+        m.d[domain] += offset.eq(pc[:3])
+        banks = []
+        for (index, bank) in enumerate(self.imem):
+            if domain == "comb":
+                port = bank.read_port(domain="comb")
+            else:
+                port = bank.read_port(domain=domain, transparent=False)
+            m.submodules[f"imem{index}_read"] = port
+            m.d.comb += port.addr.eq((pc >> 3) + (pc[:3] > index))
+            banks.append(port.data)
+        # Each word goes through a signal of its own, as an Array used in the
+        # decode would be lowered by switching around every statement using it
+        banks = am.Array(banks)
+        words = []
+        for index in range(7):
+            words.append(am.Signal(self.word_size, name=f"code{index}"))
+            m.d.comb += words[index].eq(banks[(offset + index)[:3]])
+        return words
+
+    # Sequential multiplier and divider, or None where the combinational
+    # operators are used. Their operands are the first two arguments.
+    def alu_units(self, m, args):
+        (multiplier, divider) = (None, None)
+        if self.multiplier == "sequential":
+            m.submodules.multiplier = multiplier = SequentialMultiplier(self.word_size, self.alu_radix)
+            m.d.comb += multiplier.a.eq(args[0])
+            m.d.comb += multiplier.b.eq(args[1])
+        if self.divider == "sequential":
+            m.submodules.divider = divider = SequentialDivider(self.word_size, self.alu_radix)
+            m.d.comb += divider.a.eq(args[0])
+            m.d.comb += divider.b.eq(args[1])
+        return (multiplier, divider)
+
+    # Register operands with a CNT_* number read the performance counters
+    def read_counter(self, m, index, name):
+        is_counter = am.Signal(name=f"{name}_is_counter")
+        counter = am.Signal(self.word_size, name=f"{name}_counter")
+        with m.Switch(index):
+            for (offset, signal) in enumerate(self.counters):
+                with m.Case(Argument._FIRST_COUNTER + offset):
+                    m.d.comb += is_counter.eq(1)
+                    m.d.comb += counter.eq(signal)
+        return (is_counter, counter)
+
+    # Register operands with an IE to IVEC number read the interrupt controller.
+    # IP reads the input and output sources as well.
+    def read_control(self, m, index, pending, name):
+        is_control = am.Signal(name=f"{name}_is_control")
+        control = am.Signal(self.word_size, name=f"{name}_control")
+        with m.Switch(index):
+            for (offset, signal) in enumerate(self.controls):
+                with m.Case(Argument._FIRST_CONTROL + offset):
+                    m.d.comb += is_control.eq(1)
+                    m.d.comb += control.eq(pending if signal is self.control("ip") else signal)
+        return (is_control, control)
+
+    def write_register(self, m, index, value):
+        if len(self.controls) == 0:
+            m.d.sync += self.registers[index].eq(value)
+            return
+        with m.Switch(index):
+            for (offset, signal) in enumerate(self.controls):
+                with m.Case(Argument._FIRST_CONTROL + offset):
+                    # Only the timer and software sources are latched
+                    if signal is self.control("ip"):
+                        m.d.sync += signal.eq(value & (IRQ_TIMER | IRQ_SOFTWARE))
+                    else:
+                        m.d.sync += signal.eq(value)
+            with m.Default():
+                m.d.sync += self.registers[index].eq(value)
+
+    # Counter increments of the instruction, from its opcode and operand modes
+    def instruction_events(self, m, opcode, modes):
+        events = {}
+        for number in [Argument.CNT_RETIRED, Argument.CNT_MEM_READS, Argument.CNT_MEM_WRITES] + list(CLASSES.values()):
+            events[number] = am.Signal(2, name=f"event_{Argument.lookup(number).lower()}")
+        with m.Switch(opcode):
+            for op in OPS:
+                with m.Case(op):
+                    for (number, increment) in counter_events(op, modes).items():
+                        m.d.comb += events[number].eq(increment)
+            with m.Default():
+                m.d.comb += events[Argument.CNT_RETIRED].eq(1)
+        return events
+
+    def update_counters(self, m, increments):
+        for (number, increment) in increments.items():
+            counter = self.counters[number - Argument._FIRST_COUNTER]
+            m.d.sync += counter.eq(counter + increment)
+
+    # Result of a sequential unit. The instruction stalls until it is ready.
+    # While hold is set the operands are not ready yet, or the result cannot
+    # be used yet, so the unit does not start or keeps its result.
+    def wait_for(self, m, unit, value, stall, hold=None):
+        if hold is None:
+            m.d.comb += unit.start.eq(~unit.busy & ~unit.ready)
+            m.d.comb += unit.ack.eq(unit.ready)
+        else:
+            m.d.comb += unit.start.eq(~unit.busy & ~unit.ready & ~hold)
+            m.d.comb += unit.ack.eq(unit.ready & ~hold)
+        m.d.comb += stall.eq(~unit.ready)
+        return value
+
+    # Word of RAM read by an operand slot, or slot 3 for POP. With caches it
+    # comes from the data cache port of the slot, and with harvard set from
+    # the data RAM read port. Both read only when the slot is also a source
+    # of the instruction.
+    def load(self, m, slot, address, loads):
+        if self.dcache is not None:
+            m.d.comb += self.dcache.addr[slot].eq(address)
+            m.d.comb += loads[slot].eq(1)
+            return self.dcache.data[slot]
+        if self.harvard:
+            m.d.comb += self.data_addr[slot].eq(address)
+            m.d.comb += loads[slot].eq(1)
+            return self.data[slot]
+        return self.ram[address]
+
+    # Operands that are not sources do not read RAM, even in IND or RAM mode
+    def sources(self, m, operation):
+        sources = am.Signal(3)
+        with m.Switch(operation):
+            for op in OPS:
+                with m.Case(op):
+                    for slot in source_slots(op):
+                        m.d.comb += sources[slot].eq(1)
+        return sources
+
+    # Harvard data RAM. Returns the load stall: words of the instruction that
+    # are not on the read port yet. They are read lowest slot first, and kept
+    # until the instruction retires.
+    def connect_data_ram(self, m, operation, loads, store, store_address, store_data, store_enable, retire):
+        m.submodules.ram_read = ram_read = self.ram.read_port(domain="sync", transparent=False)
+        m.submodules.ram_write = ram_write = self.ram.write_port()
+        m.d.comb += ram_write.addr.eq(self.ram_address(store_address))
+        m.d.comb += ram_write.data.eq(store_data)
+        m.d.comb += ram_write.en.eq(store & store_enable)
+
+        loaded = [am.Signal(self.word_size, name=f"loaded{slot}") for slot in range(4)]
+        load_done = am.Signal(4)
+        load_pending = am.Signal()
+        load_slot = am.Signal(2)
+        load_available = am.Signal(4)
+        load_remaining = am.Signal(4)
+        m.d.comb += load_available.eq(load_done | am.Cat(*[load_pending & (load_slot == slot) for slot in range(4)]))
+        m.d.comb += load_remaining.eq(loads & am.Cat(self.sources(m, operation), 1) & ~load_available)
+        for slot in range(4):
+            m.d.comb += self.data[slot].eq(am.Mux(load_done[slot], loaded[slot], ram_read.data))
+
+        m.d.sync += load_pending.eq(0)
+        with m.If(load_pending):
+            m.d.sync += load_done.eq(load_available)
+            with m.Switch(load_slot):
+                for slot in range(4):
+                    with m.Case(slot):
+                        m.d.sync += loaded[slot].eq(ram_read.data)
+        # The last assignment wins, so the lowest slot goes first
+        for slot in reversed(range(4)):
+            with m.If(load_remaining[slot]):
+                m.d.comb += ram_read.addr.eq(self.ram_address(self.data_addr[slot]))
+                m.d.sync += [load_pending.eq(1), load_slot.eq(slot)]
+        with m.If(retire):
+            m.d.sync += [load_done.eq(0), load_pending.eq(0)]
+
+        load_stall = am.Signal()
+        m.d.comb += load_stall.eq(load_remaining.any())
+        return load_stall
+
+    # Bus, backing memory and caches. Returns the memory stall: a cache miss,
+    # or a store that RAM has not acknowledged yet.
+    def connect_memory(self, m, operation, loads, store, store_address, store_data, stall, retire):
+        icache = self.icache
+        dcache = self.dcache
+        m.submodules.icache = icache
+        m.submodules.dcache = dcache
+        m.submodules.memory = memory = BackingMemory(self.ram, self.addr_bus_width, self.memory_latency)
+        m.submodules.arbiter = arbiter = Arbiter([icache.bus, dcache.bus, self.store_bus], self.word_size,
+                                                 self.addr_bus_width)
+        for name in ["adr", "dat_w", "we", "cyc", "stb"]:
+            m.d.comb += getattr(memory.bus, name).eq(getattr(arbiter.bus, name))
+        m.d.comb += arbiter.bus.dat_r.eq(memory.bus.dat_r)
+        m.d.comb += arbiter.bus.ack.eq(memory.bus.ack)
+
+        # Fetch only the words of the instruction
+        size = am.Signal(range(8))
+        m.d.comb += size.eq(1)
+        with m.Switch(operation):
+            for (opcode, length) in SIZES.items():
+                with m.Case(opcode):
+                    m.d.comb += size.eq(length)
+        for index in range(7):
+            m.d.comb += icache.read[index].eq(size > index)
+
+        m.d.comb += dcache.read.eq(am.Mux(icache.miss, 0, loads & am.Cat(self.sources(m, operation), 1)))
+
+        store_stall = am.Signal()
+        m.d.comb += self.store_bus.adr.eq(store_address)
+        m.d.comb += self.store_bus.dat_w.eq(store_data)
+        m.d.comb += self.store_bus.we.eq(1)
+        m.d.comb += self.store_bus.cyc.eq(store & ~stall & ~icache.miss & ~dcache.miss)
+        m.d.comb += self.store_bus.stb.eq(self.store_bus.cyc)
+        m.d.comb += store_stall.eq(self.store_bus.cyc & ~self.store_bus.ack)
+
+        for cache in [icache, dcache]:
+            m.d.comb += cache.release.eq(retire)
+            m.d.comb += cache.update.eq(retire & store)
+            m.d.comb += cache.update_addr.eq(store_address)
+            m.d.comb += cache.update_data.eq(store_data)
+
+        memory_stall = am.Signal()
+        m.d.comb += memory_stall.eq(icache.miss | dcache.miss | store_stall)
+        return memory_stall
+
     def elaborate(self, platform: Platform):
         m = am.Module()
 
@@ -170,34 +517,83 @@ class Cpu(am.Elaboratable):
         m.d.sync += self.irf.eq(0)
         m.d.sync += self.owf.eq(0)
 
+        code = self.fetch(m, self.pc())
+
         operation = am.Signal(self.word_size)
-        m.d.comb += operation.eq(self.ram[self.pc()])
+        m.d.comb += operation.eq(code[0])
 
         result = am.Signal(self.word_size)
         result_location = am.Signal(2)
         m.d.comb += result_location.eq(3)
         do_flags = am.Signal(4)
 
+        # Interrupt sources, in IRQ_* order
+        pending = am.Signal(4)
+        if len(self.controls) > 0:
+            if self.input_fifo is not None:
+                ready = [self.input_fifo.r_rdy, self.output_fifo.w_rdy]
+            else:
+                ready = [1, 1]
+            ip = self.control("ip")
+            m.d.comb += pending.eq(am.Cat(*ready, ip[IRQ_TIMERI], ip[IRQ_SOFTWAREI]))
+
         # Read arguments
         args = []
+        loads = am.Signal(4)
+        reads_input = am.Signal()
         for index in range(3):
             args.append(am.Signal(self.word_size))
-            with m.Switch(self.ram[self.pc() + index * 2 + 1]):
+            # Read in a statement of its own, because the RTLIL backend lowers a
+            # memory indexed by another memory word by switching on the inner
+            # index around the whole statement, which also replaces it in the
+            # IMM case with the last register number
+            register = am.Signal(self.word_size, name=f"arg{index}_register")
+            m.d.comb += register.eq(self.registers[code[index * 2 + 2]])
+            with m.Switch(code[index * 2 + 1]):
                 with m.Case(Argument.REG):
-                    m.d.comb += args[index].eq(self.registers[self.ram[self.pc() + index * 2 + 2]])
-                    with m.If(self.ram[self.pc() + index * 2 + 2] == Argument.INPUT):
+                    (is_counter, counter) = self.read_counter(m, code[index * 2 + 2], f"arg{index}")
+                    (is_control, control) = self.read_control(m, code[index * 2 + 2], pending, f"arg{index}")
+                    with m.If(is_counter):
+                        m.d.comb += args[index].eq(counter)
+                    with m.Elif(is_control):
+                        m.d.comb += args[index].eq(control)
+                    with m.Else():
+                        m.d.comb += args[index].eq(register)
+                    with m.If(code[index * 2 + 2] == Argument.INPUT):
                         m.d.sync += self.irf.eq(1)
+                        m.d.comb += reads_input.eq(1)
+                        if self.input_fifo is not None:
+                            m.d.comb += args[index].eq(self.input_fifo.r_data)
                 with m.Case(Argument.IMM):
-                    m.d.comb += args[index].eq(self.ram[self.pc() + index * 2 + 2])
+                    m.d.comb += args[index].eq(code[index * 2 + 2])
                 with m.Case(Argument.IND):
-                    m.d.comb += args[index].eq(self.ram[self.registers[self.ram[self.pc() + index * 2 + 2]]])
+                    m.d.comb += args[index].eq(self.load(m, index, register, loads))
                 with m.Case(Argument.RAM):
-                    m.d.comb += args[index].eq(self.ram[self.ram[self.pc() + index * 2 + 2]])
+                    m.d.comb += args[index].eq(self.load(m, index, code[index * 2 + 2], loads))
                 with m.Default():
                     # m.d.sync += self.iocf.eq(True)
                     # m.d.sync += self.hf.eq(True)
                     pass
 
+        (multiplier, divider) = self.alu_units(m, args)
+        stall = am.Signal()
+        memory_stall = am.Signal()
+        io_stall = am.Signal()
+        stalled = am.Signal()
+        m.d.comb += stalled.eq(stall | memory_stall | io_stall)
+        hold = am.Signal()  # Sequential units wait for the operands, and keep the result until it can be used
+        m.d.comb += hold.eq(memory_stall | io_stall)
+        taken = am.Signal()
+        store = am.Signal()
+        store_address = am.Signal(self.word_size)
+        store_data = am.Signal(self.word_size)
+        writes_output = am.Signal()
+        wake = am.Signal()  # An enabled interrupt is pending
+        sleeping = am.Signal()
+        enter = am.Signal()  # Take the interrupt instead of the instruction
+        cancel = am.Signal()
+        m.d.comb += cancel.eq(stalled | enter)
+
         # Parse operation
         with m.Switch(operation):
             with m.Case(Operation.HALT):
@@ -249,29 +645,34 @@ class Cpu(am.Elaboratable):
                 m.d.comb += do_flags.eq(CF | OF | SF | ZF)
 
             with m.Case(Operation.MULL):
-                m.d.comb += result.eq(args[0] * args[1])
+                m.d.comb += result.eq(self.wait_for(m, multiplier, multiplier.low, stall, hold)
+                                      if multiplier else args[0] * args[1])
                 m.d.comb += result_location.eq(2)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_3)
                 m.d.comb += do_flags.eq(SF | ZF)
             with m.Case(Operation.MULH):
-                m.d.comb += result.eq((args[0] * args[1]) >> self.word_size)
+                m.d.comb += result.eq(self.wait_for(m, multiplier, multiplier.high, stall, hold)
+                                      if multiplier else (args[0] * args[1]) >> self.word_size)
                 m.d.comb += result_location.eq(2)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_3)
                 m.d.comb += do_flags.eq(SF | ZF)
 
             with m.Case(Operation.DIV):
-                m.d.comb += result.eq(args[0] // args[1])
+                m.d.comb += result.eq(self.wait_for(m, divider, divider.quotient, stall, hold)
+                                      if divider else args[0] // args[1])
                 m.d.comb += result_location.eq(2)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_3)
                 m.d.comb += do_flags.eq(SF | ZF)
             with m.Case(Operation.MOD):
-                m.d.comb += result.eq(args[0] % args[1])
+                m.d.comb += result.eq(self.wait_for(m, divider, divider.remainder, stall, hold)
+                                      if divider else args[0] % args[1])
                 m.d.comb += result_location.eq(2)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_3)
                 m.d.comb += do_flags.eq(SF | ZF)
 
             with m.Case(Operation.CMP):
-                m.d.comb += result.eq(args[0] % args[1])
+                m.d.comb += result.eq(self.wait_for(m, divider, divider.remainder, stall, hold)
+                                      if divider else args[0] % args[1])
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_2)
                 m.d.comb += do_flags.eq(CF | OF | SF | ZF)
 
@@ -314,7 +715,7 @@ class Cpu(am.Elaboratable):
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_3)
                 m.d.comb += do_flags.eq(SF | ZF)
             with m.Case(Operation.SHL):
-                m.d.comb += result.eq(args[0] << args[1])
+                m.d.comb += result.eq(shift_left(args[0], args[1], self.word_size))
                 m.d.comb += result_location.eq(2)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_3)
                 m.d.comb += do_flags.eq(SF | ZF)
@@ -328,52 +729,61 @@ class Cpu(am.Elaboratable):
             with m.Case(Operation.JUMP):
                 m.d.comb += result.eq(args[0])
                 m.d.sync += self.pc().eq(result)
+                m.d.comb += taken.eq(1)
             with m.Case(Operation.JC):
                 m.d.comb += result.eq(args[0])
                 with m.If(self.c()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JNC):
                 m.d.comb += result.eq(args[0])
                 with m.If(~self.c()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JO):
                 m.d.comb += result.eq(args[0])
                 with m.If(self.o()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JNO):
                 m.d.comb += result.eq(args[0])
                 with m.If(~self.o()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JS):
                 m.d.comb += result.eq(args[0])
                 with m.If(self.s()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JNS):
                 m.d.comb += result.eq(args[0])
                 with m.If(~self.s()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JZ):
                 m.d.comb += result.eq(args[0])
                 with m.If(self.z()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.JNZ):
                 m.d.comb += result.eq(args[0])
                 with m.If(~self.z()):
                     m.d.sync += self.pc().eq(result)
+                    m.d.comb += taken.eq(1)
                 with m.Else():
                     m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
 
@@ -386,37 +796,106 @@ class Cpu(am.Elaboratable):
                 m.d.sync += self.pc().eq(result)
 
             with m.Case(Operation.PUSH):
-                m.d.sync += self.ram[self.sp()].eq(args[0])
+                m.d.comb += store.eq(1)
+                m.d.comb += store_address.eq(self.sp())
+                m.d.comb += store_data.eq(args[0])
                 m.d.sync += self.sp().eq(self.sp() - 1)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
             with m.Case(Operation.POP):
                 m.d.sync += self.sp().eq(self.sp() + 1)
-                m.d.comb += result.eq(self.ram[self.sp()] + 1)
+                m.d.comb += result.eq(self.load(m, 3, self.sp(), loads) + 1)
                 m.d.comb += result_location.eq(0)
                 m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_1)
 
+            if len(self.controls) > 0:
+                with m.Case(Operation.WAIT):
+                    with m.If(wake):
+                        m.d.sync += self.pc().eq(self.pc() + NUM_ARGS_0)
+                    with m.Else():
+                        m.d.comb += sleeping.eq(1)
+                with m.Case(Operation.RETI):
+                    m.d.comb += result.eq(self.control("epc"))
+                    m.d.sync += self.pc().eq(result)
+                    m.d.sync += self.status().eq(self.control("estatus"))
+                    m.d.sync += self.irq_active.eq(0)
+
             with m.Default():
                 m.d.sync += self.iocf.eq(True)
                 m.d.sync += self.hf.eq(True)
                 pass
 
-        # Write result
+        # Write result. RAM is written through store, which the cached memory
+        # starts before the instruction can complete.
         for index in range(3):
             with m.If(result_location == index):
-                with m.Switch(self.ram[self.pc() + index * 2 + 1]):
+                with m.Switch(code[index * 2 + 1]):
                     with m.Case(Argument.REG):
-                        m.d.sync += self.registers[self.ram[self.pc() + index * 2 + 2]].eq(result)
-                        with m.If(self.ram[self.pc() + index * 2 + 2] == Argument.OUTPUT):
-                            m.d.sync += self.owf.eq(1)
+                        with m.If(~cancel):
+                            self.write_register(m, code[index * 2 + 2], result)
+                        with m.If(code[index * 2 + 2] == Argument.OUTPUT):
+                            m.d.comb += writes_output.eq(1)
                     with m.Case(Argument.IND):
-                        m.d.sync += self.ram[self.registers[self.ram[self.pc() + index * 2 + 2]]].eq(result)
+                        m.d.comb += store.eq(1)
+                        m.d.comb += store_address.eq(self.registers[code[index * 2 + 2]])
+                        m.d.comb += store_data.eq(result)
                     with m.Case(Argument.RAM):
-                        m.d.sync += self.ram[self.ram[self.pc() + index * 2 + 2]].eq(result)
+                        m.d.comb += store.eq(1)
+                        m.d.comb += store_address.eq(code[index * 2 + 2])
+                        m.d.comb += store_data.eq(result)
                     with m.Default():
                         m.d.sync += self.iocf.eq(True)
                         m.d.sync += self.hf.eq(True)
                         pass
 
+        if len(self.controls) > 0:
+            m.d.comb += wake.eq((pending & self.control("ie")[:4]) != 0)
+            m.d.comb += enter.eq(wake & ~self.irq_active & ~self.hf & ~stalled & ~store)
+            with m.If(self.tick() == self.control("timer")):
+                m.d.sync += self.control("ip")[IRQ_TIMERI].eq(1)
+
+        retire = ~self.hf & ~cancel & ~sleeping
+        with m.If(writes_output & ~cancel):
+            m.d.sync += self.owf.eq(1)
+        if self.harvard:
+            m.d.comb += memory_stall.eq(self.connect_data_ram(m, operation, loads, store, store_address, store_data,
+                                                              ~stalled, retire | enter))
+        elif self.dcache is None:
+            with m.If(store & ~stalled):
+                m.d.sync += self.ram[store_address].eq(store_data)
+        else:
+            m.d.comb += memory_stall.eq(self.connect_memory(m, operation, loads, store, store_address, store_data,
+                                                            stall | io_stall, retire | enter))
+        if self.input_fifo is not None:
+            m.submodules.input_fifo = self.input_fifo
+            m.submodules.output_fifo = self.output_fifo
+            m.d.comb += io_stall.eq(reads_input & ~self.input_fifo.r_rdy | writes_output & ~self.output_fifo.w_rdy)
+            m.d.comb += self.input_fifo.r_en.eq(retire & reads_input)
+            m.d.comb += self.output_fifo.w_en.eq(retire & writes_output)
+            m.d.comb += self.output_fifo.w_data.eq(result)
+
+        # A stalled instruction runs again next cycle, so it must not have any
+        # effect yet, and neither must one replaced by an interrupt. Later
+        # assignments take priority over the ones above.
+        with m.If(cancel):
+            m.d.comb += do_flags.eq(0)
+            m.d.sync += self.pc().eq(self.pc())
+            m.d.sync += self.link().eq(self.link())
+            m.d.sync += self.sp().eq(self.sp())
+            m.d.sync += self.irf.eq(0)
+            m.d.sync += self.hf.eq(0)
+            m.d.sync += self.iocf.eq(self.iocf)
+            if len(self.controls) > 0:
+                m.d.sync += self.status().eq(self.status())
+                m.d.sync += self.irq_active.eq(self.irq_active)
+
+        # A WAIT is done once the interrupt arrives, so RETI returns past it
+        if len(self.controls) > 0:
+            with m.If(enter):
+                m.d.sync += self.pc().eq(self.control("ivec"))
+                m.d.sync += self.control("epc").eq(self.pc() + (operation == Operation.WAIT))
+                m.d.sync += self.control("estatus").eq(self.status())
+                m.d.sync += self.irq_active.eq(1)
+
         # Set flags
         with m.If(do_flags[CFI] == 1):
             pass
@@ -442,163 +921,431 @@ class Cpu(am.Elaboratable):
                 m.d.sync += self.z().eq(0)
 
         m.d.sync += self.tick().eq(self.tick() + 1)
+
+        # Performance counters
+        events = self.instruction_events(m, operation, code[1::2])
+        increments = {number: am.Mux(retire, event, 0) for (number, event) in events.items()}
+        increments[Argument.CNT_HALTED] = self.hf
+        increments[Argument.CNT_TAKEN] = retire & taken
+        increments[Argument.CNT_NOT_TAKEN] = retire & (events[Argument.CNT_JUMP] != 0) & ~taken
+        if len(self.controls) > 0:
+            increments[Argument.CNT_WAIT] = ~self.hf & ~stalled & sleeping
+        if self.input_fifo is None:
+            increments[Argument.CNT_INPUT_STALLS] = retire & self.irf & reads_input
+        else:
+            # Cycles spent waiting for the input FIFO
+            increments[Argument.CNT_INPUT_STALLS] = ~self.hf & reads_input & ~self.input_fifo.r_rdy
+        self.update_counters(m, increments)
         return m
 
 
-def test(interactive):
-    dut = Cpu()
+# Memories that Cpu indexes instead of reading through ports are never
+# elaborated themselves, so Amaranth warns with UnusedElaboratable once they
+# are freed. Silences that for a Cpu a tool builds to simulate or convert.
+def quiet_memories(dut):
+    for memory in [dut.registers, dut.ram]:
+        memory._MustUse__silence = True
+    return dut
+
+
+# Print flags, registers and the next operation on one line
+def print_state(dut, source_map=None, snapshot=None):
+    if snapshot is None:
+        snapshot = yield from take_snapshot(dut)
+    print(f"{C.BWHITE}h: {snapshot.flags['hf']} ", end="")
+    print(f"{C.BYELLOW}c: {snapshot.registers[Argument.STATUS] >> CFI & 1} ", end="")
+    print(f"{C.BYELLOW}o: {snapshot.registers[Argument.STATUS] >> OFI & 1} ", end="")
+    print(f"{C.BBLUE}s: {snapshot.registers[Argument.STATUS] >> SFI & 1} ", end="")
+    print(f"{C.BBLUE}z: {snapshot.registers[Argument.STATUS] >> ZFI & 1} ", end="")
+    print(f"{C.BWHITE}ioc: {snapshot.flags['iocf']} ", end="")
+    print(f"{C.BWHITE}ir: {snapshot.flags['irf']} ", end="")
+    print(f"{C.BWHITE}ow: {snapshot.flags['owf']}   ", end="")
+
+    # Print registers
+    digits = dut.word_size // 4
+    acolor = False
+    color = C.BWHITE if acolor else C.BYELLOW
+    for index in range(Argument._NUM_REGS):
+        if index != 0 and index % 4 == 0:
+            print(" ", end="")
+        if index % 2 == 0:
+            acolor = not acolor
+            color = C.BWHITE if acolor else C.BYELLOW
+        print(f"{color}{Argument.lookup(index).lower()}: {snapshot.registers[index]:0{digits}X}{C.RESET} ", end="")
+    for (signal, value) in zip(dut.controls, snapshot.controls):
+        print(f"{C.BCYAN}{signal.name}: {value:0{digits}X}{C.RESET} ", end="")
+    if dut.irq_active is not None:
+        print(f"{C.BCYAN}active: {yield dut.irq_active}{C.RESET} ", end="")
+
+    # Print next operation, addresses past the end read the last word like the RAM
+    pc = snapshot.registers[Argument.PC]
+    op = [snapshot.ram[min(pc + index, dut.ram_size - 1)] for index in range(NUM_ARGS_3)]
+    opstring = Operation.decode(op)
+    if source_map is not None:
+        opstring += f"  ; {source_map.format(pc)}"
+    print(f"  next_op: {opstring}")
+
+
+def print_ram(dut, snapshot=None):
+    if snapshot is None:
+        snapshot = yield from take_snapshot(dut)
+    digits = dut.word_size // 4
+    header = "".join((" " if index == 8 else "") + f"{index:>{digits + 1}X}" for index in range(16))
+    print(f"RAM dump:\n    {header}\n{0:03X}: ", end="")
+    acolor = False
+    color = C.BWHITE if acolor else C.BYELLOW
+    for (index, word) in enumerate(snapshot.ram):
+        if index % 2 == 0:
+            acolor = not acolor
+            color = C.BWHITE if acolor else C.BYELLOW
+        if index != 0 and index % 16 == 0:
+            print(f"\n{index:03X}: ", end="")
+        elif index != 0 and index % 8 == 0:
+            print(" ", end="")
+        print(f"{color}{word:0{digits}X}{C.RESET} ", end="")
+    print()
+
+
+# IPC and instruction mix from the performance counters
+def print_counters(dut, cycles, snapshot=None):
+    if snapshot is None:
+        snapshot = yield from take_snapshot(dut)
+    counters = {}
+    for (index, value) in enumerate(snapshot.counters):
+        counters[Argument.lookup(Argument._FIRST_COUNTER + index).lower()] = value
+    retired = counters["cnt_retired"]
+    print(f"Retired {retired} instructions in {cycles} cycles, IPC {retired / cycles if cycles > 0 else 0:.3f}")
+    for (name, value) in list(counters.items())[1:]:
+        share = f" ({100 * value / retired:.1f}%)" if retired > 0 else ""
+        print(f"  {name[len('cnt_'):]:14} {value:6}{share}")
+    for cache in [dut.icache, dut.dcache]:
+        if cache is not None:
+            hits = yield cache.hits
+            misses = yield cache.misses
+            rate = f", {100 * hits / (hits + misses):.1f}% hits" if hits + misses > 0 else ""
+            print(f"{cache.hits.name[:-len('_hits')]}: {hits} hits, {misses} misses{rate}")
+
+
+# Final state of a run, as the regression suite reports it: the outputs, the
+# cycles run, hf and iocf, and the performance and cache counters
+def read_result(dut, outputs, cycles):
+    result = {"outputs": outputs, "cycles": cycles, "halted": bool((yield dut.hf)),
+              "iocf": bool((yield dut.iocf)), "counters": {}}
+    for (index, counter) in enumerate(dut.counters):
+        result["counters"][Argument.lookup(Argument._FIRST_COUNTER + index).lower()] = yield counter
+    for cache in [dut.icache, dut.dcache]:
+        if cache is not None:
+            result["counters"][cache.hits.name] = yield cache.hits
+            result["counters"][cache.misses.name] = yield cache.misses
+    return result
+
+
+# Runs a program from a bench until hf or max_cycles, and returns read_result.
+# Inputs and outputs use the irf/owf protocol, or go through driver, a
+# StreamDriver made with on_output appending to outputs, with I/O FIFOs.
+def collect_result(dut, inputs, max_cycles, outputs=None, driver=None):
+    outputs = [] if outputs is None else outputs
+    cycles = 0
+    while not (yield dut.hf) and cycles < max_cycles:
+        if driver is None:
+            if (yield dut.irf):
+                yield dut.input().eq(next(inputs, 0))
+            if (yield dut.owf):
+                outputs.append((yield dut.output()))
+        yield
+        cycles += 1
+    if driver is not None:
+        yield from driver.flush()
+    return (yield from read_result(dut, outputs, cycles))
+
+
+# Outside of the interactive prompt only hf, irf and owf are sampled every
+# cycle, and after c or o whatever the Debugger stops read. The full state is
+# printed every print_every cycles and at halt. Tracing is opt-in: either a
+# VcdTrace of selected signals or a RetireTrace, or vcd_file for a dump of
+# every signal of the design. With I/O FIFOs a StreamDriver moves the inputs and outputs instead,
+# and input_stream replaces the built-in test vectors.
+def test(interactive, rom_file="build/rom_file", source_map=None, print_every=None, print_at_halt=True,
+         trace=None, vcd_file=None, cpu_class=Cpu, input_stream=None, block_size=64, cxxrtl=False, snapshot_file=None,
+         **options):
+    model = None
+    if cxxrtl:
+        # Imported here, because it builds on Cpu
+        from cxxrtl_sim import CxxrtlCpu
+        model = CxxrtlCpu(rom_file, **options)
+        dut = model.dut
+    else:
+        dut = cpu_class(rom_file, **options)
+    if trace is not None:
+        trace.attach(dut)
+
+    def finish_trace(cycles):
+        if trace is not None:
+            written = yield from trace.finish(cycles)
+            print(f"Traced {written} {trace.units} to {trace.path}")
+
+    debugger = Debugger(dut, source_map)
 
     def bench():
-        # inputs = [
-        #     0xB4, 0xF6,
-        #     0xAF, 0x70,
-        #     0x5C, 0xC7,
-        #     0xCA, 0x15,
-        #     0x1A, 0x2A,
-        #     0x14, 0x29,
-        #     0xED, 0xE0,
-        #     0x47, 0x66,
-        #     0xB7, 0x7C,
-        #     0xC5, 0xDD,
-        #     0xE1, 0xEA,
-        # ]
-
-        # outputs = [
-        #     190,
-        #     63,
-        #     149,
-        #     181,
-        #     240,
-        #     235,
-        #     13,
-        #     225,
-        #     59,
-        #     232,
-        #     247,
-        # ]
-
-        inputs = [4, 6, 1, 4, 6, 5, 1, 4, 1, 2, 6, 5, 6, 1, 4, 2, ]
-        outputs = [5 + 2 + 1 + 5 + 2 + 5 + 4 + 1 + 3, ]
-
         debug = interactive
+        running = False
+        steps = 0
+        cycles = 0
+        last_snapshot = None
 
         while not (yield dut.hf) or debug:
 
-            # Send inputs
-            if (yield dut.irf):
-                next = inputs.pop(0) if len(inputs) > 0 else 0
-                yield dut.input().eq(next)
-
-            # Receive outputs
-            if (yield dut.owf):
-                if len(outputs) > 0:
-                    print(f"Read output: {yield dut.output():02X}")
-                    assert (yield dut.output() == outputs.pop(0))
-                else:
-                    print(f"Unexpected output: {yield dut.output():02X}")
-
-            # Print flags
-            print(f"{C.BWHITE}h: {yield dut.hf} ", end="")
-            print(f"{C.BYELLOW}c: {yield dut.c()} ", end="")
-            print(f"{C.BYELLOW}o: {yield dut.o()} ", end="")
-            print(f"{C.BBLUE}s: {yield dut.s()} ", end="")
-            print(f"{C.BBLUE}z: {yield dut.z()} ", end="")
-            print(f"{C.BWHITE}ioc: {yield dut.iocf} ", end="")
-            print(f"{C.BWHITE}ir: {yield dut.irf} ", end="")
-            print(f"{C.BWHITE}ow: {yield dut.owf}   ", end="")
-
-            # Print registers
-            acolor = False
-            color = C.BWHITE if acolor else C.BYELLOW
-            for index in range(Argument._NUM_REGS):
-                if index != 0 and index % 4 == 0:
-                    print(" ", end="")
-                if index % 2 == 0:
-                    acolor = not acolor
-                    color = C.BWHITE if acolor else C.BYELLOW
-                print(f"{color}{Argument.lookup(index).lower()}: {yield dut.registers[index]:02X}{C.RESET} ", end="")
-
-            # Print next operation
-            op = bytearray(7)
-            op[0] = yield dut.ram[dut.pc() + 0]
-            op[1] = yield dut.ram[dut.pc() + 1]
-            op[2] = yield dut.ram[dut.pc() + 2]
-            op[3] = yield dut.ram[dut.pc() + 3]
-            op[4] = yield dut.ram[dut.pc() + 4]
-            op[5] = yield dut.ram[dut.pc() + 5]
-            op[6] = yield dut.ram[dut.pc() + 6]
-            opstring = Operation.decode(op)
-            print(f"  next_op: {opstring}")
-
-            if debug:
+            if driver is None:
+                # Send inputs
+                if (yield dut.irf):
+                    next = inputs.pop(0) if len(inputs) > 0 else 0
+                    yield dut.input().eq(next)
+
+                # Receive outputs
+                if (yield dut.owf):
+                    receive((yield dut.output()))
+
+            if trace is not None:
+                yield from trace.sample(cycles)
+
+            if running:
+                reason = yield from debugger.check()
+                if reason is not None:
+                    print(f"Stopped after {cycles} cycles, {reason}")
+                    (debug, running) = (True, False)
+
+            prompt = debug and steps == 0
+            if prompt or (print_every is not None and cycles % print_every == 0):
+                snapshot = yield from take_snapshot(dut, cycles)
+                yield from print_state(dut, source_map, snapshot)
+                if prompt and last_snapshot is not None:
+                    changes = snapshot.format_diff(last_snapshot, ram_only=True)
+                    if changes:
+                        print(f"RAM changes: {changes}")
+                if prompt:
+                    last_snapshot = snapshot
+
+            halted = prompt and snapshot.flags["hf"]
+            while debug and steps == 0:
                 try:
                     cmd = input("> ")
                 except EOFError:
                     print()
+                    yield from finish_trace(cycles)
                     return
+                words = cmd.split()
 
-                if cmd == "dump":
-                    print(f"RAM dump:\n      0  1  2  3  4  5  6  7   8  9  A  B  C  D  E  F\n{0:03X}: ", end="")
-                    acolor = False
-                    color = C.BWHITE if acolor else C.BYELLOW
-                    for index in range(dut.ram_size):
-                        if index % 2 == 0:
-                            acolor = not acolor
-                            color = C.BWHITE if acolor else C.BYELLOW
-                        if index != 0 and index % 16 == 0:
-                            print(f"\n{index:03X}: ", end="")
-                        elif index != 0 and index % 8 == 0:
-                            print(" ", end="")
-                        print(f"{color}{yield dut.ram[index]:02X}{C.RESET} ", end="")
-                    print()
+                if debugger.command(cmd):
+                    pass
+
+                elif cmd == "dump":
+                    yield from print_ram(dut, snapshot)
+
+                elif len(words) == 2 and words[0] == "dump":
+                    snapshot.save(words[1])
+                    print(f"Saved the state to {words[1]}")
 
                 elif cmd == "q":
+                    yield from finish_trace(cycles)
                     return
 
                 elif cmd == "r":
                     debug = False
-                    if not (yield dut.hf):
-                        yield
-                        if (yield dut.hf):
-                            print("Program halted")
+
+                elif cmd in ["c", "o"]:
+                    yield from debugger.resume(until_output=cmd == "o")
+                    (debug, running) = (False, True)
+
+                elif len(words) == 0 or words == ["s"] or (len(words) == 2 and words[0] == "s" and words[1].isdigit()):
+                    if halted:
+                        print("Program halted")
+                    else:
+                        steps = int(words[1]) if len(words) == 2 else 1
 
                 else:
-                    if not (yield dut.hf):
-                        yield
-                        if (yield dut.hf):
-                            print("Program halted")
+                    print(f"Unknown command: {cmd}, h for help")
+            if halted:
+                break
 
-            else:
-                if not (yield dut.hf):
-                    yield
-
-        print("Program halted")
-
-        # Print RAM contents
-        print(f"RAM dump:\n      0  1  2  3  4  5  6  7   8  9  A  B  C  D  E  F\n{0:03X}: ", end="")
-        acolor = False
-        color = C.BWHITE if acolor else C.BYELLOW
-        for index in range(dut.ram_size):
-            if index % 2 == 0:
-                acolor = not acolor
-                color = C.BWHITE if acolor else C.BYELLOW
-            if index != 0 and index % 16 == 0:
-                print(f"\n{index:03X}: ", end="")
-            elif index != 0 and index % 8 == 0:
-                print(" ", end="")
-            print(f"{color}{yield dut.ram[index]:02X}{C.RESET} ", end="")
-        print()
-
-        assert len(inputs) == 0 and len(outputs) == 0
+            # Outside of the prompt, hf was sampled by the loop condition
+            yield
+            cycles += 1
+            if debug:
+                steps -= 1
+                if (yield dut.hf):
+                    print("Program halted")
+                    steps = 0
+
+        print(f"Program halted after {cycles} cycles")
+        yield from finish_trace(cycles)
+
+        if print_at_halt or snapshot_file is not None:
+            snapshot = yield from take_snapshot(dut, cycles)
+        if print_at_halt:
+            yield from print_state(dut, source_map, snapshot)
+            yield from print_ram(dut, snapshot)
+            yield from print_counters(dut, cycles, snapshot)
+        if snapshot_file is not None:
+            snapshot.save(snapshot_file)
+            print(f"Saved the state to {snapshot_file}")
+
+        if driver is not None:
+            yield from driver.flush()
+            unread = yield from driver.unread()
+            assert unread == 0 and len(outputs) == 0
+        else:
+            assert len(inputs) == 0 and len(outputs) == 0
+
+    # inputs = [
+    #     0xB4, 0xF6,
+    #     0xAF, 0x70,
+    #     0x5C, 0xC7,
+    #     0xCA, 0x15,
+    #     0x1A, 0x2A,
+    #     0x14, 0x29,
+    #     0xED, 0xE0,
+    #     0x47, 0x66,
+    #     0xB7, 0x7C,
+    #     0xC5, 0xDD,
+    #     0xE1, 0xEA,
+    # ]
+
+    # outputs = [
+    #     190,
+    #     63,
+    #     149,
+    #     181,
+    #     240,
+    #     235,
+    #     13,
+    #     225,
+    #     59,
+    #     232,
+    #     247,
+    # ]
+
+    inputs = [4, 6, 1, 4, 6, 5, 1, 4, 1, 2, 6, 5, 6, 1, 4, 2, ]
+    outputs = [5 + 2 + 1 + 5 + 2 + 5 + 4 + 1 + 3, ]
+    if input_stream is not None:
+        inputs = input_stream if dut.input_fifo is not None else list(input_stream)
+        outputs = []
+
+    def receive(value):
+        if len(outputs) > 0:
+            print(f"Read output: {value:0{dut.word_size // 4}X}")
+            assert value == outputs.pop(0)
+        else:
+            print(f"Unexpected output: {value:0{dut.word_size // 4}X}")
+
+    if model is not None:
+        # The compiled model runs to halt without the prompt or traces
+        cycles = model.run(inputs, receive)
+        print(f"Program halted after {cycles} cycles")
+        snapshot = model.drive(take_snapshot(dut, cycles))
+        if print_at_halt:
+            model.drive(print_state(dut, source_map, snapshot))
+            model.drive(print_ram(dut, snapshot))
+            model.drive(print_counters(dut, cycles, snapshot))
+        if snapshot_file is not None:
+            snapshot.save(snapshot_file)
+            print(f"Saved the state to {snapshot_file}")
+        assert model.consumed == len(inputs) and len(outputs) == 0
+        print("All tests passed")
+        return
 
     sim = Simulator(dut)
     sim.add_clock(1e-6)  # 1 MHz
     sim.add_sync_process(bench)
-    with sim.write_vcd("cpu.vcd"):
+    driver = None
+    if dut.input_fifo is not None:
+        driver = StreamDriver(dut, inputs, block_size, receive)
+        driver.add_to(sim)
+    if vcd_file is not None:
+        with sim.write_vcd(vcd_file):
+            sim.run()
+    else:
         sim.run()
-        print("All tests passed")
+    print("All tests passed")
 
 
 if __name__ == "__main__":
+    from pipelined_cpu import PipelinedCpu
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("-m", "--map", nargs=1, default=None, help="source map written by assemble_rom.py")
+    ap.add_argument("-p", "--pipelined", action="store_true", help="simulate PipelinedCpu instead of Cpu")
+    ap.add_argument("--harvard", action="store_true", help="fetch instructions from a separate read-only memory")
+    ap.add_argument("-w", "--word-size", type=int, default=8, choices=[8, 16, 32])
+    ap.add_argument("--endian", default="little", choices=ENDIANS, help="byte order of the words in the ROM")
+    ap.add_argument("--multiplier", default="comb", choices=ALU_UNITS, help="sequential stalls until done")
+    ap.add_argument("--divider", default="comb", choices=ALU_UNITS, help="sequential stalls until done")
+    ap.add_argument("--alu-radix", type=int, default=2, help="radix of the sequential multiplier and divider")
+    ap.add_argument("--cache-lines", type=int, default=0, help="put caches of this many lines in front of RAM")
+    ap.add_argument("--line-size", type=int, default=4, help="words in a cache line")
+    ap.add_argument("--memory-latency", type=int, default=2, help="wait states of every RAM access behind the caches")
+    ap.add_argument("--fifo-depth", type=int, default=0, help="stream INPUT and OUTPUT through FIFOs this deep")
+    ap.add_argument("--input-file", default=None, help="inputs to stream, numbers or raw words in a .bin file")
+    ap.add_argument("--block-size", type=int, default=64, help="inputs read from the stream at a time")
+    ap.add_argument("--interrupts", action="store_true", help="add the interrupt controller, WAIT and RETI")
+    ap.add_argument("-a", "--addr-bus-width", type=int, default=8)
+    ap.add_argument("-r", "--ram-size", type=int, default=256)
+    ap.add_argument("-b", "--batch", action="store_true", help="run to halt without the interactive prompt")
+    ap.add_argument("--cxxrtl", action="store_true", help="run a model compiled with Yosys CXXRTL, implies --batch")
+    ap.add_argument("-n", "--print-every", type=int, default=None, help="print the full state every N cycles")
+    ap.add_argument("--no-dump", action="store_true", help="do not print the state and RAM at halt")
+    ap.add_argument("--snapshot", default=None, help="save the state at halt to this JSON file")
+    ap.add_argument("--vcd", nargs=1, default=None, help="trace the selected signals to this file")
+    ap.add_argument("--vcd-all", nargs=1, default=None, help="dump every signal of the design to this file")
+    ap.add_argument("--signals", default=",".join(DEFAULT_SIGNALS), help="comma separated signals to trace")
+    ap.add_argument("--start-tick", type=int, default=None)
+    ap.add_argument("--stop-tick", type=int, default=None)
+    ap.add_argument("--start-pc", type=lambda s: int(s, 0), default=None)
+    ap.add_argument("--stop-pc", type=lambda s: int(s, 0), default=None)
+    ap.add_argument("--start-label", default=None)
+    ap.add_argument("--stop-label", default=None)
+    ap.add_argument("--window", type=int, default=None, help="only write the last N cycles before hf or iocf")
+    ap.add_argument("--retire-trace", default=None, help="write every retired instruction to this binary file")
+    args = ap.parse_args()
+
+    if args.cxxrtl and (args.pipelined or args.fifo_depth or args.vcd or args.vcd_all or args.print_every
+                        or args.retire_trace):
+        ap.error("--cxxrtl only runs Cpu to halt, without FIFOs or traces")
+    if args.pipelined and (args.cache_lines or args.fifo_depth or args.interrupts):
+        ap.error("--pipelined does not support --cache-lines, --fifo-depth or --interrupts")
+    if args.harvard and args.cache_lines:
+        ap.error("--harvard can not be combined with --cache-lines, the instruction cache replaces it")
+    if args.retire_trace and (args.vcd or args.pipelined):
+        ap.error("--retire-trace cannot be combined with --vcd, and follows Cpu, not --pipelined")
+
+    if (args.start_label is not None or args.stop_label is not None) and not args.map:
+        ap.error("--start-label/--stop-label need --map")
+
+    source_map = SourceMap.load(args.map[0]) if args.map else None
+    for label in [args.start_label, args.stop_label]:
+        if label is not None and label not in source_map.labels:
+            ap.error(f"Unknown label: {label}")
+    if args.start_label is not None:
+        args.start_pc = source_map.label_address(args.start_label)
+    if args.stop_label is not None:
+        args.stop_pc = source_map.label_address(args.stop_label)
+
+    trace = None
+    if args.vcd:
+        trace = VcdTrace(args.vcd[0], args.signals.split(","), args.start_tick, args.stop_tick,
+                         args.start_pc, args.stop_pc, args.window)
+    elif args.retire_trace:
+        trace = RetireTrace(args.retire_trace)
+
+    input_stream = None
+    if args.input_file is not None:
+        input_stream = read_stream(args.input_file, args.word_size, args.endian)
+
     # test(False)
-    test(True)
+    test(not (args.batch or args.cxxrtl), args.input[0], source_map, args.print_every, not args.no_dump,
+         trace, args.vcd_all[0] if args.vcd_all else None, PipelinedCpu if args.pipelined else Cpu,
+         input_stream, args.block_size, args.cxxrtl, args.snapshot, harvard=args.harvard,
+         word_size=args.word_size, addr_bus_width=args.addr_bus_width, ram_size=args.ram_size, endian=args.endian,
+         multiplier=args.multiplier, divider=args.divider, alu_radix=args.alu_radix, cache_lines=args.cache_lines,
+         line_size=args.line_size, memory_latency=args.memory_latency, io_fifo_depth=args.fifo_depth,
+         interrupts=args.interrupts)
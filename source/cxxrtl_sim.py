@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import amaranth as am
+from amaranth.back import rtlil
+from amaranth.hdl.ast import ArrayProxy, Cat, Const, Operator, Signal, SignalDict, Slice
+from amaranth.hdl.ir import Fragment
+
+from alu_units import ALU_UNITS
+from codes import Argument, ENDIANS, load_words
+from cpu import Cpu, quiet_memories, read_result
+from synth_bench import yosys_command
+
+
+# Runs Cpu as a compiled model instead of in the Python simulator. The design
+# is exported through Yosys to CXXRTL and built into a shared library with the
+# system C++ compiler, together with DRIVER, which runs the same INPUT/OUTPUT
+# protocol as the test() bench without returning to Python every cycle.
+#
+# The library does not depend on the ROM: the design is elaborated with an
+# empty RAM, and the ROM is written into the model before it runs. So builds
+# are cached in build_dir under the hash of the design and are shared by every
+# program with the same Cpu options.
+DRIVER = r"""
+#include <cstdint>
+#include <cxxrtl/cxxrtl.h>
+#include "design.cc"
+
+using namespace cxxrtl;
+
+struct Model {
+    cxxrtl_design::p_top top;
+    debug_items items;
+    debug_item *hf, *irf, *owf, *input, *output;
+};
+
+static debug_item *find(Model *model, const char *name) {
+    auto it = model->items.table.find(name);
+    if (it == model->items.table.end() || it->second.size() != 1)
+        return nullptr;
+    return &it->second[0];
+}
+
+// One clock cycle. Only the rising edge is evaluated: the next edge
+// evaluates everything that depends on the new state before using it, so the
+// falling edge only has to be committed.
+static void step(Model *model) {
+    model->top.p_clk.set<bool>(true);
+    model->top.step();
+    model->top.p_clk.set<bool>(false);
+    model->top.commit();
+}
+
+extern "C" {
+
+void *model_create() {
+    Model *model = new Model;
+    model->top.debug_info(&model->items, nullptr, "");
+    model->top.step();
+    return model;
+}
+
+void model_destroy(void *model) {
+    delete (Model *)model;
+}
+
+// Width in bits, or 0 if there is no such signal or memory
+size_t model_width(void *model, const char *name) {
+    debug_item *item = find((Model *)model, name);
+    return item == nullptr ? 0 : item->width;
+}
+
+int model_read(void *model, const char *name, size_t index, uint32_t *chunks) {
+    Model *m = (Model *)model;
+    debug_item *item = find(m, name);
+    if (item == nullptr || index >= item->depth)
+        return 0;
+    // Signals that are not state are only up to date after an evaluation
+    m->top.step();
+    if (item->type == debug_item::OUTLINE)
+        item->outline->eval();
+    size_t count = (item->width + 31) / 32;
+    for (size_t chunk = 0; chunk < count; chunk++)
+        chunks[chunk] = item->curr[index * count + chunk];
+    return 1;
+}
+
+// Only state can be written, the next step() recomputes everything else
+int model_write(void *model, const char *name, size_t index, const uint32_t *chunks) {
+    Model *m = (Model *)model;
+    debug_item *item = find(m, name);
+    if (item == nullptr || index >= item->depth || !(item->flags & debug_item::DRIVEN_SYNC ||
+                                                     item->type == debug_item::MEMORY))
+        return 0;
+    size_t count = (item->width + 31) / 32;
+    for (size_t chunk = 0; chunk < count; chunk++) {
+        item->curr[index * count + chunk] = chunks[chunk];
+        if (item->next != nullptr)
+            item->next[index * count + chunk] = chunks[chunk];
+    }
+    m->top.step();
+    return 1;
+}
+
+int model_bind(void *model, const char *hf, const char *irf, const char *owf, const char *input,
+               const char *output) {
+    Model *m = (Model *)model;
+    m->hf = find(m, hf);
+    m->irf = find(m, irf);
+    m->owf = find(m, owf);
+    m->input = find(m, input);
+    m->output = find(m, output);
+    return m->hf && m->irf && m->owf && m->input && m->output;
+}
+
+// Runs until hf, max_cycles or max_outputs outputs, and returns the cycles run.
+// Inputs past the end read as 0.
+uint64_t model_run(void *model, const uint64_t *inputs, size_t num_inputs, size_t *used, uint64_t *outputs,
+                   size_t max_outputs, size_t *produced, uint64_t max_cycles) {
+    Model *m = (Model *)model;
+    uint64_t cycles = 0;
+    *used = 0;
+    *produced = 0;
+    while (!(m->hf->curr[0] & 1) && cycles < max_cycles && *produced < max_outputs) {
+        if (m->irf->curr[0] & 1) {
+            uint32_t value = *used < num_inputs ? (uint32_t)inputs[(*used)++] : 0;
+            m->input->curr[0] = value;
+            m->input->next[0] = value;
+        }
+        if (m->owf->curr[0] & 1)
+            outputs[(*produced)++] = m->output->curr[0];
+        step(m);
+        cycles++;
+    }
+    return cycles;
+}
+
+}
+"""
+
+CXXFLAGS = ["-std=c++14", "-O1", "-fPIC", "-shared"]
+
+
+def runtime_include(yosys):
+    if yosys == "builtin":
+        import amaranth_yosys
+        share = os.path.join(os.path.dirname(amaranth_yosys.__file__), "share")
+    else:
+        share = subprocess.run([yosys + "-config", "--datdir"], capture_output=True, text=True,
+                               check=True).stdout.strip()
+    return os.path.join(share, "include", "backends", "cxxrtl", "runtime")
+
+
+# The signals the model reads and writes, under names that do not depend on
+# the elaboration. Every word of the registers and of RAM is a signal.
+def roles(dut):
+    signals = {"hf": dut.hf, "iocf": dut.iocf, "irf": dut.irf, "owf": dut.owf}
+    for index in range(Argument._NUM_REGS):
+        signals[f"registers[{index}]"] = dut.registers[index]
+    for index in range(dut.ram_size):
+        signals[f"ram[{index}]"] = dut.ram[index]
+    for signal in dut.counters + dut.controls:
+        signals[signal.name] = signal
+    if dut.irq_active is not None:
+        signals["irq_active"] = dut.irq_active
+    for cache in [dut.icache, dut.dcache]:
+        if cache is not None:
+            signals[cache.hits.name] = cache.hits
+            signals[cache.misses.name] = cache.misses
+    return signals
+
+
+# RTLIL of a Cpu without a ROM, and where every role is in the model, as the
+# name of a signal or memory and the index of the word
+def elaborate(dut):
+    fragment = Fragment.get(dut, None).prepare(ports=[dut.hf, dut.iocf, dut.irf, dut.owf])
+    (design, name_map) = rtlil.convert_fragment(fragment, emit_src=False)
+    locations = {}
+    for (role, signal) in roles(dut).items():
+        if signal in name_map:
+            locations[role] = (" ".join(name_map[signal][1:]), 0)
+        else:
+            # RAM behind ports is one memory of the model
+            locations[role] = (find_memory(design, dut.ram_size, dut.word_size), int(role[len("ram["):-1]))
+    if dut.imem is not None:
+        for (index, bank) in enumerate(dut.imem):
+            locations[f"imem{index}"] = (find_memory(design, bank.depth, bank.width, f"imem{index}_read"), 0)
+    return (design, locations)
+
+
+# Memories with ports are $mem_v2 cells, named after their MEMID in the
+# flattened model. Finds the one of the given size and width, and memid.
+def find_memory(design, depth, width, memid=None):
+    found = []
+    (module, cell, parameters) = ([], False, {})
+    for line in design.splitlines():
+        words = line.split()
+        if len(words) >= 2 and words[0] == "module":
+            module = words[1].lstrip("\\").split(".")[1:]
+        elif len(words) >= 3 and words[0] == "cell":
+            (cell, parameters) = (words[1] == "$mem_v2", {})
+        elif cell and len(words) >= 3 and words[0] == "parameter":
+            parameters[words[1]] = words[2]
+        elif cell and words == ["end"]:
+            name = parameters.get("\\MEMID", "").strip('"').lstrip("\\")
+            if (int(parameters.get("\\SIZE", "0")) == depth and int(parameters.get("\\WIDTH", "0")) == width
+                    and memid in [None, name]):
+                found.append(" ".join(module + [name]))
+            cell = False
+    assert len(found) == 1, f"expected one {width} bit memory of {depth} words, found {found}"
+    return found[0]
+
+
+# Builds the model library, unless it is already in build_dir, and returns its path
+def build(design, build_dir="build/cxxrtl", compiler="c++", yosys="builtin"):
+    key = hashlib.sha256("\0".join([design, DRIVER, compiler] + CXXFLAGS).encode()).hexdigest()[:16]
+    directory = os.path.join(build_dir, key)
+    library = os.path.join(directory, "model.so")
+    if os.path.exists(library):
+        return library
+
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    # Built in a scratch directory and moved into place, so that processes
+    # building the same design at the same time do not see half a library
+    with tempfile.TemporaryDirectory(dir=directory) as scratch:
+        with open(os.path.join(scratch, "design.il"), "w") as ofs:
+            ofs.write(design)
+        with open(os.path.join(scratch, "driver.cc"), "w") as ofs:
+            ofs.write(DRIVER)
+        # The bundled Yosys can only see its working directory
+        subprocess.run(yosys_command(yosys) + ["-q", "-p", "read_rtlil design.il; write_cxxrtl design.cc"],
+                       cwd=scratch, check=True)
+        subprocess.run([compiler] + CXXFLAGS + ["-I", runtime_include(yosys), "-o", "model.so", "driver.cc"],
+                       cwd=scratch, check=True)
+        os.replace(os.path.join(scratch, "model.so"), library)
+    print(f"Built {library} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    return library
+
+
+# Elaborating takes much longer than loading the library, so the library and
+# the locations are first looked up by the options and the Python sources of
+# the design, and the design is only elaborated and hashed on a miss
+def load(dut, options, build_dir="build/cxxrtl", compiler="c++", yosys="builtin"):
+    digest = hashlib.sha256(repr([sorted(options.items()), compiler, yosys, am.__version__]).encode())
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+        with open(path, "rb") as ifs:
+            digest.update(ifs.read())
+    index = os.path.join(build_dir, "index", digest.hexdigest()[:16] + ".json")
+    if os.path.exists(index):
+        with open(index, "r") as ifs:
+            entry = json.load(ifs)
+        if os.path.exists(entry["library"]):
+            return entry
+
+    (design, locations) = elaborate(dut)
+    entry = {"library": os.path.abspath(build(design, build_dir, compiler, yosys)), "locations": locations}
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    with open(index + f".{os.getpid()}", "w") as ofs:
+        json.dump(entry, ofs)
+    os.replace(index + f".{os.getpid()}", index)
+    return entry
+
+
+class CxxrtlCpu:
+    def __init__(self, rom_file="build/rom_file", build_dir="build/cxxrtl", compiler="c++", yosys="builtin",
+                 **options):
+        assert not options.get("io_fifo_depth"), "the compiled model only has the irf/owf protocol, not FIFOs"
+        endian = options.get("endian", "little")
+        self.dut = dut = quiet_memories(Cpu(b"", **options))
+        entry = load(dut, options, build_dir, compiler, yosys)
+        self.locations = SignalDict((signal, tuple(entry["locations"][role])) for (role, signal) in roles(dut).items())
+
+        self.lib = ctypes.CDLL(entry["library"])
+        self.lib.model_create.restype = ctypes.c_void_p
+        self.lib.model_destroy.argtypes = [ctypes.c_void_p]
+        self.lib.model_width.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        self.lib.model_width.restype = ctypes.c_size_t
+        self.lib.model_read.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t,
+                                        ctypes.POINTER(ctypes.c_uint32)]
+        self.lib.model_write.argtypes = self.lib.model_read.argtypes
+        self.lib.model_bind.argtypes = [ctypes.c_void_p] + [ctypes.c_char_p] * 5
+        self.lib.model_run.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint64), ctypes.c_size_t,
+                                       ctypes.POINTER(ctypes.c_size_t), ctypes.POINTER(ctypes.c_uint64),
+                                       ctypes.c_size_t, ctypes.POINTER(ctypes.c_size_t), ctypes.c_uint64]
+        self.lib.model_run.restype = ctypes.c_uint64
+        self.model = self.lib.model_create()
+
+        bound = self.lib.model_bind(self.model, *[self.locate(signal)[0].encode() for signal in
+                                                  [dut.hf, dut.irf, dut.owf, dut.input(), dut.output()]])
+        assert bound, "the model is missing a flag or the INPUT or OUTPUT register"
+
+        rom = list(load_words(rom_file, dut.word_size, endian))
+        for (address, word) in enumerate(rom):
+            self.write(dut.ram[address], word)
+        if dut.imem is not None:
+            for (index, words) in enumerate(dut.code_banks(rom)):
+                bank = entry["locations"][f"imem{index}"][0]
+                for (address, word) in enumerate(words):
+                    self.write_memory(bank, address, word, dut.word_size)
+        self.cycles = 0
+        self.consumed = 0
+
+    def __del__(self):
+        if getattr(self, "model", None) is not None:
+            self.lib.model_destroy(self.model)
+
+    def locate(self, signal):
+        return self.locations[signal]
+
+    def read_memory(self, name, index):
+        width = self.lib.model_width(self.model, name.encode())
+        chunks = (ctypes.c_uint32 * max(1, (width + 31) // 32))()
+        assert self.lib.model_read(self.model, name.encode(), index, chunks), f"can not read {name}[{index}]"
+        return sum(chunk << (32 * position) for (position, chunk) in enumerate(chunks))
+
+    def write_memory(self, name, index, value, width):
+        chunks = (ctypes.c_uint32 * ((width + 31) // 32))()
+        for position in range(len(chunks)):
+            chunks[position] = (value >> (32 * position)) & 0xFFFFFFFF
+        assert self.lib.model_write(self.model, name.encode(), index, chunks), f"can not write {name}[{index}]"
+
+    def read(self, signal):
+        return self.read_memory(*self.locate(signal))
+
+    def write(self, signal, value):
+        (name, index) = self.locate(signal)
+        self.write_memory(name, index, value, len(signal))
+
+    # Value of a signal, or of a memory word at a computed address
+    def evaluate(self, value):
+        if isinstance(value, Const):
+            return value.value
+        if isinstance(value, Signal):
+            return self.read(value)
+        if isinstance(value, Slice):
+            return (self.evaluate(value.value) >> value.start) & ((1 << (value.stop - value.start)) - 1)
+        if isinstance(value, Cat):
+            result = 0
+            for part in reversed(value.parts):
+                result = result << len(part) | self.evaluate(part)
+            return result
+        if isinstance(value, ArrayProxy):
+            # Past the end is the last element, like in the design
+            return self.evaluate(value.elems[min(self.evaluate(value.index), len(value.elems) - 1)])
+        if isinstance(value, Operator) and value.operator in ["+", "-"] and len(value.operands) == 2:
+            (a, b) = (self.evaluate(operand) for operand in value.operands)
+            return (a + b if value.operator == "+" else a - b) & ((1 << len(value)) - 1)
+        raise NotImplementedError(f"can not evaluate {value!r} in the compiled model")
+
+    # Runs a simulator process like print_state, answering what it yields
+    def drive(self, process):
+        try:
+            command = next(process)
+            while True:
+                command = process.send(self.evaluate(command))
+        except StopIteration as stop:
+            return stop.value
+
+    # Same protocol as the test() bench: a word from inputs every cycle irf is
+    # set, 0 once they run out, and on_output with every word written while
+    # owf is set. Returns the cycles run, until hf or max_cycles more cycles.
+    def run(self, inputs=(), on_output=None, max_cycles=None, batch=4096):
+        inputs = list(inputs)
+        remaining = (1 << 64) - 1 if max_cycles is None else max_cycles
+        buffer = (ctypes.c_uint64 * len(inputs))(*inputs)
+        outputs = (ctypes.c_uint64 * batch)()
+        (used, produced) = (ctypes.c_size_t(), ctypes.c_size_t())
+        (offset, cycles) = (0, 0)
+        while True:
+            pointer = ctypes.cast(ctypes.addressof(buffer) + offset * 8, ctypes.POINTER(ctypes.c_uint64))
+            ran = self.lib.model_run(self.model, pointer, len(inputs) - offset, ctypes.byref(used), outputs,
+                                     batch, ctypes.byref(produced), remaining)
+            offset += used.value
+            self.consumed += used.value
+            cycles += ran
+            remaining -= ran
+            if on_output is not None:
+                for index in range(produced.value):
+                    on_output(outputs[index])
+            if produced.value < batch or remaining == 0 or self.read(self.dut.hf):
+                break
+        self.cycles += cycles
+        return cycles
+
+
+# Builds the model for these options if it is not cached yet, so that
+# processes started later find it
+def prepare(build_dir="build/cxxrtl", compiler="c++", yosys="builtin", **options):
+    return load(quiet_memories(Cpu(b"", **options)), options, build_dir, compiler, yosys)
+
+
+# Same result as regression.run_rtl, from the compiled model
+def run_cxxrtl(rom_file, inputs, max_cycles, build_dir="build/cxxrtl", **options):
+    model = CxxrtlCpu(rom_file, build_dir, **options)
+    outputs = []
+    cycles = model.run(inputs, outputs.append, max_cycles)
+    return model.drive(read_result(model.dut, outputs, cycles))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("--build-dir", default="build/cxxrtl", help="compiled models are cached here")
+    ap.add_argument("--compiler", default="c++")
+    ap.add_argument("--yosys", default="builtin", help="builtin, or the path of a Yosys binary")
+    ap.add_argument("--inputs", default="", help="comma separated input words")
+    ap.add_argument("--max-cycles", type=int, default=None)
+    ap.add_argument("--harvard", action="store_true", help="fetch instructions from a separate read-only memory")
+    ap.add_argument("-w", "--word-size", type=int, default=8, choices=[8, 16, 32])
+    ap.add_argument("--endian", default="little", choices=ENDIANS, help="byte order of the words in the ROM")
+    ap.add_argument("--multiplier", default="comb", choices=ALU_UNITS, help="sequential stalls until done")
+    ap.add_argument("--divider", default="comb", choices=ALU_UNITS, help="sequential stalls until done")
+    ap.add_argument("--alu-radix", type=int, default=2, help="radix of the sequential multiplier and divider")
+    ap.add_argument("--cache-lines", type=int, default=0, help="put caches of this many lines in front of RAM")
+    ap.add_argument("--line-size", type=int, default=4, help="words in a cache line")
+    ap.add_argument("--memory-latency", type=int, default=2, help="wait states of every RAM access behind the caches")
+    ap.add_argument("--interrupts", action="store_true", help="add the interrupt controller, WAIT and RETI")
+    ap.add_argument("-a", "--addr-bus-width", type=int, default=8)
+    ap.add_argument("-r", "--ram-size", type=int, default=256)
+    args = ap.parse_args()
+
+    inputs = [int(token, 0) for token in args.inputs.split(",") if token]
+    start = time.perf_counter()
+    result = run_cxxrtl(args.input[0], inputs, args.max_cycles, args.build_dir, compiler=args.compiler,
+                        yosys=args.yosys, harvard=args.harvard, word_size=args.word_size, endian=args.endian,
+                        multiplier=args.multiplier, divider=args.divider, alu_radix=args.alu_radix,
+                        cache_lines=args.cache_lines, line_size=args.line_size, memory_latency=args.memory_latency,
+                        interrupts=args.interrupts, addr_bus_width=args.addr_bus_width, ram_size=args.ram_size)
+    seconds = time.perf_counter() - start
+    print(f"Outputs: {' '.join(str(value) for value in result['outputs'])}")
+    print(f"{'Halted' if result['halted'] else 'Stopped'} after {result['cycles']} cycles in {seconds:.3f} s"
+          f"{', illegal opcode' if result['iocf'] else ''}")
+    for (name, value) in result["counters"].items():
+        print(f"  {name:18} {value}")
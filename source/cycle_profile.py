@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+
+from amaranth.sim import Simulator
+
+from codes import Operation, Argument, CF, OF, SF, ZF
+from cpu import Cpu, quiet_memories
+from isa_sim import IsaSim
+from source_map import SourceMap
+
+
+# Conditional jumps: (STATUS flag, whether the jump is taken with it set)
+BRANCHES = {
+    Operation.JC: (CF, True), Operation.JNC: (CF, False), Operation.JO: (OF, True), Operation.JNO: (OF, False),
+    Operation.JS: (SF, True), Operation.JNS: (SF, False), Operation.JZ: (ZF, True), Operation.JNZ: (ZF, False),
+}
+
+
+# Collects where a program spends its cycles. Fed with one record() per clock
+# cycle, from either IsaSim or the Amaranth simulation of Cpu.
+class CycleProfile:
+    def __init__(self, source_map=None):
+        self.source_map = source_map
+        self.total = 0
+        self.pcs = collections.Counter()
+        self.opcodes = collections.Counter()
+        self.taken = collections.Counter()
+        self.not_taken = collections.Counter()
+        self.stacks = collections.Counter()
+        self.stack = ["main"]
+        self.stack_key = "main"
+
+    def symbol(self, pc):
+        symbol = self.source_map.symbol(pc) if self.source_map is not None else None
+        return symbol[0] if symbol is not None else f"{pc:02X}"
+
+    # status is STATUS before the instruction, which decides branches the
+    # same way as IsaSim, whatever the next pc is
+    def record(self, pc, opcode, next_pc, status):
+        self.total += 1
+        self.pcs[pc] += 1
+        self.opcodes[opcode] += 1
+        self.stacks[self.stack_key] += 1
+
+        if opcode in BRANCHES:
+            (flag, when_set) = BRANCHES[opcode]
+            if bool(status & flag) == when_set:
+                self.taken[pc] += 1
+            else:
+                self.not_taken[pc] += 1
+        elif opcode == Operation.CALL:
+            self.stack.append(self.symbol(next_pc))
+            self.stack_key = ";".join(self.stack)
+        elif opcode == Operation.RET and len(self.stack) > 1:
+            self.stack.pop()
+            self.stack_key = ";".join(self.stack)
+
+    def labels(self):
+        labels = collections.Counter()
+        for (pc, cycles) in self.pcs.items():
+            labels[self.symbol(pc)] += cycles
+        return labels
+
+    def functions(self):
+        functions = collections.Counter()
+        for (stack, cycles) in self.stacks.items():
+            functions[stack.split(";")[-1]] += cycles
+        return functions
+
+    def report(self, top=20):
+        def percent(cycles):
+            return f"{100 * cycles / self.total:5.1f}%" if self.total > 0 else "  0.0%"
+
+        print(f"Total: {self.total} cycles")
+
+        print("\nHot spots by PC:")
+        for (pc, cycles) in self.pcs.most_common(top):
+            location = self.source_map.format(pc) if self.source_map is not None else ""
+            print(f"  {cycles:10} {percent(cycles)}  {pc:02X}  {location}")
+
+        print("\nBy label:")
+        for (label, cycles) in self.labels().most_common(top):
+            print(f"  {cycles:10} {percent(cycles)}  {label}")
+
+        print("\nBy function (self):")
+        for (function, cycles) in self.functions().most_common(top):
+            print(f"  {cycles:10} {percent(cycles)}  {function}")
+
+        print("\nOpcode mix:")
+        for (opcode, cycles) in self.opcodes.most_common():
+            print(f"  {cycles:10} {percent(cycles)}  {Operation.lookup(opcode)}")
+
+        print("\nBranches:")
+        for pc in sorted(set(self.taken) | set(self.not_taken)):
+            (taken, not_taken) = (self.taken[pc], self.not_taken[pc])
+            location = self.source_map.format(pc) if self.source_map is not None else f"{pc:02X}"
+            print(f"  {taken:10} taken {not_taken:10} not taken  "
+                  f"{100 * taken / (taken + not_taken):5.1f}%  {location}")
+
+    # Folded stacks, as read by flamegraph.pl and speedscope
+    def write_folded(self, path):
+        with open(path, "w") as ofs:
+            for (stack, cycles) in sorted(self.stacks.items()):
+                ofs.write(f"{stack} {cycles}\n")
+
+
+def profile_isa(rom_file, inputs, profile, max_ticks=None):
+    isa = IsaSim(rom_file)
+    isa.set_inputs(inputs)
+    registers = isa.registers
+    ram = isa.ram
+    while not isa.hf and (max_ticks is None or isa.cycles < max_ticks):
+        pc = registers[Argument.PC]
+        opcode = ram[pc]
+        status = registers[Argument.STATUS]
+        isa.step()
+        profile.record(pc, opcode, registers[Argument.PC], status)
+    return isa.outputs
+
+
+def profile_rtl(rom_file, inputs, profile, max_ticks=None):
+    dut = quiet_memories(Cpu(rom_file))
+    inputs = iter(inputs)
+    outputs = []
+
+    def bench():
+        pc = yield dut.pc()
+        cycles = 0
+        while not (yield dut.hf) and (max_ticks is None or cycles < max_ticks):
+            if (yield dut.irf):
+                yield dut.input().eq(next(inputs, 0))
+            if (yield dut.owf):
+                outputs.append((yield dut.output()))
+
+            opcode = yield dut.ram[pc]
+            status = yield dut.registers[Argument.STATUS]
+            yield
+            cycles += 1
+            next_pc = yield dut.pc()
+            profile.record(pc, opcode, next_pc, status)
+            pc = next_pc
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)  # 1 MHz
+    sim.add_sync_process(bench)
+    sim.run()
+    return outputs
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("-m", "--map", nargs=1, default=None, help="source map written by assemble_rom.py")
+    ap.add_argument("--inputs", type=lambda s: int(s, 0), nargs="*", default=[])
+    ap.add_argument("--rtl", action="store_true", help="profile the Amaranth simulation instead of IsaSim")
+    ap.add_argument("--max-ticks", type=int, default=None)
+    ap.add_argument("--top", type=int, default=20)
+    ap.add_argument("--folded", nargs=1, default=None, help="write folded stacks for flamegraph.pl")
+    args = ap.parse_args()
+
+    source_map = SourceMap.load(args.map[0]) if args.map else None
+    profile = CycleProfile(source_map)
+    if args.rtl:
+        profile_rtl(args.input[0], args.inputs, profile, args.max_ticks)
+    else:
+        profile_isa(args.input[0], args.inputs, profile, args.max_ticks)
+
+    profile.report(args.top)
+    if args.folded:
+        profile.write_folded(args.folded[0])
@@ -0,0 +1,169 @@
+import operator
+import re
+
+import amaranth as am
+
+from vcd_trace import signal_table
+
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+
+HELP = """Commands:
+  s [N]             step N cycles, 1 by default, also an empty line
+  c                 continue until a breakpoint, watchpoint or condition
+  o                 continue until the next output
+  r                 run to halt, ignoring the stops
+  b ADDR|LABEL      break when pc gets to an address
+  w NAME            break when a value changes, e.g. r0, sp, ram[0x40], ram[table]
+  if NAME OP VALUE  break when a comparison becomes true, e.g. if z == 1, if tick >= 100
+  l                 list the stops
+  d [N]             delete stop N, or all of them
+  dump              print the RAM
+  q                 quit"""
+
+
+class Stop:
+    def __init__(self, kind, text, name, test):
+        self.kind = kind
+        self.text = text
+        self.name = name
+        self.test = test
+
+
+# Breakpoints, watchpoints and conditions of the interactive prompt. While
+# the bench runs between stops, it samples only the signals that the stops
+# read, packed into one value so that a cycle costs a single read. Stops are
+# taken on changes after the prompt, so continuing from a breakpoint or a
+# true condition does not stop again right away.
+class Debugger:
+    def __init__(self, dut, source_map=None):
+        self.dut = dut
+        self.source_map = source_map
+        self.table = signal_table(dut)
+        self.stops = []
+        self.until_output = False
+        self.previous = None
+        self.value = None
+
+    def address(self, text):
+        if self.source_map is not None and text in self.source_map.labels:
+            return self.source_map.label_address(text)
+        try:
+            return int(text, 0)
+        except ValueError:
+            raise Exception(f"Unknown address or label: {text}")
+
+    # (value, width) of a name of signal_table or ram[ADDR|LABEL]
+    def signal(self, name):
+        if name.lower() in self.table:
+            return self.table[name.lower()]
+        match = re.fullmatch(r"ram\[(.+)\]", name, re.IGNORECASE)
+        if match is None:
+            raise Exception(f"Unknown name: {name}, expected ram[ADDR] or one of {', '.join(self.table)}")
+        address = self.address(match.group(1))
+        if address >= self.dut.ram_size:
+            raise Exception(f"Address {address:X} is outside of RAM")
+        return (self.dut.ram[address], self.dut.word_size)
+
+    def location(self, address):
+        return self.source_map.format(address) if self.source_map is not None else f"{address:02X}"
+
+    def add(self, stop):
+        self.stops.append(stop)
+        self.value = None
+        print(f"Stop {len(self.stops)}: {stop.text}")
+
+    def add_breakpoint(self, text):
+        address = self.address(text)
+        self.add(Stop("break", f"break at {self.location(address)}", "pc",
+                      lambda previous, current: current == address and previous != address))
+
+    def add_watchpoint(self, name):
+        self.signal(name)
+        self.add(Stop("watch", f"watch {name}", name, operator.ne))
+
+    def add_condition(self, name, op, text):
+        self.signal(name)
+        (compare, value) = (OPERATORS[op], int(text, 0))
+        self.add(Stop("if", f"if {name} {op} {text}", name,
+                      lambda previous, current: compare(current, value) and not compare(previous, value)))
+
+    def delete(self, number=None):
+        if number is None:
+            self.stops.clear()
+        elif 1 <= number <= len(self.stops):
+            del self.stops[number - 1]
+        else:
+            raise Exception(f"No stop {number}")
+        self.value = None
+
+    def list(self):
+        if len(self.stops) == 0:
+            print("No stops")
+        for (number, stop) in enumerate(self.stops, 1):
+            print(f"Stop {number}: {stop.text}")
+
+    def sample(self):
+        if self.value is None:
+            self.fields = {"owf": (self.dut.owf, 1)}
+            for stop in self.stops:
+                self.fields.setdefault(stop.name, self.signal(stop.name))
+            self.value = am.Cat(*[value for (value, width) in self.fields.values()])
+        packed = yield self.value
+        values = {}
+        for (name, (value, width)) in self.fields.items():
+            values[name] = packed & ((1 << width) - 1)
+            packed >>= width
+        return values
+
+    # Called at the prompt before running on, stops are taken on changes from here
+    def resume(self, until_output=False):
+        self.until_output = until_output
+        self.previous = yield from self.sample()
+
+    # Called once per cycle while running, returns why to stop or None
+    def check(self):
+        current = yield from self.sample()
+        (previous, self.previous) = (self.previous, current)
+        if self.until_output and current["owf"]:
+            return "output written"
+        for (number, stop) in enumerate(self.stops, 1):
+            if stop.test(previous[stop.name], current[stop.name]):
+                if stop.kind == "watch":
+                    return f"stop {number}, {stop.name} changed from {previous[stop.name]:X} to {current[stop.name]:X}"
+                return f"stop {number}, {stop.text}"
+        return None
+
+    # Handles a command that sets up stops, returns False for others
+    def command(self, cmd):
+        words = cmd.split()
+        if len(words) == 0:
+            return False
+        try:
+            if words[0] == "b" and len(words) == 2:
+                self.add_breakpoint(words[1])
+            elif words[0] == "w" and len(words) == 2:
+                self.add_watchpoint(words[1])
+            elif words[0] == "if":
+                match = re.fullmatch(r"if\s+(\S+?)\s*(==|!=|<=|>=|<|>)\s*(\S+)", cmd.strip())
+                if match is None:
+                    raise Exception("Expected if NAME OP VALUE")
+                self.add_condition(*match.groups())
+            elif words[0] == "l" and len(words) == 1:
+                self.list()
+            elif words[0] == "d" and len(words) <= 2:
+                self.delete(int(words[1]) if len(words) == 2 else None)
+            elif words[0] in ["h", "help"]:
+                print(HELP)
+            else:
+                return False
+        except Exception as e:
+            print(e)
+        return True
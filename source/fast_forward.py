@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import sys
+import time
+
+from amaranth.sim import Simulator
+
+from cpu import Cpu, quiet_memories
+from isa_sim import IsaSim, Checkpoint
+from snapshot import FLAGS, take_snapshot
+from source_map import SourceMap
+
+
+# Make the reset state of the design equal to the checkpoint, so that the
+# simulation starts cycle-accurately from there. Must be called before the
+# Simulator is created.
+def apply_checkpoint(dut, checkpoint):
+    dut.registers.init = checkpoint.registers
+    dut.ram.init = checkpoint.ram
+    for (counter, value) in zip(dut.counters, checkpoint.counters):
+        counter.reset = value
+    dut.hf.reset = checkpoint.hf
+    dut.iocf.reset = checkpoint.iocf
+    dut.irf.reset = checkpoint.irf
+    dut.owf.reset = checkpoint.owf
+    for (control, value) in zip(dut.controls, checkpoint.controls):
+        control.reset = value
+    if dut.irq_active is not None:
+        dut.irq_active.reset = checkpoint.active
+
+
+def read_checkpoint(dut, cycles):
+    snapshot = yield from take_snapshot(dut, cycles)
+    active = (yield dut.irq_active) if dut.irq_active is not None else 0
+    return Checkpoint(cycles, snapshot.registers, snapshot.ram, *[snapshot.flags[name] for name in FLAGS],
+                      snapshot.counters, snapshot.controls or None, active)
+
+
+def fast_forward(rom_file, inputs, until_tick=None, until_pc=None, checkpoint=None, interrupts=False):
+    isa = IsaSim(rom_file, interrupts=interrupts)
+    if checkpoint is not None:
+        isa.restore(checkpoint)
+    isa.set_inputs(inputs)
+
+    if until_tick is not None:
+        isa.run(max_ticks=until_tick - isa.cycles)
+    if until_pc is not None:
+        isa.run(until_pc=until_pc)
+    return isa
+
+
+# Continue from a checkpoint in the Amaranth simulation of Cpu. With
+# compare_every set, IsaSim runs in lockstep and the full state of both is
+# compared at the hand-off point and every compare_every cycles afterwards.
+def run_rtl(rom_file, checkpoint, inputs, max_cycles=None, compare_every=None, interrupts=False):
+    dut = quiet_memories(Cpu(rom_file, interrupts=interrupts))
+    apply_checkpoint(dut, checkpoint)
+
+    (rtl_inputs, isa_inputs) = itertools.tee(inputs)
+    reference = None
+    if compare_every is not None:
+        reference = IsaSim(rom_file, interrupts=interrupts)
+        reference.restore(checkpoint)
+        reference.set_inputs(isa_inputs)
+
+    result = {"outputs": [], "mismatch": None, "cycles": checkpoint.cycles}
+
+    def bench():
+        cycles = checkpoint.cycles
+        while True:
+            if reference is not None and (cycles - checkpoint.cycles) % compare_every == 0:
+                state = yield from read_checkpoint(dut, cycles)
+                differences = state.diff(reference.checkpoint())
+                if len(differences) > 0:
+                    result["mismatch"] = (cycles, differences)
+                    break
+
+            if (yield dut.hf) or (max_cycles is not None and cycles - checkpoint.cycles >= max_cycles):
+                break
+
+            if (yield dut.irf):
+                yield dut.input().eq(next(rtl_inputs, 0))
+
+            if (yield dut.owf):
+                result["outputs"].append((yield dut.output()))
+                print(f"Read output: {result['outputs'][-1]:02X}")
+
+            yield
+            cycles += 1
+            if reference is not None:
+                reference.step()
+
+        result["cycles"] = cycles
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)  # 1 MHz
+    sim.add_sync_process(bench)
+    sim.run()
+    return result
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("--inputs", type=lambda s: int(s, 0), nargs="*", default=[])
+    ap.add_argument("--outputs", type=lambda s: int(s, 0), nargs="*", default=None)
+    ap.add_argument("-t", "--tick", type=int, default=None, help="hand off after this many cycles")
+    ap.add_argument("-p", "--pc", type=lambda s: int(s, 0), default=None, help="hand off when reaching this PC")
+    ap.add_argument("-l", "--label", default=None, help="hand off when reaching this label")
+    ap.add_argument("-m", "--map", nargs=1, default=None, help="source map written by assemble_rom.py")
+    ap.add_argument("-c", "--cycles", type=int, default=None, help="cycles to simulate after the hand-off")
+    ap.add_argument("-n", "--compare-every", type=int, default=None)
+    ap.add_argument("--load-checkpoint", default=None)
+    ap.add_argument("--save-checkpoint", default=None)
+    ap.add_argument("--interrupts", action="store_true", help="add the interrupt controller, WAIT and RETI")
+    args = ap.parse_args()
+    if args.label is not None and not args.map:
+        ap.error("--label needs --map")
+
+    inputs = iter(args.inputs)
+    source_map = SourceMap.load(args.map[0]) if args.map else None
+    if args.label is not None:
+        if args.label not in source_map.labels:
+            ap.error(f"Unknown label: {args.label}")
+        args.pc = source_map.label_address(args.label)
+    checkpoint = Checkpoint.load(args.load_checkpoint) if args.load_checkpoint else None
+
+    start = time.perf_counter()
+    isa = fast_forward(args.input[0], inputs, until_tick=args.tick, until_pc=args.pc, checkpoint=checkpoint,
+                       interrupts=args.interrupts)
+    checkpoint = isa.checkpoint()
+    location = source_map.format(isa.pc()) if source_map else f"{isa.pc():02X}"
+    print(f"Fast-forwarded to cycle {checkpoint.cycles} (pc: {location}) in {time.perf_counter() - start:.3f} s")
+    if args.save_checkpoint:
+        checkpoint.save(args.save_checkpoint)
+
+    start = time.perf_counter()
+    result = run_rtl(args.input[0], checkpoint, inputs, max_cycles=args.cycles, compare_every=args.compare_every,
+                     interrupts=args.interrupts)
+    print(f"Simulated {result['cycles'] - checkpoint.cycles} cycles in {time.perf_counter() - start:.3f} s")
+
+    if result["mismatch"] is not None:
+        (cycles, differences) = result["mismatch"]
+        print(f"State mismatch at cycle {cycles}:")
+        for line in differences:
+            print(f"  {line}")
+        sys.exit(1)
+
+    outputs = isa.outputs + result["outputs"]
+    if args.outputs is not None:
+        assert outputs == args.outputs, f"Expected outputs {args.outputs}, got {outputs}"
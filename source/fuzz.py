@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import time
+
+from assemble_rom import assemble, tokenize
+from codes import Argument, Operation, ENDIANS, OPS, SIZES
+from cpu import Cpu
+from cxxrtl_sim import CxxrtlCpu, prepare
+from fast_forward import read_checkpoint
+from isa_sim import IsaSim
+from session import CpuSession
+
+
+POINTERS = [Argument.R0, Argument.R1, Argument.R2, Argument.R3, Argument.R4, Argument.R5, Argument.R6, Argument.R7]
+SPECIAL = [Argument.STATUS, Argument.LINK, Argument.INPUT, Argument.OUTPUT, Argument.PC, Argument.SP, Argument.TICK]
+COUNTERS = list(range(Argument._FIRST_COUNTER, Argument._FIRST_COUNTER + Argument._NUM_COUNTERS))
+CONTROLS = list(range(Argument._FIRST_CONTROL, Argument._FIRST_CONTROL + Argument._NUM_CONTROLS))
+
+# Registers a random instruction may write. PC and LINK are left to the jumps,
+# CALL and RET, and EPC, ESTATUS and IVEC to the interrupt controller, so that
+# control flow stays on instruction boundaries.
+WRITABLE = POINTERS + [Argument.STATUS, Argument.INPUT, Argument.OUTPUT, Argument.SP, Argument.TICK]
+WRITABLE_CONTROLS = [Argument.IE, Argument.IP, Argument.TIMER]
+
+# Kinds of OPS that can go in the interrupt handler, which runs straight
+# through to its RETI
+HANDLER_KINDS = ["next", "alu", "push", "pop"]
+
+
+def operand_slots(opcode):
+    return (SIZES[opcode] - 1) // 2
+
+
+# Modes a random instruction uses in an operand slot. Jump and CALL targets
+# are labels, and destinations can not be immediates.
+def slot_modes(opcode, slot):
+    (kind, expr, location, flags, size) = OPS[opcode]
+    if kind in ["jump", "call"]:
+        return [Argument.IMM]
+    if slot == location:
+        return [Argument.REG, Argument.IND, Argument.RAM]
+    return [Argument.REG, Argument.IMM, Argument.IND, Argument.RAM]
+
+
+def opcodes(interrupts=False):
+    return [opcode for (opcode, (kind, *_)) in OPS.items() if interrupts or kind not in ["wait", "reti"]]
+
+
+# The opcode, slot and mode combinations of random programs, (opcode, None,
+# None) for instructions without operands
+def coverage_bins(interrupts=False):
+    bins = set()
+    for opcode in opcodes(interrupts):
+        if operand_slots(opcode) == 0:
+            bins.add((opcode, None, None))
+        for slot in range(operand_slots(opcode)):
+            for mode in slot_modes(opcode, slot):
+                bins.add((opcode, slot, mode))
+    return bins
+
+
+def register_bins(interrupts=False):
+    return set(POINTERS + SPECIAL + COUNTERS + (CONTROLS if interrupts else []))
+
+
+def bin_name(entry):
+    (opcode, slot, mode) = entry
+    if slot is None:
+        return Operation.lookup(opcode)
+    return f"{Operation.lookup(opcode)} a{slot} {Argument.lookup(mode)}"
+
+
+# Counts the instructions that retire in IsaSim, as its trace
+class Coverage:
+    def __init__(self):
+        self.bins = collections.Counter()
+        self.registers = collections.Counter()
+        self.retired = 0
+
+    def retire(self, cycle, pc, code, *state):
+        self.retired += 1
+        opcode = code[0]
+        if opcode not in SIZES:
+            return
+        if operand_slots(opcode) == 0:
+            self.bins[(opcode, None, None)] += 1
+        for slot in range(operand_slots(opcode)):
+            (mode, value) = (code[slot * 2 + 1], code[slot * 2 + 2])
+            self.bins[(opcode, slot, mode)] += 1
+            if mode in [Argument.REG, Argument.IND]:
+                self.registers[value] += 1
+
+    def update(self, other):
+        self.bins.update(other.bins)
+        self.registers.update(other.registers)
+        self.retired += other.retired
+
+
+# Counter increments of a retired instruction as (counter, slots read, slots
+# written), with None for the stack. Written out from the operand comments of
+# Operation instead of taken from codes.counter_events: Cpu, PipelinedCpu and
+# IsaSim all count with that, so comparing them can not find a mistake in it.
+def recount_events(opcode):
+    if opcode in [Operation.NOT, Operation.NEG, Operation.ABS, Operation.COPY]:
+        return (Argument.CNT_ALU, [0], [1])
+    if opcode == Operation.CMP:
+        return (Argument.CNT_ALU, [0, 1], [])
+    if opcode in [Operation.INC, Operation.DEC]:
+        return (Argument.CNT_ALU, [0], [0])
+    if Operation.AND <= opcode <= Operation.SHL:
+        return (Argument.CNT_ALU, [0, 1], [2])
+    if Operation.JUMP <= opcode <= Operation.JNZ:
+        return (Argument.CNT_JUMP, [0], [])
+    if opcode == Operation.CALL:
+        return (Argument.CNT_CALL, [0], [])
+    if opcode in [Operation.RET, Operation.RETI]:
+        return (Argument.CNT_CALL, [], [])
+    if opcode == Operation.PUSH:
+        return (Argument.CNT_STACK, [0], [None])
+    if opcode == Operation.POP:
+        return (Argument.CNT_STACK, [None], [0])
+    return (None, [], [])
+
+
+RECOUNTED = [Argument.CNT_RETIRED, Argument.CNT_ALU, Argument.CNT_JUMP, Argument.CNT_CALL, Argument.CNT_STACK,
+             Argument.CNT_MEM_READS, Argument.CNT_MEM_WRITES]
+
+
+# Counts what the instructions that retire in IsaSim add to the counters, as
+# its trace, and passes them on to coverage
+class Recount:
+    def __init__(self, word_size, coverage=None):
+        self.mask = (1 << word_size) - 1
+        self.coverage = coverage
+        self.counters = collections.Counter()
+
+    def retire(self, cycle, pc, code, *state):
+        if self.coverage is not None:
+            self.coverage.retire(cycle, pc, code, *state)
+        (counter, reads, writes) = recount_events(code[0])
+        self.counters[Argument.CNT_RETIRED] += 1
+        if counter is not None:
+            self.counters[counter] += 1
+        for (slots, event) in [(reads, Argument.CNT_MEM_READS), (writes, Argument.CNT_MEM_WRITES)]:
+            for slot in slots:
+                if slot is None or code[slot * 2 + 1] in [Argument.IND, Argument.RAM]:
+                    self.counters[event] += 1
+
+    def diff(self, counters):
+        differences = []
+        for counter in RECOUNTED:
+            (value, expected) = (counters[counter - Argument._FIRST_COUNTER], self.counters[counter] & self.mask)
+            if value != expected:
+                differences.append(f"{Argument.lookup(counter)}: {value} != {expected} recounted")
+        return differences
+
+
+# A random program is a list of (opcode, operands), where an operand is a
+# (mode, value) or ("label", index) for the address of the instruction at
+# index. It starts by pointing R0 to R7 above the code, where the RAM
+# operands and the stack are, then runs length random instructions and
+# halts. With interrupts, a random handler ending in RETI follows.
+def generate(rng, length=32, word_size=8, ram_size=256, interrupts=False):
+    mask = (1 << word_size) - 1
+    code_size = ram_size // 2
+    program = []
+
+    def word():
+        return rng.choice([0, 1, mask, 1 << (word_size - 1), rng.randint(0, mask)])
+
+    def address():
+        return rng.randint(code_size, ram_size - 1)
+
+    def instruction(opcode, targets):
+        (kind, expr, location, flags, size) = OPS[opcode]
+        operands = []
+        for slot in range(operand_slots(opcode)):
+            mode = rng.choice(slot_modes(opcode, slot))
+            if kind in ["jump", "call"]:
+                operands.append(("label", rng.choice(targets)))
+            elif mode == Argument.REG and slot == location:
+                operands.append((mode, rng.choice(WRITABLE + (WRITABLE_CONTROLS if interrupts else []))))
+            elif mode == Argument.REG:
+                operands.append((mode, rng.choice(sorted(register_bins(interrupts)))))
+            elif mode == Argument.IMM:
+                operands.append((mode, word()))
+            elif mode == Argument.IND:
+                operands.append((mode, rng.choice(POINTERS + [Argument.SP])))
+            else:
+                operands.append((mode, address()))
+        return (opcode, operands)
+
+    for register in POINTERS:
+        program.append((Operation.COPY, [(Argument.IMM, address() if rng.random() < 0.75 else word()),
+                                         (Argument.REG, register)]))
+    if interrupts:
+        program.append((Operation.COPY, [("label", None), (Argument.REG, Argument.IVEC)]))
+
+    handler = []
+    if interrupts:
+        handler_opcodes = [opcode for opcode in opcodes(interrupts) if OPS[opcode][0] in HANDLER_KINDS]
+        handler = [instruction(rng.choice(handler_opcodes), []) for index in range(rng.randint(1, 4))]
+        handler.append((Operation.RETI, []))
+
+    # Jumps go anywhere in the body or to its HALT, mostly forwards so that
+    # few programs spend all their cycles in a loop
+    body_opcodes = [opcode for opcode in opcodes(interrupts) if OPS[opcode][0] not in ["halt", "reti"]]
+    start = len(program)
+    budget = code_size - sum(SIZES[opcode] for (opcode, operands) in program + handler) - SIZES[Operation.HALT]
+    body = []
+    for index in range(length):
+        first = start + index + 1 if rng.random() < 0.8 else start
+        (opcode, operands) = instruction(rng.choice(body_opcodes), list(range(first, start + length + 1)))
+        budget -= SIZES[opcode]
+        if budget < 0:
+            break
+        body.append((opcode, operands))
+    # Jumps past a body cut short by the budget go to the HALT
+    halt = start + len(body)
+    body = [(opcode, [(mode, min(value, halt)) if mode == "label" else (mode, value) for (mode, value) in operands])
+            for (opcode, operands) in body]
+    program += body + [(Operation.HALT, [])]
+
+    if interrupts:
+        program[start - 1] = (Operation.COPY, [("label", len(program)), (Argument.REG, Argument.IVEC)])
+        program += handler
+    inputs = [word() for index in range(16)]
+    return (program, inputs)
+
+
+def format_operand(mode, value):
+    if mode == "label":
+        return f"l{value}"
+    elif mode == Argument.REG:
+        return Argument.lookup(value).lower()
+    elif mode == Argument.IMM:
+        return f"#{value:#x}"
+    elif mode == Argument.IND:
+        return f"[{Argument.lookup(value).lower()}]"
+    return f"[#{value:#x}]"
+
+
+# Assembly source of a program, with a label on every jump target
+def render(program):
+    targets = {value for (opcode, operands) in program for (mode, value) in operands if mode == "label"}
+    lines = []
+    for (index, (opcode, operands)) in enumerate(program):
+        if index in targets:
+            lines.append(f"l{index}:")
+        lines.append("    " + " ".join([Operation.lookup(opcode).lower()] +
+                                       [format_operand(mode, value) for (mode, value) in operands]))
+    if len(program) in targets:
+        lines.append(f"l{len(program)}:")
+    return "\n".join(lines) + "\n"
+
+
+# Removes the instructions from start to stop, moving the labels on them to
+# the next instruction
+def remove(program, start, stop):
+    def move(value):
+        return value if value < start else start if value < stop else value - (stop - start)
+
+    return [(opcode, [(mode, move(value)) if mode == "label" else (mode, value) for (mode, value) in operands])
+            for (opcode, operands) in program[:start] + program[stop:]]
+
+
+# Removes halves, quarters and so on of a failing program for as long as it
+# still fails
+def shrink(program, fails):
+    size = len(program) // 2
+    while size >= 1:
+        start = 0
+        while start < len(program):
+            candidate = remove(program, start, min(start + size, len(program)))
+            if len(candidate) > 0 and fails(candidate):
+                program = candidate
+            else:
+                start += size
+        size //= 2
+    return program
+
+
+# Worker processes keep the elaborated Cpu between programs
+sessions = {}
+
+
+def run_cpu(rom, inputs, max_cycles, backend, options):
+    if backend == "cxxrtl":
+        model = CxxrtlCpu(rom, **options)
+        outputs = []
+        cycles = model.run(inputs, outputs.append, max_cycles)
+        return (outputs, model.drive(read_checkpoint(model.dut, cycles)))
+    key = json.dumps(options, sort_keys=True)
+    if key not in sessions:
+        sessions[key] = CpuSession(Cpu, **options)
+    result = sessions[key].run(rom, inputs, max_cycles, checkpoint=True)
+    return (result["outputs"], result["checkpoint"])
+
+
+# Runs a program on Cpu and on IsaSim, and returns the differences of their
+# outputs and final states, and the cycles run. IsaSim is not independent of
+# Cpu everywhere, as both decode with the tables of codes.py, so its counters
+# are also checked against a recount of the instructions it retired. Taken
+# jumps, input stalls and WAIT cycles are only compared between the two.
+def compare(program, inputs, max_cycles, backend, options, coverage=None):
+    word_size = options.get("word_size", 8)
+    endian = options.get("endian", "little")
+    (rom, source_map) = assemble(list(tokenize(render(program).splitlines())), word_size=word_size, endian=endian)
+
+    recount = Recount(word_size, coverage)
+    isa = IsaSim(rom, word_size, options.get("ram_size", 256), endian, options.get("interrupts", False), recount)
+    isa.set_inputs(inputs)
+    isa.run(max_ticks=max_cycles)
+    (outputs, state) = run_cpu(rom, inputs, max_cycles, backend, options)
+
+    differences = state.diff(isa.checkpoint()) + recount.diff(isa.counters)
+    if state.cycles != isa.cycles:
+        differences.insert(0, f"cycles: {state.cycles} != {isa.cycles}")
+    if outputs != isa.outputs:
+        differences.insert(0, f"outputs: {outputs} != {isa.outputs}")
+    return (differences, isa.cycles)
+
+
+def check(program, inputs, max_cycles, backend, options):
+    try:
+        return compare(program, inputs, max_cycles, backend, options)[0]
+    except Exception as e:
+        return [f"{e.__class__.__name__}: {e}"]
+
+
+# Runs count programs in a worker process. Every program has its own seed,
+# so a failure can be generated again from its name alone.
+def run_shard(seed, shard, count, length, max_cycles, backend, options, build_dir):
+    start = time.perf_counter()
+    coverage = Coverage()
+    summary = {"shard": shard, "programs": 0, "cycles": 0, "failures": []}
+    for number in range(count):
+        name = f"fuzz_{seed}_{shard}_{number}"
+        (program, inputs) = generate(random.Random(name), length, options.get("word_size", 8),
+                                     options.get("ram_size", 256), options.get("interrupts", False))
+        try:
+            (differences, cycles) = compare(program, inputs, max_cycles, backend, options, coverage)
+            summary["cycles"] += cycles
+        except Exception as e:
+            differences = [f"{e.__class__.__name__}: {e}"]
+        summary["programs"] += 1
+
+        if len(differences) > 0:
+            # Saved like the programs of regression.py, so a failure can be kept as a test
+            program = shrink(program, lambda candidate: len(check(candidate, inputs, max_cycles, backend,
+                                                                  options)) > 0)
+            os.makedirs(build_dir, exist_ok=True)
+            source = os.path.join(build_dir, name + ".s")
+            with open(source, "w") as ofs:
+                ofs.write(render(program))
+            with open(os.path.join(build_dir, name + ".in"), "w") as ofs:
+                ofs.write(" ".join(str(value) for value in inputs) + "\n")
+            summary["failures"].append({"name": name, "source": source, "instructions": len(program),
+                                        "differences": check(program, inputs, max_cycles, backend, options)})
+    summary["coverage"] = coverage
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def run_fuzz(seed, programs, shard_size, length, max_cycles, backend="rtl", options=None, build_dir="build/fuzz",
+             jobs=None):
+    options = options or {}
+    shards = (programs + shard_size - 1) // shard_size
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_shard, seed, shard, min(shard_size, programs - shard * shard_size), length,
+                               max_cycles, backend, options, build_dir) for shard in range(shards)]
+        for future in concurrent.futures.as_completed(futures):
+            summary = future.result()
+            failures = len(summary["failures"])
+            status = "PASS" if failures == 0 else f"FAIL ({failures})"
+            print(f"shard {summary['shard']:<5} {summary['programs']:6} programs {summary['coverage'].retired:10} "
+                  f"instructions {summary['seconds']:8.3f} s  {status}")
+            yield summary
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--programs", type=int, default=64, help="random programs to run")
+    ap.add_argument("-s", "--seed", type=int, default=None, help="defaults to a random one, which is printed")
+    ap.add_argument("-l", "--length", type=int, default=32, help="random instructions in a program")
+    ap.add_argument("--shard-size", type=int, default=8, help="programs a worker runs at a time")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, defaults to the number of cores")
+    ap.add_argument("-b", "--build", nargs=1, default=["build/fuzz"], help="failing programs are saved here")
+    ap.add_argument("-o", "--output", nargs=1, default=None, help="write a JSON summary to this file")
+    ap.add_argument("--cxxrtl", action="store_true", help="run Cpu as a model compiled with Yosys CXXRTL")
+    ap.add_argument("-w", "--word-size", type=int, default=8, choices=[8, 16, 32])
+    ap.add_argument("--endian", default="little", choices=ENDIANS, help="byte order of the words in the ROM")
+    ap.add_argument("-r", "--ram-size", type=int, default=256)
+    ap.add_argument("--interrupts", action="store_true", help="add the interrupt controller, WAIT and RETI")
+    ap.add_argument("--max-cycles", type=int, default=2000)
+    args = ap.parse_args()
+
+    # Only options where IsaSim is cycle accurate, so that the whole state can be compared
+    options = {"word_size": args.word_size, "endian": args.endian, "ram_size": args.ram_size}
+    if args.interrupts:
+        options.update(interrupts=True)
+    backend = "cxxrtl" if args.cxxrtl else "rtl"
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    print(f"Seed {seed}")
+
+    start = time.perf_counter()
+    if backend == "cxxrtl":
+        # Once here, instead of in every worker
+        prepare(**options)
+    results = sorted(run_fuzz(seed, args.programs, args.shard_size, args.length, args.max_cycles, backend, options,
+                              args.build[0], args.jobs), key=lambda summary: summary["shard"])
+    seconds = time.perf_counter() - start
+
+    coverage = Coverage()
+    for summary in results:
+        coverage.update(summary["coverage"])
+    failures = [failure for summary in results for failure in summary["failures"]]
+    for failure in failures:
+        print(f"{failure['name']}: {failure['instructions']} instructions, saved to {failure['source']}")
+        for difference in failure["differences"][:8]:
+            print(f"    {difference}")
+
+    bins = coverage_bins(args.interrupts)
+    missing = sorted(bins - set(coverage.bins), key=lambda entry: (entry[0], entry[1] or 0, entry[2] or 0))
+    registers = register_bins(args.interrupts)
+    print(f"Coverage: {len(bins) - len(missing)}/{len(bins)} opcode and mode combinations, "
+          f"{len(registers & set(coverage.registers))}/{len(registers)} registers")
+    if len(missing) > 0:
+        print(f"Not covered: {', '.join(bin_name(entry) for entry in missing[:20])}"
+              f"{', ...' if len(missing) > 20 else ''}")
+    programs = sum(summary["programs"] for summary in results)
+    print(f"{programs - len(failures)}/{programs} passed, {coverage.retired} instructions in {seconds:.3f} s")
+
+    if args.output:
+        with open(args.output[0], "w") as ofs:
+            json.dump({
+                "backend": backend,
+                "options": options,
+                "seed": seed,
+                "programs": programs,
+                "instructions": coverage.retired,
+                "covered": len(bins) - len(missing),
+                "bins": len(bins),
+                "missing": [bin_name(entry) for entry in missing],
+                "failures": failures,
+                "seconds": seconds,
+            }, ofs, indent=2)
+
+    sys.exit(0 if len(failures) == 0 else 1)
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import time
+
+from codes import Argument
+from codes import CFI, OFI, SFI, ZFI, SF, ZF
+from codes import NUM_ARGS_0, NUM_ARGS_3
+from codes import IRQ_INPUT, IRQ_OUTPUT, IRQ_TIMER, IRQ_SOFTWARE, IRQ_ALL
+from codes import ENDIANS, load_words
+from codes import OPS, alu_functions, counter_events, stores
+
+
+STATUS = Argument.STATUS
+
+
+# Where the instruction writes its result, from the registers before it runs:
+# (register, address), either of them None. The register is an operand number,
+# which is an interrupt control if there are any, and aliases the last
+# register otherwise. Both index the same way as the RTL.
+def destination(code, registers, ram_size, interrupts=False):
+    if code[0] not in OPS:
+        return (None, None)
+    (kind, expr, location, flags, size) = OPS[code[0]]
+    last_reg = Argument._NUM_REGS - 1
+    last_ram = ram_size - 1
+    if kind == "push":
+        return (None, min(registers[Argument.SP], last_ram))
+    if kind == "call":
+        return (Argument.LINK, None)
+    if location == 3:
+        return (None, None)
+    (mode, value) = (code[location * 2 + 1], code[location * 2 + 2])
+    if mode == Argument.REG:
+        return (value if interrupts and Argument.is_control(value) else min(value, last_reg), None)
+    elif mode == Argument.IND:
+        return (None, min(registers[min(value, last_reg)], last_ram))
+    elif mode == Argument.RAM:
+        return (None, min(value, last_ram))
+    return (None, None)
+
+
+# Complete architectural state between two clock cycles, which is what the test()
+# bench sees at the top of its loop. Can be moved between IsaSim and Cpu.
+class Checkpoint:
+    def __init__(self, cycles, registers, ram, hf=0, iocf=0, irf=1, owf=0, counters=None, controls=None, active=0):
+        self.cycles = cycles
+        self.registers = list(registers)
+        self.ram = list(ram)
+        self.counters = list(counters) if counters is not None else [0] * Argument._NUM_COUNTERS
+        self.controls = list(controls) if controls is not None else [0] * Argument._NUM_CONTROLS
+        self.active = active
+        self.hf = hf
+        self.iocf = iocf
+        self.irf = irf
+        self.owf = owf
+
+    def save(self, path):
+        with open(path, "w") as ofs:
+            json.dump(vars(self), ofs)
+
+    @staticmethod
+    def load(path):
+        with open(path, "r") as ifs:
+            return Checkpoint(**json.load(ifs))
+
+    def diff(self, other):
+        differences = []
+        for name in ["hf", "iocf", "irf", "owf", "active"]:
+            if getattr(self, name) != getattr(other, name):
+                differences.append(f"{name}: {getattr(self, name)} != {getattr(other, name)}")
+        for (index, (a, b)) in enumerate(zip(self.registers, other.registers)):
+            if a != b:
+                differences.append(f"{Argument.lookup(index).lower()}: {a:02X} != {b:02X}")
+        for (index, (a, b)) in enumerate(zip(self.counters, other.counters)):
+            if a != b:
+                differences.append(f"{Argument.lookup(Argument._FIRST_COUNTER + index).lower()}: {a:02X} != {b:02X}")
+        for (index, (a, b)) in enumerate(zip(self.controls, other.controls)):
+            if a != b:
+                differences.append(f"{Argument.lookup(Argument._FIRST_CONTROL + index).lower()}: {a:02X} != {b:02X}")
+        for (index, (a, b)) in enumerate(zip(self.ram, other.ram)):
+            if a != b:
+                differences.append(f"ram[{index:03X}]: {a:02X} != {b:02X}")
+        return differences
+
+
+# Instruction set level model of Cpu. Every call to step() is one clock cycle of
+# Cpu.elaborate(), including the quirks of the current RTL (the S flag is bit 0
+# of the result, C and O are never set, CMP computes a0 % a1, POP adds one, and
+# out of range register and RAM indices alias the last entry), so that final
+# registers and RAM can be compared one to one with the Amaranth simulation.
+#
+# Each distinct instruction encoding is translated once from the OPS table into
+# a small Python function, which is what makes the model fast.
+#
+# With interrupts set it also models the interrupt controller of Cpu. There are
+# no FIFOs here, so the input and output sources are always pending. A WAIT that
+# only the timer can end is skipped over in one go by run().
+#
+# With a trace, such as a retire_trace.RetireWriter, every retired instruction
+# is passed to trace.retire().
+class IsaSim:
+    def __init__(self, rom_file="build/rom_file", word_size=8, ram_size=256, endian="little", interrupts=False,
+                 trace=None):
+        self.word_size = word_size
+        self.ram_size = ram_size + 6
+        self.mask = (1 << word_size) - 1
+        self.interrupts = interrupts
+        self.trace = trace
+
+        # Same loader as Cpu, word_size / 8 bytes per word
+        self.rom = list(load_words(rom_file, word_size, endian))
+        self.rom_size = len(self.rom)
+
+        self.registers = [0] * Argument._NUM_REGS
+        self.counters = [0] * Argument._NUM_COUNTERS
+        self.controls = [0] * Argument._NUM_CONTROLS
+        self.ram = [0] * self.ram_size
+        self.inputs = iter(())
+        self.outputs = []
+        self.translations = {}
+        self.decoded = {}
+        self.reset()
+
+    def reset(self):
+        self.registers[:] = [0] * Argument._NUM_REGS
+        self.registers[Argument.SP] = (self.ram_size - 7) & self.mask
+        self.counters[:] = [0] * Argument._NUM_COUNTERS
+        self.controls[:] = [0] * Argument._NUM_CONTROLS
+        self.ram[:] = self.rom + [0] * (self.ram_size - len(self.rom))
+        self.decoded.clear()
+        self.cycles = 0
+
+        self.hf = 0  # Halt flag
+        self.iocf = 0  # Illegal opcode flag
+        self.irf = 1  # Input read flag
+        self.owf = 0  # Output written flag
+        self.active = 0  # In the interrupt handler
+        self.sleeping = False  # The last cycle was a WAIT that did not wake up
+
+    def checkpoint(self):
+        return Checkpoint(self.cycles, self.registers, self.ram, self.hf, self.iocf, self.irf, self.owf,
+                          self.counters, self.controls, self.active)
+
+    def restore(self, checkpoint):
+        self.registers[:] = checkpoint.registers
+        self.counters[:] = checkpoint.counters
+        self.controls[:] = checkpoint.controls
+        self.ram[:] = checkpoint.ram
+        self.decoded.clear()
+        self.cycles = checkpoint.cycles
+        self.hf = checkpoint.hf
+        self.iocf = checkpoint.iocf
+        self.irf = checkpoint.irf
+        self.owf = checkpoint.owf
+        self.active = checkpoint.active
+        self.sleeping = False
+
+    def set_inputs(self, inputs):
+        self.inputs = iter(inputs)
+
+    def pc(self):
+        return self.registers[Argument.PC]
+
+    def tick(self):
+        return self.registers[Argument.TICK]
+
+    def counter(self, name):
+        return self.counters[Argument.get(name.upper()) - Argument._FIRST_COUNTER]
+
+    def _translate(self, code):
+        last_reg = Argument._NUM_REGS - 1
+        last_ram = self.ram_size - 1
+        # Addresses coming from registers only need clamping if RAM is smaller than the address space
+        clamp = self.mask > last_ram
+
+        def address(expr):
+            return f"min({expr}, {last_ram})" if clamp else expr
+
+        def control(number):
+            return f"K[{number - Argument._FIRST_CONTROL}]"
+
+        def operand(index):
+            mode = code[index * 2 + 1]
+            value = code[index * 2 + 2]
+            if mode == Argument.REG and Argument.is_counter(value):
+                return f"C[{value - Argument._FIRST_COUNTER}]"
+            elif mode == Argument.REG and self.interrupts and value == Argument.IP:
+                return f"({control(Argument.IP)} | {IRQ_INPUT | IRQ_OUTPUT})"
+            elif mode == Argument.REG and self.interrupts and Argument.is_control(value):
+                return control(value)
+            elif mode == Argument.REG:
+                return f"R[{min(value, last_reg)}]"
+            elif mode == Argument.IMM:
+                return f"{value}"
+            elif mode == Argument.IND:
+                return f"M[{address(f'R[{min(value, last_reg)}]')}]"
+            elif mode == Argument.RAM:
+                return f"M[{min(value, last_ram)}]"
+            return "0"
+
+        (kind, expr, location, flags, size) = OPS.get(code[0], ("illegal", None, 3, 0, 0))
+        if kind in ["wait", "reti"] and not self.interrupts:
+            (kind, expr, location, flags, size) = ("illegal", None, 3, 0, 0)
+        irf = any(code[index * 2 + 1] == Argument.REG and code[index * 2 + 2] == Argument.INPUT for index in range(3))
+        owf = 0
+        hf = 0
+        iocf = 0
+        input_written = False
+
+        reads = []
+        writes = []
+
+        if kind == "halt":
+            hf = 1
+        elif kind == "next":
+            writes.append(f"R[{Argument.PC}] = (pc + {size}) & MASK")
+        elif kind == "alu":
+            reads.append(f"res = ({expr.format(a=operand(0), b=operand(1))}) & MASK")
+            writes.append(f"R[{Argument.PC}] = (pc + {size}) & MASK")
+        elif kind == "jump":
+            reads.append(f"taken = {expr}")
+            writes.append(f"R[{Argument.PC}] = {operand(0)} if taken else (pc + {size}) & MASK")
+        elif kind == "call":
+            reads.append(f"target = {operand(0)}")
+            writes.append(f"R[{Argument.LINK}] = (pc + {size}) & MASK")
+            writes.append(f"R[{Argument.PC}] = target")
+        elif kind == "ret":
+            writes.append(f"R[{Argument.PC}] = R[{Argument.LINK}]")
+        elif kind == "push":
+            reads.append(f"value = {operand(0)}")
+            reads.append(f"sp = R[{Argument.SP}]")
+            writes.append(f"M[{address('sp')}] = value")
+            writes.append(f"invalidate({address('sp')})")
+            writes.append(f"R[{Argument.SP}] = (sp - 1) & MASK")
+            writes.append(f"R[{Argument.PC}] = (pc + {size}) & MASK")
+        elif kind == "pop":
+            reads.append(f"sp = R[{Argument.SP}]")
+            reads.append(f"res = (M[{address('sp')}] + 1) & MASK")
+            writes.append(f"R[{Argument.SP}] = (sp + 1) & MASK")
+            writes.append(f"R[{Argument.PC}] = (pc + {size}) & MASK")
+        elif kind == "wait":
+            pending = f"({control(Argument.IP)} | {IRQ_INPUT | IRQ_OUTPUT})"
+            reads.append(f"awake = {pending} & {control(Argument.IE)} & {IRQ_ALL}")
+            writes.append(f"if awake: R[{Argument.PC}] = (pc + {size}) & MASK")
+            writes.append("else: S.sleeping = True")
+        elif kind == "reti":
+            writes.append(f"R[{STATUS}] = {control(Argument.ESTATUS)}")
+            writes.append(f"R[{Argument.PC}] = {control(Argument.EPC)}")
+            writes.append("S.active = 0")
+        else:
+            iocf = 1
+            hf = 1
+
+        # Write the result, to a location resolved before anything else is written
+        if location < 3:
+            mode = code[location * 2 + 1]
+            value = code[location * 2 + 2]
+            if mode == Argument.REG and self.interrupts and value == Argument.IP:
+                writes.append(f"{control(value)} = res & {IRQ_TIMER | IRQ_SOFTWARE}")
+            elif mode == Argument.REG and self.interrupts and Argument.is_control(value):
+                writes.append(f"{control(value)} = res")
+            elif mode == Argument.REG:
+                writes.append(f"R[{min(value, last_reg)}] = res")
+                owf = int(value == Argument.OUTPUT)
+                input_written = value == Argument.INPUT
+            elif mode == Argument.IND:
+                reads.append(f"dest = {address(f'R[{min(value, last_reg)}]')}")
+                writes.append("M[dest] = res")
+                writes.append("invalidate(dest)")
+            elif mode == Argument.RAM:
+                writes.append(f"M[{min(value, last_ram)}] = res")
+                writes.append(f"invalidate({min(value, last_ram)})")
+            else:
+                iocf = 1
+                hf = 1
+
+        if flags & (SF | ZF):
+            update = [f"R[{STATUS}] & {~(flags & (SF | ZF))}"]
+            if flags & SF:
+                update.append(f"((res & 1) << {SFI})")
+            if flags & ZF:
+                update.append(f"((res == 0) << {ZFI})")
+            writes.append(f"R[{STATUS}] = " + " | ".join(update))
+
+        # Performance counters, with the hf and irf of the previous cycle
+        def count(number, increment=1):
+            index = number - Argument._FIRST_COUNTER
+            return f"C[{index}] = (C[{index}] + {increment}) & MASK"
+
+        counts = [count(number, increment) for (number, increment) in counter_events(code[0], code[1::2]).items()
+                  if increment != 0]
+        if kind == "jump":
+            counts.append(f"if taken: {count(Argument.CNT_TAKEN)}")
+            counts.append(f"else: {count(Argument.CNT_NOT_TAKEN)}")
+        if irf:
+            counts.append(f"if irf: {count(Argument.CNT_INPUT_STALLS)}")
+        if kind == "wait":
+            counts = [f"if awake and {line[len('if '):]}" if line.startswith("if ") else f"if awake: {line}"
+                      for line in counts] + [f"if not awake: {count(Argument.CNT_WAIT)}"]
+
+        lines = ["halted = S.hf", "irf = S.irf"]
+        lines += [f"S.irf = {int(irf)}", f"S.owf = {owf}", f"S.hf = {hf}"]
+        if iocf:
+            lines.append("S.iocf = 1")
+        lines += reads
+        lines.append(f"R[{Argument.OUTPUT}] = 0")
+        lines += writes
+        lines.append(f"if halted: {count(Argument.CNT_HALTED)}")
+        lines.append("else:")
+        lines += ["    " + line for line in counts]
+        lines.append(f"return {input_written}")
+
+        namespace = {
+            "S": self,
+            "R": self.registers,
+            "M": self.ram,
+            "C": self.counters,
+            "K": self.controls,
+            "invalidate": self._invalidate,
+            **alu_functions(self.word_size),
+        }
+        exec("def handler(pc):\n    " + "\n    ".join(lines), namespace)
+        handler = namespace["handler"]
+        handler.code = code
+        handler.stores = stores(code[0], code[1::2])
+        handler.waits = kind == "wait"
+        return handler
+
+    def _decode(self, pc):
+        # Instruction bytes past the end of RAM read the last entry, like the RTL
+        code = tuple(self.ram[min(pc + index, self.ram_size - 1)] for index in range(NUM_ARGS_3))
+        handler = self.translations.get(code)
+        if handler is None:
+            handler = self._translate(code)
+            self.translations[code] = handler
+        self.decoded[pc] = handler
+        return handler
+
+    # Drop decoded instructions that overlap a RAM write, for self-modifying code
+    def _invalidate(self, address):
+        decoded = self.decoded
+        for pc in range(address - NUM_ARGS_3 + 1, address + 1):
+            decoded.pop(pc, None)
+
+    def step(self):
+        registers = self.registers
+
+        # Same I/O handshake as the test() bench does between clock cycles. The
+        # bench writes INPUT from a sync process, so the new value only shows up
+        # after this cycle, and only if the instruction did not write INPUT itself.
+        next_input = next(self.inputs, 0) if self.irf else None
+        if self.owf:
+            self.outputs.append(registers[Argument.OUTPUT])
+
+        pc = registers[Argument.PC]
+        tick = registers[Argument.TICK]
+
+        handler = self.decoded.get(pc)
+        if handler is None:
+            handler = self._decode(pc)
+
+        if self.trace is not None:
+            retired = self.counters[0]  # CNT_RETIRED
+            (register, address) = destination(handler.code, registers, self.ram_size, self.interrupts)
+
+        if self.interrupts and self._interrupt(handler):
+            self._enter(pc, handler)
+            if next_input is not None:
+                registers[Argument.INPUT] = next_input
+        elif not handler(pc) and next_input is not None:
+            registers[Argument.INPUT] = next_input
+
+        if self.interrupts and tick == self.controls[Argument.TIMER - Argument._FIRST_CONTROL]:
+            self.controls[Argument.IP - Argument._FIRST_CONTROL] |= IRQ_TIMER
+        registers[Argument.TICK] = (tick + 1) & self.mask
+        if self.trace is not None and self.counters[0] != retired:
+            self.trace.retire(self.cycles, pc, handler.code, register, address, registers, self.controls, self.ram,
+                              self.hf, self.iocf, self.irf, self.owf)
+        self.cycles += 1
+
+    def _pending(self):
+        controls = self.controls
+        pending = controls[Argument.IP - Argument._FIRST_CONTROL] | IRQ_INPUT | IRQ_OUTPUT
+        return pending & controls[Argument.IE - Argument._FIRST_CONTROL] & IRQ_ALL
+
+    def _interrupt(self, handler):
+        return not self.active and not self.hf and not handler.stores and self._pending() != 0
+
+    # Takes the interrupt instead of running the instruction at pc, which runs
+    # again after RETI. A WAIT is done once an interrupt arrives, so RETI
+    # returns past it.
+    def _enter(self, pc, handler):
+        registers = self.registers
+        controls = self.controls
+        self.irf = 0
+        self.owf = 0
+        registers[Argument.OUTPUT] = 0
+        controls[Argument.EPC - Argument._FIRST_CONTROL] = (pc + NUM_ARGS_0) & self.mask if handler.waits else pc
+        controls[Argument.ESTATUS - Argument._FIRST_CONTROL] = registers[STATUS]
+        registers[Argument.PC] = controls[Argument.IVEC - Argument._FIRST_CONTROL]
+        self.active = 1
+
+    # Cycles that a sleeping WAIT can be skipped without any change but TICK,
+    # the cycle count and CNT_WAIT, or None if nothing can wake it up
+    def _sleep_cycles(self):
+        if self._pending() != 0:
+            return 0
+        if not self.controls[Argument.IE - Argument._FIRST_CONTROL] & IRQ_TIMER:
+            return None
+        # The timer fires in the cycle where TICK equals TIMER, and wakes the next one
+        return (self.controls[Argument.TIMER - Argument._FIRST_CONTROL] - self.registers[Argument.TICK]) & self.mask
+
+    def run(self, max_ticks=None, until_pc=None):
+        step = self.step
+        registers = self.registers
+        ticks = 0
+        while not self.hf:
+            if max_ticks is not None and ticks >= max_ticks:
+                break
+            if until_pc is not None and ticks > 0 and registers[Argument.PC] == until_pc:
+                break
+            step()
+            ticks += 1
+
+            if self.sleeping:
+                self.sleeping = False
+                skip = self._sleep_cycles()
+                if max_ticks is not None:
+                    skip = max_ticks - ticks if skip is None else min(skip, max_ticks - ticks)
+                elif skip is None:
+                    break
+                registers[Argument.TICK] = (registers[Argument.TICK] + skip) & self.mask
+                index = Argument.CNT_WAIT - Argument._FIRST_COUNTER
+                self.counters[index] = (self.counters[index] + skip) & self.mask
+                self.cycles += skip
+                ticks += skip
+        return ticks
+
+    def print_state(self):
+        digits = self.word_size // 4
+        print(f"h: {self.hf} ioc: {self.iocf} ir: {self.irf} ow: {self.owf}   ", end="")
+        for index in range(Argument._NUM_REGS):
+            if index != 0 and index % 4 == 0:
+                print(" ", end="")
+            print(f"{Argument.lookup(index).lower()}: {self.registers[index]:0{digits}X} ", end="")
+        print()
+        for (index, value) in enumerate(self.counters):
+            print(f"{Argument.lookup(Argument._FIRST_COUNTER + index).lower()}: {value} ", end="")
+        print()
+        if self.interrupts:
+            for (index, value) in enumerate(self.controls):
+                print(f"{Argument.lookup(Argument._FIRST_CONTROL + index).lower()}: {value:0{digits}X} ", end="")
+            print(f"active: {self.active}")
+
+        header = "".join((" " if index == 8 else "") + f"{index:>{digits + 1}X}" for index in range(16))
+        print(f"RAM dump:\n    {header}\n{0:03X}: ", end="")
+        for index in range(self.ram_size):
+            if index != 0 and index % 16 == 0:
+                print(f"\n{index:03X}: ", end="")
+            elif index != 0 and index % 8 == 0:
+                print(" ", end="")
+            print(f"{self.ram[index]:0{digits}X} ", end="")
+        print()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("-w", "--word-size", type=int, default=8)
+    ap.add_argument("-r", "--ram-size", type=int, default=256)
+    ap.add_argument("--endian", default="little", choices=ENDIANS, help="byte order of the words in the ROM")
+    ap.add_argument("--inputs", type=lambda s: int(s, 0), nargs="*", default=[])
+    ap.add_argument("--outputs", type=lambda s: int(s, 0), nargs="*", default=None)
+    ap.add_argument("--max-ticks", type=int, default=None)
+    ap.add_argument("--interrupts", action="store_true", help="model the interrupt controller")
+    ap.add_argument("--retire-trace", default=None, help="write every retired instruction to this binary file")
+    ap.add_argument("-q", "--quiet", action="store_true")
+    args = ap.parse_args()
+
+    trace = None
+    if args.retire_trace is not None:
+        # Imported here, because it builds on IsaSim
+        from retire_trace import RetireWriter
+        trace = RetireWriter(args.retire_trace, args.word_size)
+
+    sim = IsaSim(args.input[0], word_size=args.word_size, ram_size=args.ram_size, endian=args.endian,
+                 interrupts=args.interrupts, trace=trace)
+    sim.set_inputs(args.inputs)
+
+    start = time.perf_counter()
+    ticks = sim.run(max_ticks=args.max_ticks)
+    elapsed = time.perf_counter() - start
+    if trace is not None:
+        trace.close()
+        print(f"Traced {trace.written} instructions to {trace.path}")
+
+    if not args.quiet:
+        sim.print_state()
+    for value in sim.outputs:
+        print(f"Read output: {value:0{args.word_size // 4}X}")
+    print(f"{'Program halted' if sim.hf else 'Stopped'} after {ticks} ticks in {elapsed:.3f} s "
+          f"({ticks / elapsed if elapsed > 0 else 0:.0f} ticks/s)")
+
+    if args.outputs is not None:
+        assert sim.outputs == args.outputs, f"Expected outputs {args.outputs}, got {sim.outputs}"
@@ -0,0 +1,193 @@
+import amaranth as am
+from amaranth.build import Platform
+
+
+# Signals of a classic Wishbone bus, seen from the master. A cycle lasts from
+# cyc and stb going high until the slave answers with ack, which is high for
+# one cycle and carries dat_r for reads.
+class WishboneBus:
+    def __init__(self, word_size, addr_width, name="bus"):
+        self.adr = am.Signal(addr_width, name=f"{name}_adr")
+        self.dat_w = am.Signal(word_size, name=f"{name}_dat_w")
+        self.dat_r = am.Signal(word_size, name=f"{name}_dat_r")
+        self.we = am.Signal(name=f"{name}_we")
+        self.cyc = am.Signal(name=f"{name}_cyc")
+        self.stb = am.Signal(name=f"{name}_stb")
+        self.ack = am.Signal(name=f"{name}_ack")
+
+
+# Gives the bus to the lowest numbered master that wants it, and keeps it with
+# that master until its cycle is acknowledged
+class Arbiter(am.Elaboratable):
+    def __init__(self, masters, word_size, addr_width):
+        self.masters = masters
+        self.bus = WishboneBus(word_size, addr_width, "arbiter")
+
+    def elaborate(self, platform: Platform):
+        m = am.Module()
+
+        owner = am.Signal(range(len(self.masters)))
+        locked = am.Signal()
+        grant = am.Signal(range(len(self.masters)))
+        m.d.comb += grant.eq(owner)
+        with m.If(~locked):
+            for index in reversed(range(len(self.masters))):
+                with m.If(self.masters[index].cyc):
+                    m.d.comb += grant.eq(index)
+
+        with m.If(self.bus.cyc & ~self.bus.ack):
+            m.d.sync += locked.eq(1)
+            m.d.sync += owner.eq(grant)
+        with m.Else():
+            m.d.sync += locked.eq(0)
+
+        with m.Switch(grant):
+            for (index, master) in enumerate(self.masters):
+                with m.Case(index):
+                    m.d.comb += self.bus.adr.eq(master.adr)
+                    m.d.comb += self.bus.dat_w.eq(master.dat_w)
+                    m.d.comb += self.bus.we.eq(master.we)
+                    m.d.comb += self.bus.cyc.eq(master.cyc)
+                    m.d.comb += self.bus.stb.eq(master.stb)
+                    m.d.comb += master.ack.eq(self.bus.ack)
+        for master in self.masters:
+            m.d.comb += master.dat_r.eq(self.bus.dat_r)
+        return m
+
+
+# Wishbone slave in front of a Memory. An access takes latency + 2 cycles,
+# counting the cycle of the request and the one with ack.
+class BackingMemory(am.Elaboratable):
+    def __init__(self, memory, addr_width, latency=2):
+        self.memory = memory
+        self.latency = latency
+        self.bus = WishboneBus(memory.width, addr_width, "memory")
+
+    def elaborate(self, platform: Platform):
+        m = am.Module()
+        bus = self.bus
+
+        m.submodules.read = read = self.memory.read_port(transparent=False)
+        m.submodules.write = write = self.memory.write_port()
+        m.d.comb += read.addr.eq(bus.adr)
+        m.d.comb += write.addr.eq(bus.adr)
+        m.d.comb += write.data.eq(bus.dat_w)
+        m.d.comb += bus.dat_r.eq(read.data)
+
+        wait = am.Signal(range(self.latency + 1))
+        with m.If(bus.ack):
+            m.d.sync += bus.ack.eq(0)
+            m.d.sync += wait.eq(0)
+        with m.Elif(bus.cyc & bus.stb):
+            with m.If(wait == self.latency):
+                m.d.sync += bus.ack.eq(1)
+                m.d.comb += write.en.eq(bus.we)
+            with m.Else():
+                m.d.sync += wait.eq(wait + 1)
+        return m
+
+
+# Direct-mapped, read-only cache with several read ports. A port that is read
+# and hits keeps its word until release, so an access stays a hit while other
+# ports refill lines over it. When any read port misses, the line of the first
+# one is refilled from the bus one word at a time. Writes go around the cache,
+# update only changes the word if its line is present.
+class Cache(am.Elaboratable):
+    def __init__(self, word_size, addr_width, lines, line_size, ports, name="cache"):
+        assert lines & (lines - 1) == 0 and line_size & (line_size - 1) == 0, "cache sizes must be powers of two"
+        assert lines * line_size <= 1 << addr_width, "cache is larger than the address space"
+        self.word_size = word_size
+        self.lines = lines
+        self.line_size = line_size
+        self.offset_bits = line_size.bit_length() - 1
+        self.low_bits = self.offset_bits + lines.bit_length() - 1
+
+        self.bus = WishboneBus(word_size, addr_width, name)
+
+        self.addr = [am.Signal(addr_width, name=f"{name}_addr{index}") for index in range(ports)]
+        self.data = [am.Signal(word_size, name=f"{name}_data{index}") for index in range(ports)]
+        self.read = am.Signal(ports)
+        self.hit = am.Signal(ports)
+        self.miss = am.Signal()
+        self.release = am.Signal()
+
+        self.update = am.Signal()
+        self.update_addr = am.Signal(addr_width)
+        self.update_data = am.Signal(word_size)
+
+        # Read ports that hit or missed, counted at release
+        self.hits = am.Signal(32, name=f"{name}_hits")
+        self.misses = am.Signal(32, name=f"{name}_misses")
+
+        self.words = am.Memory(width=word_size, depth=lines * line_size)
+        self.tags = am.Memory(width=max(addr_width - self.low_bits, 1), depth=lines)
+        self.valid = am.Signal(lines)
+
+    def lookup(self, m, address, name):
+        hit = am.Signal(name=f"{name}_lookup_hit")
+        word = am.Signal(self.word_size, name=f"{name}_lookup")
+        line = address[self.offset_bits:self.low_bits]
+        m.d.comb += hit.eq(self.valid.bit_select(line, 1) & (self.tags[line] == address[self.low_bits:]))
+        m.d.comb += word.eq(self.words[address[:self.low_bits]])
+        return (hit, word)
+
+    def elaborate(self, platform: Platform):
+        m = am.Module()
+        ports = len(self.addr)
+
+        held = am.Signal(ports)
+        missed = am.Signal(ports)
+        for index in range(ports):
+            (hit, word) = self.lookup(m, self.addr[index], f"port{index}")
+            held_word = am.Signal(self.word_size, name=f"held{index}")
+            m.d.comb += self.hit[index].eq(held[index] | hit)
+            m.d.comb += self.data[index].eq(am.Mux(held[index], held_word, word))
+            with m.If(~self.release & self.read[index] & ~held[index] & hit):
+                m.d.sync += held[index].eq(1)
+                m.d.sync += held_word.eq(word)
+
+        pending = self.read & ~self.hit
+        m.d.comb += self.miss.eq(pending != 0)
+        first = am.Signal(range(ports))
+        for index in reversed(range(ports)):
+            with m.If(pending[index]):
+                m.d.comb += first.eq(index)
+
+        with m.If(self.release):
+            m.d.sync += held.eq(0)
+            m.d.sync += missed.eq(0)
+            m.d.sync += self.hits.eq(self.hits + sum((self.read & ~missed)[index] for index in range(ports)))
+            m.d.sync += self.misses.eq(self.misses + sum((self.read & missed)[index] for index in range(ports)))
+
+        # Refill
+        busy = am.Signal()
+        base = am.Signal.like(self.bus.adr)
+        count = am.Signal(range(self.line_size))
+        line = base[self.offset_bits:self.low_bits]
+        m.d.comb += self.bus.adr.eq(base | count)
+        m.d.comb += self.bus.cyc.eq(busy)
+        m.d.comb += self.bus.stb.eq(busy)
+        with m.If(busy):
+            with m.If(self.bus.ack):
+                m.d.sync += self.words[am.Cat(count, line)].eq(self.bus.dat_r)
+                m.d.sync += count.eq(count + 1)
+                with m.If(count == self.line_size - 1):
+                    m.d.sync += busy.eq(0)
+                    m.d.sync += self.valid.bit_select(line, 1).eq(1)
+        with m.Elif(self.miss):
+            address = am.Signal.like(base)
+            with m.Switch(first):
+                for index in range(ports):
+                    with m.Case(index):
+                        m.d.comb += address.eq(self.addr[index])
+            m.d.sync += busy.eq(1)
+            m.d.sync += base.eq(address >> self.offset_bits << self.offset_bits)
+            m.d.sync += count.eq(0)
+            m.d.sync += self.tags[address[self.offset_bits:self.low_bits]].eq(address[self.low_bits:])
+            m.d.sync += self.valid.bit_select(address[self.offset_bits:self.low_bits], 1).eq(0)
+            m.d.sync += missed.bit_select(first, 1).eq(1)
+
+        (hit, word) = self.lookup(m, self.update_addr, "update")
+        with m.If(self.update & hit):
+            m.d.sync += self.words[self.update_addr[:self.low_bits]].eq(self.update_data)
+        return m
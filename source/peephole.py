@@ -0,0 +1,430 @@
+import collections
+
+from codes import Argument, Operation, OPS, SF, ZF
+from codes import alu_functions, source_slots
+
+
+# Registers that only change when an instruction writes them
+STABLE = [Argument.R0, Argument.R1, Argument.R2, Argument.R3, Argument.R4, Argument.R5, Argument.R6, Argument.R7,
+          Argument.LINK, Argument.SP]
+
+# Instructions after which the next one only runs if it has a label
+UNCONDITIONAL = [Operation.JUMP, Operation.RET, Operation.RETI, Operation.HALT]
+
+
+class Label:
+    def __init__(self, name, line):
+        self.name = name
+        self.line = line
+
+
+# .byte and .word lines, and anything else that is not an instruction, which
+# the optimizer does not look into or move code across
+class Data:
+    def __init__(self, tokens, line):
+        self.tokens = tokens
+        self.line = line
+
+
+class Instruction:
+    def __init__(self, opcode, line, tokens):
+        self.opcode = opcode
+        self.line = line
+        self.tokens = tokens  # As written, or None once changed
+        self.operands = []  # (mode, value), or ("label", name) for a label
+        self.removed = False
+
+    def replace(self, opcode, operands):
+        self.opcode = opcode
+        self.operands = operands
+        self.tokens = None
+
+    @property
+    def kind(self):
+        return OPS[self.opcode][0] if self.opcode in OPS else "illegal"
+
+    @property
+    def words(self):
+        return 1 + 2 * len(self.operands)
+
+
+# Same operand syntax as layout() in assemble_rom.py
+def parse_operand(token):
+    upper = token.upper()
+    if Argument.contains(upper):
+        return (Argument.REG, Argument.get(upper))
+    elif token[0] == "#":
+        return (Argument.IMM, int(token[1:], 0))
+    elif token[0] == "[" and token[1] != "#" and token[-1] == "]" and Argument.contains(upper[1:-1]):
+        return (Argument.IND, Argument.get(upper[1:-1]))
+    elif token[0] == "[" and token[1] == "#" and token[-1] == "]":
+        return (Argument.RAM, int(token[2:-1], 0))
+    return ("label", token)
+
+
+def format_operand(mode, value):
+    if mode == "label":
+        return value
+    elif mode == Argument.REG:
+        return Argument.lookup(value).lower()
+    elif mode == Argument.IMM:
+        return f"#{value}"
+    elif mode == Argument.IND:
+        return f"[{Argument.lookup(value).lower()}]"
+    return f"[#{value}]"
+
+
+# Splits the tokens of tokenize() into labels, data and instructions, each
+# with the number of its line
+def parse(token_list):
+    items = []
+    line = 0
+    tokens = iter(token_list)
+    for token in tokens:
+        last = items[-1] if len(items) > 0 else None
+        if token == "\n":
+            line += 1
+        elif token.endswith(":"):
+            items.append(Label(token.strip(":"), line))
+        elif token in [".byte", ".word"]:
+            data = [token]
+            for token in tokens:
+                if token == "\n":
+                    break
+                data.append(token)
+            items.append(Data(data, line))
+            line += 1
+        elif Operation.contains(token.upper()):
+            items.append(Instruction(Operation.get(token.upper()), line, [token]))
+        elif isinstance(last, Instruction) and last.line == line:
+            last.operands.append(parse_operand(token))
+            last.tokens.append(token)
+        else:
+            items.append(Data([token], line))
+    return (items, line)
+
+
+# Tokens again, with every item on its own line, so the source map still
+# points to the right lines
+def unparse(items, lines):
+    token_list = []
+    line = 0
+    for item in items:
+        while line < item.line:
+            token_list.append("\n")
+            line += 1
+        if isinstance(item, Label):
+            token_list.append(item.name + ":")
+        elif isinstance(item, Data):
+            token_list += item.tokens
+        elif item.tokens is not None:
+            token_list += item.tokens
+        else:
+            token_list += [Operation.lookup(item.opcode).lower()] + [format_operand(*operand)
+                                                                   for operand in item.operands]
+    return token_list + ["\n"] * (lines - line)
+
+
+def labels(items):
+    return {item.name: index for (index, item) in enumerate(items) if isinstance(item, Label)}
+
+
+# Instructions are only marked as removed during a pass, and dropped from the
+# list after it, so that indices stay put and a pass takes linear time
+def live(item):
+    return isinstance(item, Instruction) and not item.removed
+
+
+# Index of the first instruction from index on, and whether a label or data
+# comes before it
+def next_instruction(items, index):
+    crossed = False
+    while index < len(items) and not live(items[index]):
+        crossed = crossed or not isinstance(items[index], Instruction)
+        index += 1
+    return (index if index < len(items) else None, crossed)
+
+
+# The instruction before index, if no label or data comes in between
+def previous_instruction(items, index):
+    index -= 1
+    while index >= 0 and isinstance(items[index], Instruction):
+        if not items[index].removed:
+            return items[index]
+        index -= 1
+    return None
+
+
+def well_formed(instruction):
+    return instruction.opcode in OPS and instruction.words == OPS[instruction.opcode][4] or \
+        instruction.kind in ["halt", "ret", "reti"] and len(instruction.operands) == 0
+
+
+def reads_flags(instruction):
+    if instruction.kind == "jump" and instruction.opcode != Operation.JUMP:
+        return True
+    return any(mode in [Argument.REG, Argument.IND] and value == Argument.STATUS
+               for (mode, value) in instruction.operands)
+
+
+# Whether the instruction after one reads INPUT. A new input word only shows
+# up the cycle after INPUT was read, so programs space their reads out, for
+# example with NOPs, and the instruction before a read has to stay.
+def before_input(items, index):
+    (following, crossed) = next_instruction(items, index + 1)
+    if following is None or any(isinstance(item, Data) for item in items[index + 1:following]):
+        return False
+    return (Argument.REG, Argument.INPUT) in items[following].operands
+
+
+# Whether the S and Z flags an instruction sets are never read, because the
+# instructions that follow set them again or halt first
+def flags_dead(items, index):
+    for index in range(index + 1, len(items)):
+        item = items[index]
+        if isinstance(item, Data):
+            return False
+        if not live(item):
+            continue
+        if reads_flags(item):
+            return False
+        if item.opcode in OPS and OPS[item.opcode][3] & (SF | ZF) == SF | ZF:
+            return True
+        if item.kind == "halt":
+            return True
+        if item.kind not in ["next", "alu", "push", "pop", "wait"]:
+            return False
+    return True
+
+
+# Operands whose value or address only changes when they are written
+def stable(operand):
+    (mode, value) = operand
+    if mode in [Argument.REG, Argument.IND]:
+        return value in STABLE
+    return True
+
+
+def copy_redundant(items, index):
+    instruction = items[index]
+    if instruction.opcode != Operation.COPY or not well_formed(instruction):
+        return False
+    (source, destination) = instruction.operands
+    if not (stable(source) and stable(destination)):
+        return False
+    # Copying a location to itself only sets the flags
+    if source == destination and flags_dead(items, index):
+        return True
+    # The same copy, or the copy back, right after one, sets the same value
+    # and flags again. Neither can move the location of the other.
+    previous = previous_instruction(items, index)
+    if previous is None or previous.opcode != Operation.COPY or not well_formed(previous):
+        return False
+    (first, second) = previous.operands
+    if second[0] == Argument.REG and first[0] == Argument.IND and first[1] == second[1]:
+        return False
+    return [source, destination] in [[first, second], [second, first]]
+
+
+# Result of an ALU instruction whose sources are all numbers, or None
+def fold(instruction, word_size):
+    (kind, expr, location, flags, size) = OPS.get(instruction.opcode, ("illegal", None, 3, 0, 0))
+    if kind != "alu" or location == 3 or instruction.opcode == Operation.COPY or not well_formed(instruction):
+        return None
+    if instruction.operands[location][0] not in [Argument.REG, Argument.IND, Argument.RAM]:
+        return None
+    sources = [instruction.operands[slot] for slot in source_slots(instruction.opcode)]
+    if any(mode != Argument.IMM for (mode, value) in sources):
+        return None
+    mask = (1 << word_size) - 1
+    values = [value & mask for (mode, value) in sources] + [0]
+    return eval(expr.format(a=values[0], b=values[1]), alu_functions(word_size)) & mask
+
+
+# Where a jump to a label ends up, after any unconditional jumps to labels there
+def thread(items, positions, name):
+    seen = {name}
+    while True:
+        (index, crossed) = next_instruction(items, positions[name] + 1)
+        # Data after the label means the label is not followed by code
+        if index is None or any(isinstance(item, Data) for item in items[positions[name]:index]):
+            return name
+        target = items[index]
+        if target.opcode != Operation.JUMP or not well_formed(target) or target.operands[0][0] != "label" or \
+                target.operands[0][1] not in positions or target.operands[0][1] in seen:
+            return name
+        name = target.operands[0][1]
+        seen.add(name)
+
+
+# Whether a jump goes to the instruction right after it
+def jumps_to_next(items, positions, index):
+    (mode, value) = items[index].operands[0]
+    if mode != "label" or value not in positions:
+        return False
+    following = index + 1
+    while following < len(items) and not isinstance(items[following], Data) and not live(items[following]):
+        if isinstance(items[following], Label) and items[following].name == value:
+            return True
+        following += 1
+    return False
+
+
+# Whether the code from a label returns without using LINK or the stack,
+# following its jumps, so that it can be jumped to instead of called
+def leaf(items, positions, name):
+    work = [positions[name]]
+    seen = set()
+    while len(work) > 0:
+        index = work.pop()
+        while index < len(items):
+            item = items[index]
+            if isinstance(item, Data):
+                return False
+            if live(item):
+                if index in seen:
+                    break
+                seen.add(index)
+                if not well_formed(item) or item.kind in ["call", "reti", "push", "pop"]:
+                    return False
+                # After the jump LINK is the return address of the caller, and SP is one lower
+                if any(mode in [Argument.REG, Argument.IND] and value in [Argument.LINK, Argument.SP]
+                       for (mode, value) in item.operands):
+                    return False
+                if item.kind in ["ret", "halt"]:
+                    break
+                if item.kind == "jump":
+                    (mode, value) = item.operands[0]
+                    if mode != "label" or value not in positions:
+                        return False
+                    work.append(positions[value])
+                    if item.opcode == Operation.JUMP:
+                        break
+            index += 1
+    return True
+
+
+def tail_call(items, positions, index):
+    call = items[index]
+    if call.opcode != Operation.CALL or not well_formed(call) or call.operands[0][0] != "label" or \
+            call.operands[0][1] not in positions:
+        return False
+    (pop_index, crossed) = next_instruction(items, index + 1)
+    if pop_index is None or crossed or items[pop_index].opcode != Operation.POP or \
+            items[pop_index].operands != [(Argument.REG, Argument.LINK)]:
+        return False
+    (ret_index, crossed) = next_instruction(items, pop_index + 1)
+    if ret_index is None or crossed or items[ret_index].opcode != Operation.RET:
+        return False
+    return leaf(items, positions, call.operands[0][1])
+
+
+# One pass of every rule over the program, returns the number of changes of
+# every kind
+def optimize_pass(items, word_size):
+    changes = collections.Counter()
+    positions = labels(items)
+    index = 0
+    while index < len(items):
+        item = items[index]
+        if not isinstance(item, Instruction):
+            index += 1
+            continue
+        previous = previous_instruction(items, index)
+        removable = not before_input(items, index)
+
+        if previous is not None and previous.opcode in UNCONDITIONAL:
+            changes["unreachable instructions removed"] += 1
+        elif removable and item.opcode == Operation.NOP and len(item.operands) == 0:
+            changes["NOPs dropped"] += 1
+        elif removable and copy_redundant(items, index):
+            changes["redundant COPYs removed"] += 1
+        elif removable and item.kind == "jump" and well_formed(item) and jumps_to_next(items, positions, index):
+            changes["jumps to the next instruction removed"] += 1
+        else:
+            value = fold(item, word_size)
+            if value is not None:
+                item.replace(Operation.COPY, [(Argument.IMM, value), item.operands[OPS[item.opcode][2]]])
+                changes["constants folded"] += 1
+            elif item.kind in ["jump", "call"] and well_formed(item) and item.operands[0][0] == "label" and \
+                    item.operands[0][1] in positions:
+                target = thread(items, positions, item.operands[0][1])
+                if target != item.operands[0][1]:
+                    item.replace(item.opcode, [("label", target)])
+                    changes["jumps threaded"] += 1
+            if tail_call(items, positions, index):
+                # CALL f, POP LINK, RET becomes POP LINK, JUMP f
+                (ret_index, crossed) = next_instruction(items, next_instruction(items, index + 1)[0] + 1)
+                items[ret_index].replace(Operation.JUMP, item.operands)
+                changes["tail calls turned into jumps"] += 1
+            else:
+                index += 1
+                continue
+        item.removed = True
+        index += 1
+    items[:] = [item for item in items if not (isinstance(item, Instruction) and item.removed)]
+    return changes
+
+
+# Words and instructions from every label to the next. Every instruction takes
+# one cycle in Cpu without caches or sequential ALU units, so the instructions
+# are the cycles to run through the block once.
+def blocks(items):
+    result = collections.OrderedDict([("(start)", (0, 0))])
+    name = "(start)"
+    for item in items:
+        if isinstance(item, Label):
+            name = item.name
+            result.setdefault(name, (0, 0))
+            continue
+        (words, cycles) = result[name]
+        if isinstance(item, Instruction):
+            result[name] = (words + item.words, cycles + 1)
+        elif item.tokens[0] in [".byte", ".word"]:
+            result[name] = (words + len(item.tokens) - 1, cycles)
+        else:
+            result[name] = (words + 2 * len(item.tokens), cycles)
+    return result
+
+
+# Returns the optimized tokens and a report: the number of words before and
+# after, the changes of every kind, and (name, words, cycles, words, cycles)
+# of every block before and after. Labels are never removed, so the blocks
+# line up. Code that computes addresses of instructions other than from labels
+# can not be optimized, as every change moves code.
+def optimize(token_list, word_size=8):
+    (items, lines) = parse(token_list)
+    for item in items:
+        if isinstance(item, Instruction) and item.kind in ["jump", "call"] and len(item.operands) > 0 and \
+                item.operands[0][0] == Argument.IMM:
+            raise Exception(f"Can not optimize a jump to a fixed address, on line {item.line + 1}")
+    before = blocks(items)
+
+    changes = collections.Counter()
+    while True:
+        changed = optimize_pass(items, word_size)
+        if len(changed) == 0:
+            break
+        changes.update(changed)
+
+    after = blocks(items)
+    report = {
+        "words": (sum(words for (words, cycles) in before.values()), sum(words for (words, cycles) in after.values())),
+        "changes": changes,
+        "blocks": [(name, *before[name], *after.get(name, (0, 0))) for name in before],
+    }
+    return (unparse(items, lines), report)
+
+
+def format_report(report, word_size=8):
+    (before, after) = report["words"]
+    size = word_size // 8
+    lines = [f"Optimized {before} -> {after} words ({before * size} -> {after * size} bytes)"]
+    for (change, count) in report["changes"].items():
+        lines.append(f"  {count} {change}")
+    lines.append(f"{'block':24} {'words':>14} {'cycles':>14}")
+    for (name, words, cycles, new_words, new_cycles) in report["blocks"]:
+        if words == 0 and new_words == 0:
+            continue
+        lines.append(f"{name:24} {words:>6} -> {new_words:<5} {cycles:>6} -> {new_cycles:<5}")
+    return "\n".join(lines)
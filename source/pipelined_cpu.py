@@ -0,0 +1,519 @@
+import amaranth as am
+from amaranth.build import Platform
+
+from codes import Operation, Argument, OPS, SIZES
+from codes import CFI, OFI, SFI, ZFI, SF, ZF
+from cpu import Cpu, shift_left
+
+
+FETCH_BYTES = 7  # Opcode and three (mode, value) operands
+
+ALU = {
+    Operation.AND: lambda a, b, word_size: a & b,
+    Operation.OR: lambda a, b, word_size: a | b,
+    Operation.XOR: lambda a, b, word_size: a ^ b,
+    Operation.NOT: lambda a, b, word_size: ~a,
+    Operation.NEG: lambda a, b, word_size: -a,
+    Operation.ABS: lambda a, b, word_size: abs(a),
+    Operation.ADD: lambda a, b, word_size: a + b,
+    Operation.SUB: lambda a, b, word_size: a - b,
+    Operation.MULL: lambda a, b, word_size: a * b,
+    Operation.MULH: lambda a, b, word_size: (a * b) >> word_size,
+    Operation.DIV: lambda a, b, word_size: a // b,
+    Operation.MOD: lambda a, b, word_size: a % b,
+    Operation.CMP: lambda a, b, word_size: a % b,
+    Operation.INC: lambda a, b, word_size: a + 1,
+    Operation.DEC: lambda a, b, word_size: a - 1,
+    Operation.MIN: lambda a, b, word_size: am.Mux(a < b, a, b),
+    Operation.MAX: lambda a, b, word_size: am.Mux(a > b, a, b),
+    Operation.ASHR: lambda a, b, word_size: a.as_signed() >> b,
+    Operation.SHR: lambda a, b, word_size: a.as_unsigned() >> b,
+    Operation.SHL: shift_left,
+    Operation.COPY: lambda a, b, word_size: a,
+}
+
+# Status bit and the value it must have for the jump to be taken
+CONDITIONS = {
+    Operation.JC: (CFI, 1),
+    Operation.JNC: (CFI, 0),
+    Operation.JO: (OFI, 1),
+    Operation.JNO: (OFI, 0),
+    Operation.JS: (SFI, 1),
+    Operation.JNS: (SFI, 0),
+    Operation.JZ: (ZFI, 1),
+    Operation.JNZ: (ZFI, 0),
+}
+
+
+# Four stage version of Cpu, which runs the same ROMs:
+#
+#   fetch      reads the 7 bytes at the fetch pc and predicts the next
+#              instruction to be the sequential one
+#   decode     decodes the operands, reads registers and RAM and resolves the
+#              destination, with register values forwarded from execute and
+#              write-back
+#   execute    ALU and control flow. Taken jumps, CALL, RET and writes to pc
+#              flush decode and fetch and redirect the fetch pc
+#   write-back commits registers, RAM, flags and the I/O flags in the same
+#              order as Cpu does within one cycle
+#
+# Decode stalls while an older instruction in flight writes RAM and it needs
+# to read RAM, and while an input is being consumed and it reads INPUT, so
+# that the bench protocol for irf stays the same. A RAM write over an
+# instruction that is already in flight (self-modifying code) flushes it and
+# fetches it again. A sequential multiplier or divider stalls execute until
+# its result is ready. hf stays set once the halting instruction is committed,
+# and TICK counts clock cycles, which are no longer the same as instructions.
+# The performance counters count instructions as they are committed, so a
+# program reading them does not see the ones still in flight, and
+# CNT_INPUT_STALLS counts the cycles decode waits for an input.
+class PipelinedCpu(Cpu):
+    def elaborate(self, platform: Platform):
+        assert self.icache is None, "caches are only supported by Cpu"
+        assert self.input_fifo is None, "I/O FIFOs are only supported by Cpu"
+        assert len(self.controls) == 0, "interrupts are only supported by Cpu"
+        m = am.Module()
+        word_size = self.word_size
+        last_reg = Argument._NUM_REGS - 1
+
+        def signal(name, width=word_size, **kwargs):
+            return am.Signal(width, name=name, **kwargs)
+
+        def clamp(index):
+            return am.Mux(index > last_reg, last_reg, index)
+
+        def overlaps(address, pc):
+            return (address >= pc) & (address <= pc + FETCH_BYTES - 1)
+
+        # Pipeline registers
+        fetch_pc = signal("fetch_pc", reset=self.pc().reset)
+        stopped = signal("stopped", 1)
+
+        fd_valid = signal("fd_valid", 1)
+        fd_pc = signal("fd_pc")
+        fd_bytes = [signal(f"fd_byte{index}") for index in range(FETCH_BYTES)]
+
+        de_valid = signal("de_valid", 1)
+        de_pc = signal("de_pc")
+        de_op = signal("de_op")
+        de_size = signal("de_size")
+        de_args = [signal(f"de_arg{index}") for index in range(3)]
+        de_status = signal("de_status")
+        de_sp = signal("de_sp")
+        de_link = signal("de_link")
+        de_stack = signal("de_stack")  # ram[sp], for POP
+        de_res_we = signal("de_res_we", 1)
+        de_res_index = signal("de_res_index")
+        de_ram_we = signal("de_ram_we", 1)
+        de_ram_address = signal("de_ram_address")
+        de_bad_dest = signal("de_bad_dest", 1)
+        de_reads_input = signal("de_reads_input", 1)
+
+        ew_valid = signal("ew_valid", 1)
+        ew_next_pc = signal("ew_next_pc")
+        ew_op_we = signal("ew_op_we", 1)
+        ew_op_index = signal("ew_op_index")
+        ew_op_value = signal("ew_op_value")
+        ew_res_we = signal("ew_res_we", 1)
+        ew_res_index = signal("ew_res_index")
+        ew_result = signal("ew_result")
+        ew_flags_we = signal("ew_flags_we", 1)
+        ew_status = signal("ew_status")
+        ew_ram_we = signal("ew_ram_we", 1)
+        ew_ram_address = signal("ew_ram_address")
+        ew_ram_value = signal("ew_ram_value")
+        ew_irf = signal("ew_irf", 1)
+        ew_owf = signal("ew_owf", 1)
+        ew_halt = signal("ew_halt", 1)
+        ew_iocf = signal("ew_iocf", 1)
+        ew_taken = signal("ew_taken", 1)
+
+        # Execute stage outputs, also forwarded to decode
+        e_next_pc = signal("e_next_pc")
+        e_result = signal("e_result")
+        e_op_we = signal("e_op_we", 1)
+        e_op_index = signal("e_op_index")
+        e_op_value = signal("e_op_value")
+        e_flags_we = signal("e_flags_we", 1)
+        e_status = signal("e_status")
+        e_ram_value = signal("e_ram_value")
+        e_halt = signal("e_halt", 1)
+        e_iocf = signal("e_iocf", 1)
+        e_redirect = signal("e_redirect", 1)
+        e_taken = signal("e_taken", 1)
+
+        # Register writes of the instructions in flight, oldest first
+        writes = [
+            (ew_valid & ew_op_we, ew_op_index, ew_op_value),
+            (ew_valid & ew_res_we, ew_res_index, ew_result),
+            (ew_valid & ew_flags_we, Argument.STATUS, ew_status),
+            (de_valid & e_op_we, e_op_index, e_op_value),
+            (de_valid & de_res_we, de_res_index, e_result),
+            (de_valid & e_flags_we, Argument.STATUS, e_status),
+        ]
+
+        def forward(index, pc):
+            value = self.registers[index]
+            for (we, write_index, write_value) in writes:
+                value = am.Mux(we & (write_index == index), write_value, value)
+            # pc reads as the address of the instruction, TICK as the cycle count
+            return am.Mux(index == Argument.PC, pc, am.Mux(index == Argument.TICK, self.tick(), value))
+
+        # Fetch. The fetch pc of the next cycle is f_next, which the harvard
+        # instruction memory uses as the address of its registered read port
+        f_next = signal("f_next")
+        m.d.comb += f_next.eq(fetch_pc)
+        m.d.sync += fetch_pc.eq(f_next)
+        if self.harvard:
+            fetch_ready = signal("fetch_ready", 1)
+            m.d.sync += fetch_ready.eq(1)
+            f_bytes = self.fetch(m, f_next, domain="sync")
+            f_enable = ~stopped & fetch_ready
+        else:
+            f_bytes = self.fetch(m, fetch_pc)
+            f_enable = ~stopped
+
+        f_size = signal("f_size")
+        m.d.comb += f_size.eq(1)
+        with m.Switch(f_bytes[0]):
+            for (opcode, size) in SIZES.items():
+                with m.Case(opcode):
+                    m.d.comb += f_size.eq(size)
+
+        # Decode and read operands
+        modes = fd_bytes[1::2]
+        values = fd_bytes[2::2]
+
+        # Words read from RAM by the operands, and by POP as slot 3
+        d_loads = [signal(f"d_load{slot}") for slot in range(4)]
+
+        d_args = []
+        d_registers = []
+        for index in range(3):
+            d_args.append(signal(f"d_arg{index}"))
+            d_registers.append(signal(f"d_register{index}"))
+            m.d.comb += d_registers[index].eq(forward(clamp(values[index]), fd_pc))
+            with m.Switch(modes[index]):
+                with m.Case(Argument.REG):
+                    (is_counter, counter) = self.read_counter(m, values[index], f"d_arg{index}")
+                    m.d.comb += d_args[index].eq(am.Mux(is_counter, counter, d_registers[index]))
+                with m.Case(Argument.IMM):
+                    m.d.comb += d_args[index].eq(values[index])
+                with m.Case(Argument.IND, Argument.RAM):
+                    m.d.comb += d_args[index].eq(d_loads[index])
+
+        d_status = signal("d_status")
+        d_sp = signal("d_sp")
+        d_link = signal("d_link")
+        m.d.comb += d_status.eq(forward(Argument.STATUS, fd_pc))
+        m.d.comb += d_sp.eq(forward(Argument.SP, fd_pc))
+        m.d.comb += d_link.eq(forward(Argument.LINK, fd_pc))
+
+        d_load_needed = signal("d_load_needed", 4)
+        m.d.comb += d_load_needed.eq(am.Cat(*[
+            (modes[index] == Argument.IND) | (modes[index] == Argument.RAM) for index in range(3)
+        ] + [fd_bytes[0] == Operation.POP]))
+        d_load_addresses = [am.Mux(modes[index] == Argument.IND, d_registers[index], values[index])
+                            for index in range(3)] + [d_sp]
+        d_ram_hazard = signal("d_ram_hazard", 1)
+        m.d.comb += d_ram_hazard.eq((de_valid & de_ram_we) | (ew_valid & ew_ram_we))
+
+        # With harvard set, data RAM has one registered read port and one write
+        # port, so that it can be mapped to block RAM. Decode reads the words it
+        # needs one per cycle, lowest slot first, and stalls until the last one
+        # is on the port. Reads wait for older stores like below, so words read
+        # early can not go stale. Without harvard fetch reads RAM combinationally
+        # anyway, and so do the operands.
+        d_load_stall = signal("d_load_stall", 1)
+        load_done = signal("load_done", 4)
+        load_pending = signal("load_pending", 1)
+        if self.harvard:
+            m.submodules.ram_read = ram_read = self.ram.read_port(domain="sync", transparent=False)
+            m.submodules.ram_write = ram_write = self.ram.write_port()
+            loaded = [signal(f"loaded{slot}") for slot in range(4)]
+            load_slot = signal("load_slot", 2)
+            load_available = signal("load_available", 4)
+            load_remaining = signal("load_remaining", 4)
+            m.d.comb += load_available.eq(load_done | am.Cat(*[load_pending & (load_slot == slot)
+                                                               for slot in range(4)]))
+            m.d.comb += load_remaining.eq(d_load_needed & ~load_available)
+            m.d.comb += d_load_stall.eq(fd_valid & load_remaining.any())
+            for slot in range(4):
+                m.d.comb += d_loads[slot].eq(am.Mux(load_done[slot], loaded[slot], ram_read.data))
+
+            m.d.sync += load_pending.eq(0)
+            with m.If(load_pending):
+                m.d.sync += load_done.eq(load_available)
+                with m.Switch(load_slot):
+                    for slot in range(4):
+                        with m.Case(slot):
+                            m.d.sync += loaded[slot].eq(ram_read.data)
+            with m.If(fd_valid & ~d_ram_hazard):
+                # The last assignment wins, so the lowest slot goes first
+                for slot in reversed(range(4)):
+                    with m.If(load_remaining[slot]):
+                        m.d.comb += ram_read.addr.eq(self.ram_address(d_load_addresses[slot]))
+                        m.d.sync += [load_pending.eq(1), load_slot.eq(slot)]
+        else:
+            for slot in range(4):
+                m.d.comb += d_loads[slot].eq(self.ram[d_load_addresses[slot]])
+
+        d_size = signal("d_size")
+        d_location = signal("d_location", 2)
+        m.d.comb += d_size.eq(1)
+        m.d.comb += d_location.eq(3)
+        with m.Switch(fd_bytes[0]):
+            for (opcode, (kind, expr, location, flags, increment)) in OPS.items():
+                with m.Case(opcode):
+                    m.d.comb += d_size.eq(SIZES[opcode])
+                    m.d.comb += d_location.eq(location)
+
+        # Destination of the result
+        d_res_we = signal("d_res_we", 1)
+        d_res_index = signal("d_res_index")
+        d_ram_we = signal("d_ram_we", 1)
+        d_ram_address = signal("d_ram_address")
+        d_bad_dest = signal("d_bad_dest", 1)
+        for index in range(3):
+            with m.If(d_location == index):
+                with m.Switch(modes[index]):
+                    with m.Case(Argument.REG):
+                        m.d.comb += d_res_we.eq(1)
+                        m.d.comb += d_res_index.eq(clamp(values[index]))
+                    with m.Case(Argument.IND):
+                        m.d.comb += d_ram_we.eq(1)
+                        m.d.comb += d_ram_address.eq(d_registers[index])
+                    with m.Case(Argument.RAM):
+                        m.d.comb += d_ram_we.eq(1)
+                        m.d.comb += d_ram_address.eq(values[index])
+                    with m.Default():
+                        m.d.comb += d_bad_dest.eq(1)
+        with m.If(fd_bytes[0] == Operation.PUSH):
+            m.d.comb += d_ram_we.eq(1)
+            m.d.comb += d_ram_address.eq(d_sp)
+
+        # Hazards that are not covered by forwarding
+        d_reads_input = signal("d_reads_input", 1)
+        d_reads_ram = signal("d_reads_ram", 1)
+        m.d.comb += d_reads_input.eq(am.Cat(*[
+            (modes[index] == Argument.REG) & (values[index] == Argument.INPUT) for index in range(3)
+        ]).any())
+        m.d.comb += d_reads_ram.eq(d_load_needed.any())
+
+        d_input_stall = signal("d_input_stall", 1)
+        m.d.comb += d_input_stall.eq(fd_valid & d_reads_input & (
+            (de_valid & de_reads_input) | (ew_valid & ew_irf) | self.irf
+        ))
+        d_stall = signal("d_stall", 1)
+        m.d.comb += d_stall.eq(d_input_stall | d_load_stall | (fd_valid & d_reads_ram & d_ram_hazard))
+
+        # Performance counter events travel with the instruction and count when
+        # it is committed
+        d_events = self.instruction_events(m, fd_bytes[0], modes)
+        de_events = {number: signal(f"de_{event.name}", 2) for (number, event) in d_events.items()}
+        ew_events = {number: signal(f"ew_{event.name}", 2) for (number, event) in d_events.items()}
+
+        # Execute
+        # A sequential multiplier or divider holds the instruction in execute,
+        # and decode and fetch behind it, until its result is ready
+        (multiplier, divider) = self.alu_units(m, de_args)
+        units = {}
+        if multiplier is not None:
+            m.d.comb += multiplier.cancel.eq(~de_valid)
+            units[Operation.MULL] = (multiplier, multiplier.low)
+            units[Operation.MULH] = (multiplier, multiplier.high)
+        if divider is not None:
+            m.d.comb += divider.cancel.eq(~de_valid)
+            units[Operation.DIV] = (divider, divider.quotient)
+            units[Operation.MOD] = (divider, divider.remainder)
+            units[Operation.CMP] = (divider, divider.remainder)
+        e_wait = signal("e_wait", 1)
+        e_stall = signal("e_stall", 1)
+        m.d.comb += e_stall.eq(de_valid & e_wait)
+
+        m.d.comb += e_next_pc.eq(de_pc)
+        m.d.comb += e_ram_value.eq(e_result)
+        with m.Switch(de_op):
+            for (opcode, (kind, expr, location, flags, increment)) in OPS.items():
+                # Without interrupts WAIT and RETI are illegal
+                if kind in ["wait", "reti"]:
+                    continue
+                with m.Case(opcode):
+                    m.d.comb += e_next_pc.eq(de_pc + increment)
+
+                    if kind == "halt":
+                        m.d.comb += e_halt.eq(1)
+                    elif kind == "alu" and opcode in units:
+                        (unit, value) = units[opcode]
+                        m.d.comb += e_result.eq(self.wait_for(m, unit, value, e_wait))
+                    elif kind == "alu":
+                        m.d.comb += e_result.eq(ALU[opcode](de_args[0], de_args[1], word_size))
+                    elif kind == "jump":
+                        m.d.comb += e_result.eq(de_args[0])
+                        if opcode == Operation.JUMP:
+                            m.d.comb += e_next_pc.eq(e_result)
+                            m.d.comb += e_taken.eq(1)
+                        else:
+                            (bit, taken) = CONDITIONS[opcode]
+                            with m.If(de_status[bit] == taken):
+                                m.d.comb += e_next_pc.eq(e_result)
+                                m.d.comb += e_taken.eq(1)
+                    elif kind == "call":
+                        m.d.comb += e_result.eq(de_args[0])
+                        m.d.comb += e_next_pc.eq(e_result)
+                        m.d.comb += e_op_we.eq(1)
+                        m.d.comb += e_op_index.eq(Argument.LINK)
+                        m.d.comb += e_op_value.eq(de_pc + increment)
+                    elif kind == "ret":
+                        m.d.comb += e_result.eq(de_link)
+                        m.d.comb += e_next_pc.eq(e_result)
+                    elif kind == "push":
+                        m.d.comb += e_ram_value.eq(de_args[0])
+                        m.d.comb += e_op_we.eq(1)
+                        m.d.comb += e_op_index.eq(Argument.SP)
+                        m.d.comb += e_op_value.eq(de_sp - 1)
+                    elif kind == "pop":
+                        m.d.comb += e_result.eq(de_stack + 1)
+                        m.d.comb += e_op_we.eq(1)
+                        m.d.comb += e_op_index.eq(Argument.SP)
+                        m.d.comb += e_op_value.eq(de_sp + 1)
+
+                    if flags & (SF | ZF):
+                        status = am.Mux(de_res_we & (de_res_index == Argument.STATUS), e_result, de_status)
+                        bits = [status[index] for index in range(word_size)]
+                        if flags & SF:
+                            bits[SFI] = e_result[0]
+                        if flags & ZF:
+                            bits[ZFI] = e_result == 0
+                        m.d.comb += e_flags_we.eq(1)
+                        m.d.comb += e_status.eq(am.Cat(*bits))
+
+            with m.Default():
+                m.d.comb += e_halt.eq(1)
+                m.d.comb += e_iocf.eq(1)
+
+        with m.If(de_bad_dest & ~e_wait):
+            m.d.comb += e_halt.eq(1)
+            m.d.comb += e_iocf.eq(1)
+
+        # A result written to pc is a jump
+        with m.If(de_res_we & (de_res_index == Argument.PC)):
+            m.d.comb += e_next_pc.eq(e_result)
+
+        m.d.comb += e_redirect.eq((e_next_pc != de_pc + de_size) & ~e_wait)
+
+        # Write back
+        m.d.sync += self.output().eq(0)
+        m.d.sync += self.irf.eq(0)
+        m.d.sync += self.owf.eq(0)
+        with m.If(ew_valid):
+            m.d.sync += self.pc().eq(ew_next_pc)
+            with m.If(ew_op_we):
+                m.d.sync += self.registers[ew_op_index].eq(ew_op_value)
+            with m.If(ew_res_we):
+                m.d.sync += self.registers[ew_res_index].eq(ew_result)
+            with m.If(ew_flags_we):
+                m.d.sync += self.status().eq(ew_status)
+            if not self.harvard:
+                with m.If(ew_ram_we):
+                    m.d.sync += self.ram[ew_ram_address].eq(ew_ram_value)
+            m.d.sync += self.irf.eq(ew_irf)
+            m.d.sync += self.owf.eq(ew_owf)
+            with m.If(ew_halt):
+                m.d.sync += self.hf.eq(1)
+            with m.If(ew_iocf):
+                m.d.sync += self.iocf.eq(1)
+        m.d.sync += self.tick().eq(self.tick() + 1)
+        if self.harvard:
+            m.d.comb += ram_write.addr.eq(self.ram_address(ew_ram_address))
+            m.d.comb += ram_write.data.eq(ew_ram_value)
+            m.d.comb += ram_write.en.eq(ew_valid & ew_ram_we)
+
+        increments = {number: am.Mux(ew_valid, event, 0) for (number, event) in ew_events.items()}
+        increments[Argument.CNT_HALTED] = self.hf
+        increments[Argument.CNT_TAKEN] = ew_valid & ew_taken
+        increments[Argument.CNT_NOT_TAKEN] = ew_valid & (ew_events[Argument.CNT_JUMP] != 0) & ~ew_taken
+        increments[Argument.CNT_INPUT_STALLS] = d_input_stall
+        self.update_counters(m, increments)
+
+        # Advance the pipeline. Execute moves on to write-back unless it stalls
+        m.d.sync += [
+            ew_valid.eq(de_valid & ~e_stall),
+            ew_next_pc.eq(e_next_pc),
+            ew_op_we.eq(e_op_we),
+            ew_op_index.eq(e_op_index),
+            ew_op_value.eq(e_op_value),
+            ew_res_we.eq(de_res_we),
+            ew_res_index.eq(de_res_index),
+            ew_result.eq(e_result),
+            ew_flags_we.eq(e_flags_we),
+            ew_status.eq(e_status),
+            ew_ram_we.eq(de_ram_we),
+            ew_ram_address.eq(de_ram_address),
+            ew_ram_value.eq(e_ram_value),
+            ew_irf.eq(de_reads_input),
+            ew_owf.eq(de_res_we & (de_res_index == Argument.OUTPUT)),
+            ew_halt.eq(e_halt),
+            ew_iocf.eq(e_iocf),
+            ew_taken.eq(e_taken),
+        ]
+        m.d.sync += [ew_events[number].eq(de_events[number]) for number in de_events]
+
+        with m.If(e_stall):
+            pass
+        with m.Elif(d_stall):
+            m.d.sync += de_valid.eq(0)
+        with m.Else():
+            m.d.sync += [
+                de_valid.eq(fd_valid),
+                de_pc.eq(fd_pc),
+                de_op.eq(fd_bytes[0]),
+                de_size.eq(d_size),
+                de_status.eq(d_status),
+                de_sp.eq(d_sp),
+                de_link.eq(d_link),
+                de_stack.eq(d_loads[3]),
+                de_res_we.eq(d_res_we),
+                de_res_index.eq(d_res_index),
+                de_ram_we.eq(d_ram_we),
+                de_ram_address.eq(d_ram_address),
+                de_bad_dest.eq(d_bad_dest),
+                de_reads_input.eq(d_reads_input),
+            ]
+            m.d.sync += [de_events[number].eq(d_events[number]) for number in d_events]
+            m.d.sync += [de_args[index].eq(d_args[index]) for index in range(3)]
+
+            m.d.sync += [load_done.eq(0), load_pending.eq(0)]
+
+            m.d.sync += fd_valid.eq(f_enable)
+            m.d.sync += fd_pc.eq(fetch_pc)
+            m.d.sync += [fd_bytes[index].eq(f_bytes[index]) for index in range(FETCH_BYTES)]
+            with m.If(f_enable):
+                m.d.comb += f_next.eq(fetch_pc + f_size)
+
+        # Control flow resolved in execute
+        with m.If(de_valid & e_halt):
+            m.d.sync += [de_valid.eq(0), fd_valid.eq(0), stopped.eq(1), load_done.eq(0), load_pending.eq(0)]
+        with m.Elif(de_valid & e_redirect):
+            m.d.sync += [de_valid.eq(0), fd_valid.eq(0), load_done.eq(0), load_pending.eq(0)]
+            m.d.comb += f_next.eq(e_next_pc)
+
+        # RAM written under an instruction in flight, fetch it again. Code in the
+        # harvard instruction memory can not change.
+        if not self.harvard:
+            with m.If(ew_valid & ew_ram_we):
+                with m.If(de_valid & overlaps(ew_ram_address, de_pc)):
+                    m.d.sync += [ew_valid.eq(0), de_valid.eq(0), fd_valid.eq(0), stopped.eq(0)]
+                    m.d.comb += f_next.eq(de_pc)
+                with m.Elif(de_valid & (e_halt | e_redirect)):
+                    pass
+                with m.Elif(fd_valid & overlaps(ew_ram_address, fd_pc)):
+                    m.d.sync += fd_valid.eq(0)
+                    with m.If(~e_stall):
+                        m.d.sync += de_valid.eq(0)
+                    m.d.comb += f_next.eq(fd_pc)
+                with m.Elif(~d_stall & ~e_stall & f_enable & overlaps(ew_ram_address, fetch_pc)):
+                    m.d.sync += fd_valid.eq(0)
+                    m.d.comb += f_next.eq(fetch_pc)
+
+        return m
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+
+from amaranth.sim import Simulator
+
+from alu_units import ALU_UNITS
+from assemble_rom import assemble, tokenize
+from codes import Argument, ENDIANS
+from cpu import Cpu, collect_result
+from cxxrtl_sim import prepare, run_cxxrtl
+from isa_sim import IsaSim
+from pipelined_cpu import PipelinedCpu
+from session import CpuSession
+from stream import StreamDriver
+
+
+# Every <name>.s in the ROM directory is a test. <name>.in holds the input
+# vector and <name>.out the expected outputs, as whitespace separated numbers.
+# A missing .in means no inputs, a missing .out means any outputs pass.
+# Programs whose results depend on the word size can add <name>.w16.out or
+# <name>.w32.out, which are used instead of <name>.out at that word size.
+# Programs in the interrupts directory only run with interrupts enabled.
+def find_programs(directory):
+    programs = []
+    for source in sorted(glob.glob(os.path.join(directory, "**", "*.s"), recursive=True)):
+        base = source[:-len(".s")]
+        programs.append({
+            "name": os.path.relpath(base, directory),
+            "source": source,
+            "inputs": base + ".in" if os.path.exists(base + ".in") else None,
+            "outputs": base + ".out" if os.path.exists(base + ".out") else None,
+        })
+    return programs
+
+
+def read_vector(path):
+    if path is None:
+        return None
+    with open(path, "r") as ifs:
+        return [int(token, 0) for token in ifs.read().split()]
+
+
+def vector_for(path, word_size):
+    if path is None or word_size == 8:
+        return path
+    (base, extension) = os.path.splitext(path)
+    wide = f"{base}.w{word_size}{extension}"
+    return wide if os.path.exists(wide) else path
+
+
+# options are passed on to the Cpu, like harvard or divider
+def run_rtl(rom_file, inputs, max_cycles, cpu_class=Cpu, **options):
+    dut = cpu_class(rom_file, **options)
+    inputs = iter(inputs)
+    outputs = []
+    result = {}
+
+    driver = None
+    if dut.input_fifo is not None:
+        driver = StreamDriver(dut, inputs, on_output=outputs.append)
+
+    def bench():
+        result.update((yield from collect_result(dut, inputs, max_cycles, outputs, driver)))
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)  # 1 MHz
+    sim.add_sync_process(bench)
+    if driver is not None:
+        driver.add_to(sim)
+    sim.run()
+    return result
+
+
+def run_isa(rom_file, inputs, max_cycles, word_size=8, endian="little", ram_size=256, interrupts=False):
+    isa = IsaSim(rom_file, word_size=word_size, ram_size=ram_size, endian=endian, interrupts=interrupts)
+    isa.set_inputs(iter(inputs))
+    isa.run(max_ticks=max_cycles)
+    counters = {}
+    for (index, value) in enumerate(isa.counters):
+        counters[Argument.lookup(Argument._FIRST_COUNTER + index).lower()] = value
+    return {"outputs": isa.outputs, "cycles": isa.cycles, "halted": bool(isa.hf), "iocf": bool(isa.iocf),
+            "counters": counters}
+
+
+# Sessions of this worker process by backend and options, so that a worker
+# elaborates the design once instead of once per program
+sessions = {}
+
+
+def run_session(rom_file, inputs, max_cycles, cpu_class=Cpu, **options):
+    key = (cpu_class.__name__, json.dumps(options, sort_keys=True))
+    if key not in sessions:
+        sessions[key] = CpuSession(cpu_class, **options)
+    return sessions[key].run(rom_file, inputs, max_cycles)
+
+
+# Assembles and runs one program, in a worker process
+def run_program(program, build_dir, backend, max_cycles, options=None, optimize=False):
+    start = time.perf_counter()
+    summary = {"name": program["name"], "passed": False, "cycles": 0, "error": None}
+    options = options or {}
+    word_size = options.get("word_size", 8)
+    endian = options.get("endian", "little")
+    try:
+        with open(program["source"], "r") as ifs:
+            (byte_list, source_map) = assemble(list(tokenize(ifs)), file=program["source"], word_size=word_size,
+                                               endian=endian, optimize=optimize)
+        rom_file = os.path.join(build_dir, program["name"] + ".rom")
+        os.makedirs(os.path.dirname(rom_file), exist_ok=True)
+        with open(rom_file, "wb") as ofs:
+            ofs.write(byte_list)
+        source_map.save(rom_file + ".map")
+
+        inputs = read_vector(program["inputs"]) or []
+        expected = read_vector(vector_for(program["outputs"], word_size))
+        if backend == "isa":
+            result = run_isa(rom_file, inputs, max_cycles, word_size, endian, options.get("ram_size", 256),
+                             options.get("interrupts", False))
+        elif backend == "cxxrtl":
+            result = run_cxxrtl(rom_file, inputs, max_cycles, **options)
+        else:
+            cpu_class = PipelinedCpu if backend == "pipelined" else Cpu
+            run = run_rtl if options.get("io_fifo_depth") else run_session
+            result = run(rom_file, inputs, max_cycles, cpu_class, **options)
+
+        summary["cycles"] = result["cycles"]
+        summary["outputs"] = result["outputs"]
+        summary["counters"] = result["counters"]
+        summary["expected"] = expected
+        if not result["halted"]:
+            summary["error"] = f"did not halt within {max_cycles} cycles"
+        elif result["iocf"]:
+            summary["error"] = "illegal opcode"
+        elif expected is not None and result["outputs"] != expected:
+            summary["error"] = "output mismatch"
+        summary["passed"] = summary["error"] is None
+    except Exception as e:
+        summary["error"] = f"{e.__class__.__name__}: {e}"
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def run_suite(programs, build_dir="build/regression", backend="rtl", max_cycles=100000, jobs=None, options=None,
+              optimize=False):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_program, program, build_dir, backend, max_cycles, options, optimize)
+                   for program in programs]
+        for future in concurrent.futures.as_completed(futures):
+            summary = future.result()
+            status = "PASS" if summary["passed"] else f"FAIL ({summary['error']})"
+            print(f"{summary['name']:24} {summary['cycles']:10} cycles {summary['seconds']:8.3f} s  {status}")
+            yield summary
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--directory", nargs=1, default=[os.path.join(os.path.dirname(__file__), "roms")])
+    ap.add_argument("-b", "--build", nargs=1, default=["build/regression"])
+    ap.add_argument("-o", "--output", nargs=1, default=None, help="write a JSON summary to this file")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, defaults to the number of cores")
+    ap.add_argument("-k", "--filter", default=None, help="only run programs whose name contains this")
+    ap.add_argument("--isa", action="store_true", help="run on IsaSim instead of the Amaranth simulation")
+    ap.add_argument("--pipelined", action="store_true", help="simulate PipelinedCpu instead of Cpu")
+    ap.add_argument("--cxxrtl", action="store_true", help="run Cpu as a model compiled with Yosys CXXRTL")
+    ap.add_argument("--harvard", action="store_true", help="fetch instructions from a separate read-only memory")
+    ap.add_argument("-w", "--word-size", type=int, default=8, choices=[8, 16, 32])
+    ap.add_argument("--endian", default="little", choices=ENDIANS, help="byte order of the words in the ROM")
+    ap.add_argument("--multiplier", default="comb", choices=ALU_UNITS, help="sequential stalls until done")
+    ap.add_argument("--divider", default="comb", choices=ALU_UNITS, help="sequential stalls until done")
+    ap.add_argument("--alu-radix", type=int, default=2, help="radix of the sequential multiplier and divider")
+    ap.add_argument("--fifo-depth", type=int, default=0, help="stream INPUT and OUTPUT through FIFOs this deep")
+    ap.add_argument("-a", "--addr-bus-width", type=int, default=8)
+    ap.add_argument("-r", "--ram-size", type=int, default=256)
+    ap.add_argument("--cache-lines", type=int, default=0, help="put caches of this many lines in front of RAM")
+    ap.add_argument("--line-size", type=int, default=4, help="words in a cache line")
+    ap.add_argument("--memory-latency", type=int, default=2, help="wait states of every RAM access behind the caches")
+    ap.add_argument("--interrupts", action="store_true", help="add the interrupt controller, WAIT and RETI")
+    ap.add_argument("--max-cycles", type=int, default=100000)
+    ap.add_argument("-O", "--optimize", action="store_true", help="assemble with the peephole optimizer")
+    args = ap.parse_args()
+
+    backend = "isa" if args.isa else "pipelined" if args.pipelined else "cxxrtl" if args.cxxrtl else "rtl"
+    if backend == "cxxrtl" and args.fifo_depth:
+        ap.error("--cxxrtl does not support --fifo-depth")
+    if backend == "pipelined" and (args.cache_lines or args.fifo_depth or args.interrupts):
+        ap.error("--pipelined does not support --cache-lines, --fifo-depth or --interrupts")
+    if args.harvard and args.cache_lines:
+        ap.error("--harvard can not be combined with --cache-lines, the instruction cache replaces it")
+    options = {"harvard": args.harvard, "word_size": args.word_size, "addr_bus_width": args.addr_bus_width,
+               "ram_size": args.ram_size, "endian": args.endian, "multiplier": args.multiplier,
+               "divider": args.divider, "alu_radix": args.alu_radix}
+    if args.fifo_depth:
+        options.update(io_fifo_depth=args.fifo_depth)
+    if args.cache_lines:
+        options.update(cache_lines=args.cache_lines, line_size=args.line_size, memory_latency=args.memory_latency)
+    if args.interrupts:
+        options.update(interrupts=True)
+    programs = find_programs(args.directory[0])
+    if not args.interrupts:
+        programs = [program for program in programs if not program["name"].startswith("interrupts" + os.sep)]
+    if args.filter is not None:
+        programs = [program for program in programs if args.filter in program["name"]]
+    if len(programs) == 0:
+        print(f"No programs found in {args.directory[0]}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    if backend == "cxxrtl":
+        # Once here, instead of in every worker
+        prepare(**options)
+    results = sorted(run_suite(programs, args.build[0], backend, args.max_cycles, args.jobs, options,
+                               args.optimize),
+                     key=lambda summary: summary["name"])
+    seconds = time.perf_counter() - start
+
+    passed = sum(1 for summary in results if summary["passed"])
+    print(f"{passed}/{len(results)} passed in {seconds:.3f} s")
+
+    if args.output:
+        with open(args.output[0], "w") as ofs:
+            json.dump({
+                "backend": backend,
+                "options": options,
+                "passed": passed,
+                "failed": len(results) - passed,
+                "seconds": seconds,
+                "results": results,
+            }, ofs, indent=2)
+
+    sys.exit(0 if passed == len(results) else 1)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+
+from codes import Argument, Operation, disassemble
+from codes import CFI, OFI, SFI, ZFI, NUM_ARGS_3
+from isa_sim import destination
+from snapshot import FLAGS, take_snapshot
+from source_map import SourceMap
+
+
+MAGIC = b"RTRC"
+VERSION = 1
+
+# Magic, version, word size and record size
+HEADER = struct.Struct("<4sBBH")
+
+# One retired instruction: cycle, pc, the 7 instruction words, result, RAM
+# address written, register written, STATUS after the instruction and events.
+# Words take 32 bits whatever the word size. Record n starts at
+# HEADER.size + n * RECORD.size, so a trace can be indexed in place.
+RECORD = struct.Struct("<Q9IIBBBx")
+(CYCLE, PC, CODE, RESULT, ADDRESS, REGISTER, STATUS, EVENTS) = (0, 1, 2, 9, 10, 11, 12, 13)
+
+# Events of a record
+WROTE_REGISTER = 1
+WROTE_RAM = 2
+INPUT = 4  # Read INPUT, irf is set after it
+OUTPUT = 8  # Wrote OUTPUT, owf is set after it
+HALTED = 16
+ILLEGAL = 32
+
+EVENT_NAMES = [("in", INPUT), ("out", OUTPUT), ("halt", HALTED), ("illegal", ILLEGAL)]
+
+
+# Writes the records of a run to a new trace file, one at a time as the
+# instructions retire, so a run that is stopped still leaves a readable trace
+class RetireWriter:
+    def __init__(self, path, word_size=8):
+        self.path = path
+        self.ofs = open(path, "wb", buffering=1 << 16)
+        self.ofs.write(HEADER.pack(MAGIC, VERSION, word_size, RECORD.size))
+        self.written = 0
+
+    # pc, code, register and address are from before the instruction, as
+    # destination() gives them, and the rest of the state is from after it
+    def retire(self, cycle, pc, code, register, address, registers, controls, ram, hf, iocf, irf, owf):
+        events = INPUT * irf | OUTPUT * owf | HALTED * hf | ILLEGAL * iocf
+        result = 0
+        if register is not None:
+            events |= WROTE_REGISTER
+            result = controls[register - Argument._FIRST_CONTROL] if Argument.is_control(register) \
+                else registers[register]
+        if address is not None:
+            events |= WROTE_RAM
+            result = ram[address]
+        self.ofs.write(RECORD.pack(cycle, pc, *code, result, address or 0, register or 0,
+                                   registers[Argument.STATUS], events))
+        self.written += 1
+
+    def close(self):
+        self.ofs.close()
+
+
+# Retire trace of Cpu from inside the test() bench, in the place of a
+# VcdTrace. Every cycle costs one snapshot. An instruction retired when
+# cnt_retired went up, and is decoded from the snapshot of the cycle before.
+# This follows Cpu, where the instruction at pc is the one that retires, and
+# not the stages of PipelinedCpu.
+class RetireTrace:
+    units = "instructions"
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = None
+
+    def attach(self, dut):
+        self.dut = dut
+        self.writer = RetireWriter(self.path, dut.word_size)
+        # With harvard set, instructions come from the ROM and not from RAM
+        self.rom = None
+        if dut.imem is not None:
+            self.rom = [dut.imem[address % 8].init[address // 8] for address in range(dut.ram_size)]
+
+    def code(self, snapshot, pc):
+        words = self.rom if self.rom is not None else snapshot.ram
+        return [words[min(pc + index, self.dut.ram_size - 1)] for index in range(NUM_ARGS_3)]
+
+    # Called by the bench once per cycle, before the clock edge
+    def sample(self, cycles):
+        current = yield from take_snapshot(self.dut, cycles)
+        (previous, self.previous) = (self.previous, current)
+        if previous is None or current.counters[0] == previous.counters[0]:
+            return
+        pc = previous.registers[Argument.PC]
+        code = self.code(previous, pc)
+        (register, address) = destination(code, previous.registers, self.dut.ram_size, len(self.dut.controls) > 0)
+        self.writer.retire(previous.cycles, pc, code, register, address, current.registers, current.controls,
+                           current.ram, *[current.flags[name] for name in FLAGS])
+
+    # Called by the bench when the run ends, returns the number of records written
+    def finish(self, cycles):
+        yield from self.sample(cycles)
+        self.writer.close()
+        return self.writer.written
+
+
+# A trace file mapped into memory. Records are unpacked where they are, so
+# queries over long traces neither read nor copy the whole file.
+class RetireTraceFile:
+    def __init__(self, path):
+        if os.path.getsize(path) < HEADER.size:
+            raise Exception(f"{path} is not a retire trace")
+        with open(path, "rb") as ifs:
+            self.map = mmap.mmap(ifs.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.word_size, size) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise Exception(f"{path} is not a retire trace")
+        # A run that was killed can leave part of a record at the end
+        self.count = (len(self.map) - HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+
+    def records(self, start=0, stop=None):
+        stop = self.count if stop is None else min(stop, self.count)
+        view = memoryview(self.map)[HEADER.size + start * RECORD.size:HEADER.size + stop * RECORD.size]
+        return RECORD.iter_unpack(view)
+
+    # Index of the first record at or after a cycle, records are in cycle order
+    def find(self, cycle):
+        return bisect.bisect_left(self, cycle, key=lambda record: record[CYCLE])
+
+
+def select(records, pc_range=None, opcodes=None, address=None):
+    for record in records:
+        if pc_range is not None and not pc_range[0] <= record[PC] <= pc_range[1]:
+            continue
+        if opcodes is not None and record[CODE] not in opcodes:
+            continue
+        if address is not None and not (record[EVENTS] & WROTE_RAM and record[ADDRESS] == address):
+            continue
+        yield record
+
+
+def format_record(record, word_size=8, source_map=None):
+    digits = word_size // 4
+    instruction = disassemble(record[CODE:CODE + NUM_ARGS_3], base=record[PC], end=1)[0]
+    raw = " ".join(f"{value:0{digits}X}" for value in instruction.raw)
+    effects = []
+    if record[EVENTS] & WROTE_REGISTER:
+        effects.append(f"{Argument.lookup(record[REGISTER]).lower()}={record[RESULT]:0{digits}X}")
+    if record[EVENTS] & WROTE_RAM:
+        effects.append(f"ram[{record[ADDRESS]:03X}]={record[RESULT]:0{digits}X}")
+    effects.append("cosz=" + "".join(f"{record[STATUS] >> index & 1}" for index in [CFI, OFI, SFI, ZFI]))
+    effects += [name for (name, event) in EVENT_NAMES if record[EVENTS] & event]
+    line = (f"{record[CYCLE]:>10} {record[PC]:03X}: {raw:<{NUM_ARGS_3 * (digits + 1) - 1}} {instruction.text:<24} "
+            f"{' '.join(effects)}")
+    if source_map is not None:
+        line += f"  ; {source_map.format(record[PC])}"
+    return line
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="query a retire trace written by cpu.py or isa_sim.py --retire-trace")
+    ap.add_argument("trace")
+    ap.add_argument("--pc", default=None, help="only instructions at LO:HI or one address, numbers or labels")
+    ap.add_argument("--opcode", nargs="+", default=None, help="only these opcodes, names or numbers")
+    ap.add_argument("--address", type=lambda s: int(s, 0), default=None, help="only writes to this RAM address")
+    ap.add_argument("--cycles", default=None, help="only cycles LO:HI, either end can be left out")
+    ap.add_argument("-m", "--map", nargs=1, default=None, help="source map written by assemble_rom.py")
+    ap.add_argument("-n", "--limit", type=int, default=None, help="print at most this many records")
+    ap.add_argument("--count", action="store_true", help="only print the number of matching records")
+    args = ap.parse_args()
+
+    trace = RetireTraceFile(args.trace)
+    source_map = SourceMap.load(args.map[0]) if args.map else None
+
+    def address(text):
+        if source_map is not None and text in source_map.labels:
+            return source_map.label_address(text)
+        try:
+            return int(text, 0)
+        except ValueError:
+            ap.error(f"Unknown label or address: {text}")
+
+    pc_range = None
+    if args.pc is not None:
+        (low, _, high) = args.pc.partition(":")
+        pc_range = (address(low), address(high or low))
+
+    opcodes = None
+    if args.opcode is not None:
+        opcodes = set()
+        for name in args.opcode:
+            if Operation.contains(name.upper()):
+                opcodes.add(Operation.get(name.upper()))
+            elif name.isdigit() or name.lower().startswith("0x"):
+                opcodes.add(int(name, 0))
+            else:
+                ap.error(f"Unknown opcode: {name}")
+
+    (start, stop) = (0, None)
+    if args.cycles is not None:
+        (low, _, high) = args.cycles.partition(":")
+        try:
+            (low, high) = (int(low, 0) if low else None, int(high, 0) if high else None)
+        except ValueError:
+            ap.error(f"Expected --cycles LO:HI, got {args.cycles}")
+        start = trace.find(low) if low is not None else 0
+        stop = trace.find(high + 1) if high is not None else None
+
+    matches = select(trace.records(start, stop), pc_range, opcodes, args.address)
+    if args.count:
+        print(sum(1 for record in matches))
+    else:
+        for (number, record) in enumerate(matches):
+            if args.limit is not None and number >= args.limit:
+                break
+            print(format_record(record, trace.word_size, source_map))
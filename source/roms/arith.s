@@ -0,0 +1,13 @@
+; Multiply, divide and shift the two inputs
+    nop
+    copy input r0
+    nop
+    copy input r1
+    mull r0 r1 output
+    mulh r0 r1 output
+    div r0 r1 output
+    mod r0 r1 output
+    shl r0 #1 output
+    shr r0 #1 output
+    ashr r0 #1 output
+    halt
@@ -0,0 +1,14 @@
+; Double every input up to the first zero through a subroutine
+    nop
+loop:
+    copy input r0
+    jz done
+    call double
+    copy r0 output
+    jump loop
+done:
+    halt
+
+double:
+    add r0 r0 r0
+    ret
@@ -0,0 +1,11 @@
+; Copy four inputs to the output. A new input is only available every other
+; cycle, so the reads are interleaved with nops.
+    nop
+    copy input output
+    nop
+    copy input output
+    nop
+    copy input output
+    nop
+    copy input output
+    halt
@@ -0,0 +1,15 @@
+; Copy the inputs up to the first zero from the input interrupt, and sleep in
+; WAIT otherwise
+    copy handler ivec
+    copy #1 ie
+idle:
+    wait
+    jump idle
+
+handler:
+    copy input r0
+    jz done
+    copy r0 output
+    reti
+done:
+    halt
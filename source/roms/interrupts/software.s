@@ -0,0 +1,16 @@
+; Double the inputs up to the first zero in a software interrupt handler
+    copy handler ivec
+    copy #8 ie
+loop:
+    copy input r0
+    jz done
+    copy #8 ip
+    copy r0 output
+    jump loop
+done:
+    halt
+
+handler:
+    add r0 r0 r0
+    copy #0 ip
+    reti
@@ -0,0 +1,19 @@
+; Output a count from the timer interrupt every 16 cycles, and sleep in WAIT
+; in between instead of polling TICK
+    copy handler ivec
+    add tick #16 timer
+    copy #0 ip
+    copy #4 ie
+    copy #0 r0
+idle:
+    wait
+    sub r0 #5 r1
+    jnz idle
+    halt
+
+handler:
+    inc r0
+    copy r0 output
+    add timer #16 timer
+    copy #0 ip
+    reti
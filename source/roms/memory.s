@@ -0,0 +1,16 @@
+; Store the inputs in RAM and write them back out in reverse
+    copy #0xE0 r7
+store:
+    copy input r0
+    jz load
+    copy r0 [r7]
+    inc r7
+    jump store
+load:
+    cmp #0xE0 r7
+    jz done
+    dec r7
+    copy [r7] output
+    jump load
+done:
+    halt
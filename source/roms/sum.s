@@ -0,0 +1,10 @@
+; Sum the inputs up to the first zero
+    copy #0 r1
+loop:
+    copy input r0
+    jz done
+    add r0 r1 r1
+    jump loop
+done:
+    copy r1 output
+    halt
@@ -0,0 +1,45 @@
+import amaranth as am
+from amaranth.sim import Simulator
+
+from cpu import Cpu, collect_result
+from fast_forward import read_checkpoint
+
+
+# One elaborated Cpu and Simulator that run programs one after another. The
+# Cpu sits in a sync domain made here, so that its reset can be pulsed
+# between programs, and Cpu.load_rom swaps in each ROM. The simulation only
+# advances inside run, so a worker can keep a session between tests. FIFO
+# streaming is not supported, as StreamDriver keeps state across runs.
+class CpuSession:
+    def __init__(self, cpu_class=Cpu, **options):
+        assert not options.get("io_fifo_depth"), "sessions use the irf/owf protocol, not FIFOs"
+        self.dut = cpu_class(b"", **options)
+        top = am.Module()
+        top.domains.sync = self.domain = am.ClockDomain("sync")
+        top.submodules.cpu = self.dut
+        self.sim = Simulator(top)
+        self.sim.add_clock(1e-6)  # 1 MHz
+        self.sim.add_sync_process(self.bench)
+        self.job = None
+        self.result = None
+
+    # Same result as regression.run_rtl, with checkpoint also the final
+    # state as a Checkpoint
+    def run(self, rom, inputs=(), max_cycles=100000, checkpoint=False):
+        # Read here, so that a bad ROM raises before the bench takes it
+        self.job = (self.dut.rom_words(rom), iter(inputs), max_cycles, checkpoint)
+        while self.job is not None:
+            self.sim.advance()
+        return self.result
+
+    def bench(self):
+        dut = self.dut
+        while True:
+            while self.job is None:
+                yield
+            (rom, inputs, max_cycles, checkpoint) = self.job
+            yield from dut.load_rom(rom, self.domain.rst)
+            result = yield from collect_result(dut, inputs, max_cycles)
+            if checkpoint:
+                result["checkpoint"] = yield from read_checkpoint(dut, result["cycles"])
+            (self.result, self.job) = (result, None)
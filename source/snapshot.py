@@ -0,0 +1,98 @@
+import array
+import json
+import sys
+
+import amaranth as am
+
+from codes import Argument, pack_words, word_type
+
+
+FLAGS = ["hf", "iocf", "irf", "owf"]
+
+
+# RAM, registers, performance counters, interrupt controls and flags of a Cpu
+# at one cycle. Words are kept in arrays of the ROM word type, so the RAM can
+# be written out as a ROM image with pack_words.
+class Snapshot:
+    def __init__(self, word_size, ram, registers, counters, controls, flags, cycles=None):
+        self.word_size = word_size
+        self.ram = ram
+        self.registers = registers
+        self.counters = counters
+        self.controls = controls
+        self.flags = flags  # name -> 0 or 1
+        self.cycles = cycles
+
+    # Every word with a name, in the order they are diffed
+    def words(self):
+        for (address, word) in enumerate(self.ram):
+            yield (f"ram[{address:03X}]", word)
+        for (index, word) in enumerate(self.registers):
+            yield (Argument.lookup(index).lower(), word)
+        for (index, word) in enumerate(self.counters):
+            yield (Argument.lookup(Argument._FIRST_COUNTER + index).lower(), word)
+        for (index, word) in enumerate(self.controls):
+            yield (Argument.lookup(Argument._FIRST_CONTROL + index).lower(), word)
+
+    # (name, old, new) of the words and flags that differ from an older snapshot
+    def diff(self, old, ram_only=False):
+        changes = []
+        for ((name, before), (_, after)) in zip(old.words(), self.words()):
+            if before != after and not (ram_only and not name.startswith("ram")):
+                changes.append((name, before, after))
+        if not ram_only:
+            for name in FLAGS:
+                if old.flags[name] != self.flags[name]:
+                    changes.append((name, old.flags[name], self.flags[name]))
+        return changes
+
+    def format_diff(self, old, ram_only=False):
+        digits = self.word_size // 4
+        return " ".join(f"{name}: {before:0{digits}X}->{after:0{digits}X}"
+                        for (name, before, after) in self.diff(old, ram_only))
+
+    def save(self, path):
+        with open(path, "w") as ofs:
+            json.dump({
+                "word_size": self.word_size,
+                "cycles": self.cycles,
+                "flags": self.flags,
+                "registers": list(self.registers),
+                "counters": list(self.counters),
+                "controls": list(self.controls),
+                "ram": pack_words(self.ram, self.word_size).hex(),
+            }, ofs, separators=(",", ":"))
+
+    @staticmethod
+    def load(path):
+        with open(path, "r") as ifs:
+            data = json.load(ifs)
+        code = word_type(data["word_size"])
+        ram = array.array(code, bytes.fromhex(data["ram"]))
+        if sys.byteorder != "little" and ram.itemsize > 1:
+            ram.byteswap()
+        return Snapshot(data["word_size"], ram, array.array(code, data["registers"]),
+                        array.array(code, data["counters"]), array.array(code, data["controls"]), data["flags"],
+                        data["cycles"])
+
+
+# Reads the state of a Cpu from a bench with a single command. Every word is
+# concatenated into one value, which is split back into arrays through bytes.
+def take_snapshot(dut, cycles=None):
+    ram = [dut.ram[address] for address in range(dut.ram_size)]
+    registers = [dut.registers[index] for index in range(Argument._NUM_REGS)]
+    words = ram + registers + dut.counters + dut.controls
+    flags = [getattr(dut, name) for name in FLAGS]
+    value = yield am.Cat(*words, *flags)
+
+    size = dut.word_size // 8
+    packed = array.array(word_type(dut.word_size))
+    packed.frombytes((value & ((1 << len(words) * dut.word_size) - 1)).to_bytes(len(words) * size, "little"))
+    if sys.byteorder != "little" and size > 1:
+        packed.byteswap()
+    value >>= len(words) * dut.word_size
+    bits = {name: value >> index & 1 for (index, name) in enumerate(FLAGS)}
+
+    ends = [len(ram), len(ram) + len(registers), len(ram) + len(registers) + len(dut.counters), len(words)]
+    return Snapshot(dut.word_size, packed[:ends[0]], packed[ends[0]:ends[1]], packed[ends[1]:ends[2]],
+                    packed[ends[2]:ends[3]], bits, cycles)
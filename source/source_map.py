@@ -0,0 +1,63 @@
+import bisect
+import json
+
+
+# Maps ROM addresses back to the assembly source. Written by assemble_rom.py
+# next to the ROM. Entries are stored column-wise and sorted by address, so a
+# lookup is a bisect over the address column.
+class SourceMap:
+    def __init__(self, file, size, labels, addresses, lines, scopes, text):
+        self.file = file
+        self.size = size
+        self.labels = labels  # name -> address
+        self.addresses = addresses  # first address of every source line that emitted code
+        self.lines = lines  # line number, or None for code the assembler added
+        self.scopes = scopes  # closest label at or before the address
+        self.text = text
+
+    @staticmethod
+    def build(file, size, labels, entries):
+        columns = list(zip(*entries)) if len(entries) > 0 else [[], [], [], []]
+        return SourceMap(file, size, labels, *[list(column) for column in columns])
+
+    def save(self, path):
+        with open(path, "w") as ofs:
+            json.dump(vars(self), ofs, separators=(",", ":"))
+
+    @staticmethod
+    def load(path):
+        with open(path, "r") as ifs:
+            return SourceMap(**json.load(ifs))
+
+    def index(self, address):
+        if address < 0 or address >= self.size:
+            return None
+        index = bisect.bisect_right(self.addresses, address) - 1
+        return index if index >= 0 else None
+
+    # (address, file, line, label, text) of the source line that produced the address
+    def lookup(self, address):
+        index = self.index(address)
+        if index is None:
+            return None
+        return (self.addresses[index], self.file, self.lines[index], self.scopes[index], self.text[index])
+
+    def label_address(self, name):
+        return self.labels[name]
+
+    # Closest label at or before the address and the offset from it, eg. ("ghc_loop", 7)
+    def symbol(self, address):
+        index = self.index(address)
+        if index is None or self.scopes[index] is None:
+            return None
+        label = self.scopes[index]
+        return (label, address - self.labels[label])
+
+    def format(self, address):
+        entry = self.lookup(address)
+        if entry is None:
+            return f"{address:02X}"
+        (start, file, line, label, text) = entry
+        symbol = f"{label}+{address - self.labels[label]}" if label is not None else f"{address:02X}"
+        location = f"{file}:{line}" if line is not None else file
+        return f"{symbol} ({location}: {text})"
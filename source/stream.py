@@ -0,0 +1,108 @@
+import itertools
+
+import amaranth as am
+from amaranth.sim import Delay, Passive, Settle
+
+from codes import load_words
+
+
+# Words of a stream file, read lazily. .bin files hold raw words like a ROM
+# image, anything else whitespace separated numbers.
+def read_stream(path, word_size=8, endian="little"):
+    if path.endswith(".bin"):
+        yield from load_words(path, word_size, endian)
+        return
+    with open(path, "r") as ifs:
+        for line in ifs:
+            for token in line.split():
+                yield int(token, 0)
+
+
+# Feeds the input FIFO of a Cpu from an iterator and drains its output FIFO,
+# from one passive process. Words move in bursts: both fill levels are sampled
+# once, and then the words go through on consecutive cycles without further
+# handshakes. This is safe because the Cpu only takes words out of the input
+# FIFO and only puts words into the output FIFO, at most one per cycle. So
+# between bursts the process sleeps until half of the input FIFO is free or
+# half of the output FIFO is full, which is the earliest that can happen and
+# leaves the Cpu half a FIFO of slack on both sides.
+class StreamDriver:
+    def __init__(self, dut, inputs=(), block_size=64, on_output=None, period=1e-6):
+        self.dut = dut
+        self.inputs = iter(inputs)
+        self.block_size = block_size
+        self.on_output = on_output
+        self.period = period
+        self.block = []
+        self.outputs = []
+        self.flushing = False
+
+    def add_to(self, sim):
+        sim.add_sync_process(self.run)
+
+    def sleep(self, cycles):
+        # Wakes up between two edges, so that the tick is the last of them
+        yield Delay((cycles - 0.5) * self.period)
+        yield
+
+    def run(self):
+        yield Passive()
+        (input_fifo, output_fifo) = (self.dut.input_fifo, self.dut.output_fifo)
+        levels = am.Cat(input_fifo.w_level, output_fifo.r_level)
+        level_bits = len(input_fifo.w_level)
+        (input_half, output_half) = (max(1, input_fifo.depth // 2), max(1, output_fifo.depth // 2))
+        data_bits = len(input_fifo.w_data)
+        while True:
+            if len(self.block) == 0:
+                self.block = list(itertools.islice(self.inputs, self.block_size))
+            yield Settle()
+            value = yield levels
+            room = input_fifo.depth - (value & ((1 << level_bits) - 1))
+            full = value >> level_bits
+
+            # A short block is the end of the stream, and goes in as soon as it fits
+            wanted = min(input_half, len(self.block))
+            feed = min(room, len(self.block)) if len(self.block) > 0 and room >= wanted else 0
+            drain = full if full >= (1 if self.flushing else output_half) else 0
+            if feed == 0 and drain == 0:
+                deficits = [(1 if self.flushing else output_half) - full]
+                if len(self.block) > 0:
+                    deficits.append(wanted - room)
+                yield from self.sleep(min(deficits))
+                continue
+
+            if drain > 0:
+                yield output_fifo.r_en.eq(1)
+            for cycle in range(max(feed, drain)):
+                if cycle < feed:
+                    # w_en is the top bit, one command sets both
+                    yield am.Cat(input_fifo.w_data, input_fifo.w_en).eq(self.block[cycle] | 1 << data_bits)
+                elif cycle == feed and feed > 0:
+                    yield input_fifo.w_en.eq(0)
+                if cycle < drain:
+                    yield Settle()
+                    word = yield output_fifo.r_data
+                    self.outputs.append(word)
+                    if self.on_output is not None:
+                        self.on_output(word)
+                elif cycle == drain and drain > 0:
+                    yield output_fifo.r_en.eq(0)
+                yield
+            if feed >= drain and feed > 0:
+                yield input_fifo.w_en.eq(0)
+            if drain >= feed:
+                yield output_fifo.r_en.eq(0)
+            del self.block[:feed]
+
+    # Runs the clock until the output FIFO is empty, once the Cpu has halted
+    def flush(self):
+        self.flushing = True
+        yield Settle()
+        while (yield self.dut.output_fifo.r_level) > 0:
+            yield
+            yield Settle()
+
+    # Inputs the Cpu has not read, which consumes the rest of the iterator
+    def unread(self):
+        yield Settle()
+        return (yield self.dut.input_fifo.r_level) + len(self.block) + sum(1 for _ in self.inputs)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from amaranth.back import rtlil
+
+from alu_units import ALU_UNITS
+from codes import load_words
+from cpu import Cpu
+from pipelined_cpu import PipelinedCpu
+
+
+CORES = {
+    "cpu": Cpu,
+    "pipelined": PipelinedCpu,
+}
+
+# Only uses passes that are also in the Yosys bundled with
+# amaranth[builtin-yosys], which has no synth, abc or stat. The netlist is
+# analysed here instead. File names are relative, because the bundled Yosys
+# can only see its working directory.
+SCRIPT = """
+read_rtlil design.il
+hierarchy -top top
+proc
+flatten
+opt -fast
+wreduce
+memory_collect
+opt_clean
+write_json netlist.json
+"""
+
+SEQUENTIAL = {"$dff", "$dffe", "$adff", "$adffe", "$sdff", "$sdffe", "$sdffce", "$aldff", "$aldffe", "$dffsr",
+              "$dffsre", "$dlatch", "$adlatch", "$dlatchsr", "$ff"}
+
+
+def clog2(value):
+    return max(1, (int(value) - 1).bit_length())
+
+
+# Rough delay of a cell in 2-input gate levels
+def cell_delay(cell):
+    kind = cell["type"]
+    parameters = cell["parameters"]
+    width = int(parameters.get("Y_WIDTH", parameters.get("WIDTH", "1")), 2)
+    a_width = int(parameters.get("A_WIDTH", "1"), 2)
+    if kind in ["$pos", "$buf"]:
+        return 0
+    if kind in ["$not", "$and", "$or", "$xor", "$xnor", "$mux", "$demux"]:
+        return 1
+    if kind in ["$logic_not", "$logic_and", "$logic_or", "$reduce_and", "$reduce_or", "$reduce_xor",
+                "$reduce_bool"]:
+        return clog2(a_width)
+    if kind in ["$eq", "$ne", "$eqx", "$nex"]:
+        return 1 + clog2(a_width)
+    if kind in ["$add", "$sub", "$neg", "$lt", "$le", "$gt", "$ge"]:
+        return 2 * clog2(max(width, a_width)) + 1
+    if kind == "$mul":
+        return 4 * clog2(width) + 2
+    if kind in ["$div", "$mod", "$divfloor", "$modfloor"]:
+        return width * (2 * clog2(width) + 1)
+    if kind in ["$shl", "$shr", "$sshl", "$sshr", "$shift", "$shiftx"]:
+        return clog2(a_width)
+    if kind == "$pmux":
+        return 1 + clog2(int(parameters["S_WIDTH"], 2))
+    if kind == "$bmux":
+        return clog2(int(parameters["S_WIDTH"], 2))
+    if kind == "$mem_v2":
+        return clog2(int(parameters["SIZE"], 2))
+    return 1
+
+
+# Longest combinational path from a register, memory or input to a register,
+# memory or output, both in cells and in estimated gate levels
+def analyse(netlist):
+    module = netlist["modules"]["top"]
+    cells = module["cells"]
+    drivers = {}
+    for (name, cell) in cells.items():
+        for (port, direction) in cell["port_directions"].items():
+            if direction == "output":
+                for bit in cell["connections"][port]:
+                    drivers[bit] = name
+
+    def is_source(cell):
+        if cell["type"] in SEQUENTIAL:
+            return True
+        # Memories with only registered read ports start a path
+        return cell["type"] == "$mem_v2" and int(cell["parameters"]["RD_CLK_ENABLE"], 2) != 0
+
+    # Depth first, without recursion. Cells that are already being visited
+    # are skipped, so a combinational loop can not hang the analysis.
+    arrival = {}
+    visiting = set()
+    for name in cells:
+        stack = [(name, False)]
+        while len(stack) > 0:
+            (current, expanded) = stack.pop()
+            if current in arrival:
+                continue
+            cell = cells[current]
+            inputs = []
+            if not is_source(cell):
+                for (port, direction) in cell["port_directions"].items():
+                    if direction == "input":
+                        inputs.extend(drivers[bit] for bit in cell["connections"][port] if bit in drivers)
+            pending = [driver for driver in inputs if driver not in arrival and driver not in visiting]
+            if not expanded and len(pending) > 0:
+                visiting.add(current)
+                stack.append((current, True))
+                stack.extend((driver, False) for driver in pending)
+                continue
+            visiting.discard(current)
+            (levels, delay) = (0, 0)
+            for driver in inputs:
+                if driver in arrival:
+                    levels = max(levels, arrival[driver][0])
+                    delay = max(delay, arrival[driver][1])
+            if is_source(cell):
+                arrival[current] = (0, 0)
+            else:
+                arrival[current] = (levels + 1, delay + cell_delay(cell))
+
+    counts = {}
+    (flip_flops, memories, memory_bits) = (0, 0, 0)
+    for cell in cells.values():
+        counts[cell["type"]] = counts.get(cell["type"], 0) + 1
+        if cell["type"] in SEQUENTIAL:
+            flip_flops += int(cell["parameters"]["WIDTH"], 2)
+        if cell["type"] == "$mem_v2":
+            memories += 1
+            memory_bits += int(cell["parameters"]["WIDTH"], 2) * int(cell["parameters"]["SIZE"], 2)
+
+    return {
+        "cells": len(cells),
+        "cell_types": dict(sorted(counts.items())),
+        "flip_flops": flip_flops,
+        "memories": memories,
+        "memory_bits": memory_bits,
+        "logic_depth": max((levels for (levels, delay) in arrival.values()), default=0),
+        "gate_levels": max((delay for (levels, delay) in arrival.values()), default=0),
+    }
+
+
+def yosys_command(yosys):
+    # The Yosys bundled with amaranth[builtin-yosys] runs as a Python module
+    return [sys.executable, "-m", "amaranth_yosys"] if yosys == "builtin" else [yosys]
+
+
+def elaborate(rom_file, core, word_size, ram_size, addr_bus_width, harvard, alu="comb", alu_radix=2, cache_lines=0):
+    dut = CORES[core](rom_file, word_size=word_size, addr_bus_width=addr_bus_width, ram_size=ram_size,
+                      harvard=harvard, multiplier=alu, divider=alu, alu_radix=alu_radix, cache_lines=cache_lines)
+    ports = [dut.hf, dut.iocf, dut.irf, dut.owf, dut.input(), dut.output()]
+    return rtlil.convert(dut, ports=ports)
+
+
+def synthesize(config, rom_file, yosys="builtin", gate_delay=0.1):
+    start = time.perf_counter()
+    result = dict(config)
+    # A configuration that can not be built is an error of its own, and the
+    # rest of the matrix still runs
+    try:
+        design = elaborate(rom_file, **config)
+    except Exception as e:
+        result["error"] = f"{e.__class__.__name__}: {e}"
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "design.il"), "w") as ofs:
+            ofs.write(design)
+        result["elaborate_seconds"] = time.perf_counter() - start
+        with open(os.path.join(directory, "synth.ys"), "w") as ofs:
+            ofs.write(SCRIPT)
+
+        process = subprocess.run(yosys_command(yosys) + ["-q", "-s", "synth.ys"], cwd=directory,
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            result["error"] = (process.stderr.strip().splitlines() or ["yosys failed"])[-1]
+            return result
+
+        with open(os.path.join(directory, "netlist.json"), "r") as ifs:
+            result.update(analyse(json.load(ifs)))
+
+    # Rough estimate, every gate level costs gate_delay ns including routing
+    result["critical_path_ns"] = result["gate_levels"] * gate_delay
+    result["fmax_mhz"] = 1000 / result["critical_path_ns"] if result["gate_levels"] > 0 else None
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def name(config):
+    alu = f" seq{config['alu_radix']}" if config.get("alu", "comb") == "sequential" else ""
+    cache = f" c{config['cache_lines']}" if config.get("cache_lines", 0) else ""
+    return (f"{config['core']}{'-harvard' if config['harvard'] else ''} w{config['word_size']} "
+            f"r{config['ram_size']} a{config['addr_bus_width']}{alu}{cache}")
+
+
+# Compare against the latest entry in the history with the same configuration
+def regressions(result, history, tolerance):
+    previous = None
+    for entry in history:
+        for old in entry["results"]:
+            if name(old) == name(result) and "error" not in old:
+                previous = old
+    if previous is None or "error" in result:
+        return []
+
+    found = []
+    for key in ["cells", "flip_flops", "logic_depth", "gate_levels"]:
+        if result[key] > previous[key] * (1 + tolerance):
+            found.append(f"{key} {previous[key]} -> {result[key]}")
+    return found
+
+
+def git_commit():
+    process = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return process.stdout.strip() if process.returncode == 0 else None
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", nargs=1, default=["build/rom_file"])
+    ap.add_argument("-o", "--history", nargs=1, default=["build/synth_history.json"])
+    ap.add_argument("--cores", nargs="*", default=["cpu"], choices=list(CORES))
+    ap.add_argument("--harvard", nargs="*", type=int, default=[0], help="0 for von Neumann, 1 for harvard")
+    ap.add_argument("--word-sizes", nargs="*", type=int, default=[8])
+    ap.add_argument("--ram-sizes", nargs="*", type=int, default=[256], help="sizes smaller than the ROM are skipped")
+    ap.add_argument("--addr-bus-widths", nargs="*", type=int, default=[8])
+    ap.add_argument("--alu", nargs="*", default=["comb"], choices=ALU_UNITS,
+                    help="multiplier and divider, sequential ones stall until done")
+    ap.add_argument("--alu-radixes", nargs="*", type=int, default=[2], help="radixes of the sequential units")
+    ap.add_argument("--cache-lines", nargs="*", type=int, default=[0], help="cache sizes in lines, 0 for no caches")
+    ap.add_argument("--yosys", default="builtin", help="path to a yosys binary, or builtin")
+    ap.add_argument("--gate-delay", type=float, default=0.1, help="ns per gate level for the critical path estimate")
+    ap.add_argument("--tolerance", type=float, default=0.02, help="relative growth reported as a regression")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    args = ap.parse_args()
+
+    history = []
+    if os.path.exists(args.history[0]):
+        with open(args.history[0], "r") as ifs:
+            history = json.load(ifs)
+
+    results = []
+    failed = False
+    alus = [(alu, radix) for alu in args.alu for radix in (args.alu_radixes if alu == "sequential" else [2])]
+    for (core, harvard, word_size, ram_size, addr_bus_width, (alu, alu_radix), cache_lines) in itertools.product(
+            args.cores, args.harvard, args.word_sizes, args.ram_sizes, args.addr_bus_widths, alus, args.cache_lines):
+        # Caches are only in Cpu, and replace the harvard instruction memory
+        if cache_lines and (core != "cpu" or harvard):
+            continue
+        rom_words = len(load_words(args.input[0], word_size))
+        if ram_size < rom_words:
+            print(f"skipped r{ram_size}: the ROM has {rom_words} words")
+            continue
+        config = {"core": core, "harvard": bool(harvard), "word_size": word_size, "ram_size": ram_size,
+                  "addr_bus_width": addr_bus_width, "alu": alu, "alu_radix": alu_radix, "cache_lines": cache_lines}
+        result = synthesize(config, args.input[0], args.yosys, args.gate_delay)
+        results.append(result)
+
+        if "error" in result:
+            print(f"{name(config):32} error: {result['error']}")
+            failed = True
+            continue
+        print(f"{name(config):32} {result['cells']:7} cells {result['flip_flops']:6} FFs "
+              f"{result['memories']:2} memories ({result['memory_bits']} bits) depth {result['logic_depth']:3} "
+              f"~{result['gate_levels']} gate levels ~{result['fmax_mhz']:.1f} MHz in {result['seconds']:.1f} s")
+        for regression in regressions(result, history, args.tolerance):
+            print(f"  regression: {regression}")
+            failed = True
+
+    history.append({
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "results": results,
+    })
+    os.makedirs(os.path.dirname(args.history[0]) or ".", exist_ok=True)
+    with open(args.history[0], "w") as ofs:
+        json.dump(history, ofs, indent=2)
+
+    if failed and args.fail_on_regression:
+        sys.exit(1)
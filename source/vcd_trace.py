@@ -0,0 +1,118 @@
+import collections
+
+import vcd
+
+from codes import Argument
+
+
+DEFAULT_SIGNALS = ["pc", "status", "hf", "iocf", "irf", "owf"]
+
+
+# Names that can be traced: the internal flags, the status bits, every register
+# and the performance counters
+def signal_table(dut):
+    signals = {
+        "hf": (dut.hf, 1),
+        "iocf": (dut.iocf, 1),
+        "irf": (dut.irf, 1),
+        "owf": (dut.owf, 1),
+        "c": (dut.c(), 1),
+        "o": (dut.o(), 1),
+        "s": (dut.s(), 1),
+        "z": (dut.z(), 1),
+    }
+    for index in range(Argument._NUM_REGS):
+        signals[Argument.lookup(index).lower()] = (dut.registers[index], dut.word_size)
+    for (index, counter) in enumerate(dut.counters):
+        signals[Argument.lookup(Argument._FIRST_COUNTER + index).lower()] = (counter, dut.word_size)
+    return signals
+
+
+# Records a chosen set of signals from inside a bench, instead of dumping every
+# signal of the design for the whole run. Recording starts at start_tick or
+# start_pc and ends at stop_tick or stop_pc. With a window, only the last
+# window cycles are kept and they are written when the run ends with hf or iocf
+# set.
+class VcdTrace:
+    units = "cycles"
+
+    def __init__(self, path, names=None, start_tick=None, stop_tick=None, start_pc=None, stop_pc=None,
+                 window=None):
+        self.path = path
+        self.names = names if names is not None else DEFAULT_SIGNALS
+        self.start_tick = start_tick
+        self.stop_tick = stop_tick
+        self.start_pc = start_pc
+        self.stop_pc = stop_pc
+        self.window = window
+
+        self.active = start_tick is None and start_pc is None
+        self.done = False
+        self.samples = collections.deque(maxlen=window)
+        self.written = 0
+        self.writer = None
+
+    def attach(self, dut):
+        table = signal_table(dut)
+        for name in self.names:
+            if name not in table:
+                raise Exception(f"Unknown trace signal: {name}, expected one of {', '.join(table)}")
+        self.signals = [table[name][0] for name in self.names]
+        self.widths = [table[name][1] for name in self.names]
+        self.pc = dut.pc()
+        self.hf = dut.hf
+        self.iocf = dut.iocf
+
+    # Called by the bench once per cycle, before the clock edge
+    def sample(self, cycles):
+        if self.done:
+            return
+
+        if self.start_pc is not None or self.stop_pc is not None:
+            pc = yield self.pc
+            if not self.active and pc == self.start_pc:
+                self.active = True
+            elif self.active and pc == self.stop_pc:
+                self.done = True
+                return
+        if self.start_tick is not None and not self.active and cycles >= self.start_tick:
+            self.active = True
+        if self.stop_tick is not None and cycles >= self.stop_tick:
+            self.done = True
+            return
+
+        if self.active:
+            values = []
+            for signal in self.signals:
+                values.append((yield signal))
+            if self.window is not None:
+                self.samples.append((cycles, values))
+            else:
+                self.emit(cycles, values)
+
+    # Called by the bench when the run ends, returns the number of cycles written
+    def finish(self, cycles):
+        if self.active and not self.done:
+            yield from self.sample(cycles)
+        if self.window is not None and ((yield self.hf) or (yield self.iocf)):
+            for (cycles, values) in self.samples:
+                self.emit(cycles, values)
+        if self.writer is not None:
+            self.writer.close()
+            self.ofs.close()
+        return self.written
+
+    def emit(self, cycles, values):
+        if self.writer is None:
+            self.ofs = open(self.path, "w")
+            self.writer = vcd.VCDWriter(self.ofs, timescale="1 us")
+            self.variables = []
+            for (name, width) in zip(self.names, self.widths):
+                self.variables.append(self.writer.register_var("cpu", name, "wire", size=width))
+            self.last = [None] * len(self.variables)
+
+        for (index, value) in enumerate(values):
+            if value != self.last[index]:
+                self.writer.change(self.variables[index], cycles, value)
+                self.last[index] = value
+        self.written += 1